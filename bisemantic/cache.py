@@ -0,0 +1,125 @@
+"""
+Persistent cache of predictions
+"""
+import hashlib
+import sqlite3
+
+import numpy as np
+
+from bisemantic import logger
+
+
+class PredictionCache(object):
+    """
+    Probability distributions predicted for text pairs, stored in an SQLite database.
+
+    Entries are keyed by a hash of the text pair and the fingerprint of the model that made the prediction, so a
+    retrained model never sees another model's predictions. When the cache holds more than its maximum number of
+    entries, the least recently used ones are evicted.
+    """
+
+    # SQLite limits the number of parameters in a statement.
+    chunk_size = 500
+
+    def __init__(self, filename, maximum_size=None):
+        """
+        :param filename: database file, created if it does not exist
+        :type filename: str
+        :param maximum_size: maximum number of predictions to keep or None to keep all of them
+        :type maximum_size: int or None
+        """
+        self.filename = filename
+        self.maximum_size = maximum_size
+        self.connection = sqlite3.connect(filename)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS predictions "
+                                    "(model TEXT, pair BLOB, probabilities BLOB, used INTEGER, "
+                                    "PRIMARY KEY (model, pair))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)")
+        self._clock = self.connection.execute("SELECT COALESCE(MAX(used), 0) FROM predictions").fetchone()[0]
+
+    def __repr__(self):
+        return "%s(%s, %d predictions)" % (self.__class__.__name__, self.filename, len(self))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @staticmethod
+    def pair_keys(text_1s, text_2s):
+        """
+        :param text_1s: first elements of the text pairs
+        :type text_1s: iterable of str
+        :param text_2s: second elements of the text pairs
+        :type text_2s: iterable of str
+        :return: a hash of each text pair
+        :rtype: list of bytes
+        """
+        return [hashlib.sha1(("%s\0%s" % (t1, t2)).encode("utf-8")).digest() for t1, t2 in zip(text_1s, text_2s)]
+
+    def get(self, model, keys, classes):
+        """
+        Look up predictions and mark the ones found as recently used.
+
+        :param model: model fingerprint
+        :type model: str
+        :param keys: text pair hashes
+        :type keys: list of bytes
+        :param classes: number of classes the model predicts
+        :type classes: int
+        :return: a matrix of predictions and a mask of the rows for which predictions were found
+        :rtype: (numpy.array, numpy.array)
+        """
+        probabilities = np.zeros((len(keys), classes), dtype=np.float32)
+        found = np.zeros(len(keys), dtype=bool)
+        positions = {}
+        for i, key in enumerate(keys):
+            positions.setdefault(key, []).append(i)
+        unique_keys = list(positions)
+        with self.connection:
+            for start in range(0, len(unique_keys), self.chunk_size):
+                chunk = unique_keys[start:start + self.chunk_size]
+                parameters = ",".join("?" * len(chunk))
+                rows = self.connection.execute("SELECT pair, probabilities FROM predictions "
+                                               "WHERE model = ? AND pair IN (%s)" % parameters,
+                                               [model] + chunk).fetchall()
+                for key, value in rows:
+                    i = positions[bytes(key)]
+                    probabilities[i] = np.frombuffer(value, dtype=np.float32)
+                    found[i] = True
+                self._clock += 1
+                self.connection.execute("UPDATE predictions SET used = ? "
+                                        "WHERE model = ? AND pair IN (%s)" % parameters, [self._clock, model] + chunk)
+        logger.info("Prediction cache: %d hits, %d misses" % (found.sum(), len(found) - found.sum()))
+        return probabilities, found
+
+    def put(self, model, keys, probabilities):
+        """
+        Store predictions, evicting the least recently used ones if the cache is full.
+
+        :param model: model fingerprint
+        :type model: str
+        :param keys: text pair hashes
+        :type keys: list of bytes
+        :param probabilities: matrix of predictions, one row per key
+        :type probabilities: numpy.array
+        """
+        self._clock += 1
+        rows = ((model, key, np.asarray(p, dtype=np.float32).tobytes(), self._clock)
+                for key, p in zip(keys, probabilities))
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)", rows)
+            if self.maximum_size is not None:
+                excess = len(self) - self.maximum_size
+                if excess > 0:
+                    self.connection.execute("DELETE FROM predictions WHERE rowid IN "
+                                            "(SELECT rowid FROM predictions ORDER BY used LIMIT ?)", (excess,))
+                    logger.info("Prediction cache: evicted %d predictions" % excess)
+
+    def close(self):
+        self.connection.close()
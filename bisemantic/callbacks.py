@@ -0,0 +1,524 @@
+"""
+Callbacks that record the progress of model training
+"""
+import json
+import math
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import h5py
+import numpy as np
+from keras.callbacks import Callback
+
+from bisemantic import logger
+from bisemantic.weights import save_weight_arrays
+
+
+class AsyncModelCheckpoint(Callback):
+    """
+    Save the model whenever the monitored quantity improves without making training wait on the file system.
+
+    The model is saved to a local temporary file on the training thread, which is fast but does wait for the model to
+    be serialized, and then a background thread copies it to its destination and atomically renames it into place, so
+    a slow or networked model directory does not stall training and never contains a partially written model.
+
+    Optionally a copy of the model is also kept every N epochs, retaining only the K most recent copies, and the weights
+    of the best model are also written to a file that can be memory-mapped. Those weights are copied from the model on
+    the training thread and serialized on the background thread.
+    """
+
+    def __init__(self, filepath, monitor="val_loss", verbose=0, every_epochs=None, keep=None, epoch_filepath=None,
+                 mapped_filepath=None):
+        """
+        :param filepath: where to write the best model
+        :type filepath: str
+        :param monitor: quantity to monitor
+        :type monitor: str
+        :param verbose: verbosity mode
+        :type verbose: int
+        :param every_epochs: keep a copy of the model every this many epochs or None to keep no copies
+        :type every_epochs: int or None
+        :param keep: number of copies to keep or None to keep all of them
+        :type keep: int or None
+        :param epoch_filepath: name template for the copies, formatted with the epoch number
+        :type epoch_filepath: str or None
+        :param mapped_filepath: where to write the weights of the best model in memory-mappable form or None to not
+            write them
+        :type mapped_filepath: str or None
+        """
+        super().__init__()
+        self.filepath = filepath
+        self.monitor = monitor
+        self.verbose = verbose
+        self.every_epochs = every_epochs
+        self.keep = keep
+        self.epoch_filepath = epoch_filepath
+        self.mapped_filepath = mapped_filepath
+        self.best = np.inf
+        self.writer = None
+        self._copies = []
+
+    def on_train_begin(self, logs=None):
+        self.writer = BackgroundFileWriter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        destinations = []
+        current = logs.get(self.monitor)
+        if current is None:
+            logger.warning("Can save best model only with %s available, skipping" % self.monitor)
+        elif current < self.best:
+            if self.verbose > 0:
+                print("Epoch %05d: %s improved from %0.5f to %0.5f, saving model to %s" %
+                      (epoch + 1, self.monitor, self.best, current, self.filepath))
+            self.best = current
+            destinations.append(self.filepath)
+        if self.every_epochs is not None and (epoch + 1) % self.every_epochs == 0:
+            copy = self.epoch_filepath.format(epoch=epoch + 1)
+            destinations.append(copy)
+            self._copies.append(copy)
+        if destinations:
+            f, temporary = tempfile.mkstemp(suffix=".h5")
+            os.close(f)
+            self.model.save(temporary, overwrite=True)
+            self.writer.submit(temporary, destinations)
+            if self.filepath in destinations and self.mapped_filepath is not None:
+                # Written after the model file, so mapped weights older than the model file are out of date. The
+                # weights are copied now, since training changes them while they are being written.
+                architecture, weights = self.model.to_json(), self.model.get_weights()
+                self.writer.submit_write(lambda filename: save_weight_arrays(architecture, weights, filename),
+                                         [self.mapped_filepath])
+            if self.keep is not None:
+                while len(self._copies) > self.keep:
+                    self.writer.remove(self._copies.pop(0))
+
+    def on_train_end(self, logs=None):
+        self.close()
+
+    def close(self):
+        """
+        Wait for the checkpoints to be written. This is done when training ends, but not if training fails.
+        """
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            writer.close()
+
+
+class ResumeCheckpoint(Callback):
+    """
+    Save everything needed to resume training exactly where it stopped.
+
+    The model, including its optimizer state, is saved at the end of every epoch and optionally every N batches. The
+    epoch and the number of batches completed in it are stored along with a description of the run in an attribute of
+    the saved model file, so the model and the training position can never get out of sync. As with AsyncModelCheckpoint
+    the file is written in the background and atomically renamed into place.
+
+    If the training data is sampled, the recorded losses of its samples and the sampling counts are saved too.
+    """
+
+    def __init__(self, filepath, state, every_batches=None, generator=None):
+        """
+        :param filepath: where to write the resume checkpoint
+        :type filepath: str
+        :param state: description of the training run to store with the checkpoint
+        :type state: dict
+        :param every_batches: save every this many batches or None to only save at the end of epochs
+        :type every_batches: int or None
+        :param generator: training data generator
+        :type generator: bisemantic.data.TextPairEmbeddingGenerator or None
+        """
+        super().__init__()
+        self.filepath = filepath
+        self.state = state
+        self.every_batches = every_batches
+        self.generator = generator
+        # Number of batches of the first epoch that were completed before training started.
+        self.batch_offset = 0
+        self.epoch = 0
+        self.writer = None
+
+    def on_train_begin(self, logs=None):
+        self.writer = BackgroundFileWriter()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        # The end of the epoch is handled by on_epoch_end.
+        if self.every_batches is not None and (batch + 1) % self.every_batches == 0 and \
+                batch + 1 < self.params["steps"]:
+            self._save(self.epoch, self.batch_offset + batch + 1)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.batch_offset = 0
+        self._save(epoch + 1, 0)
+
+    def on_train_end(self, logs=None):
+        self.close()
+
+    def close(self):
+        """
+        Wait for the checkpoints to be written. This is done when training ends, but not if training fails.
+        """
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            writer.close()
+
+    def _save(self, epoch, batch):
+        f, temporary = tempfile.mkstemp(suffix=".h5")
+        os.close(f)
+        self.model.save(temporary, overwrite=True)
+        state = dict(self.state, epoch=epoch, batch=batch)
+        sampled = self.generator is not None and self.generator.sampled
+        if sampled:
+            g = self.generator
+            state.update({"sampled-epochs": g.sampled_epochs, "trained-samples": g.trained_samples,
+                          "scored-samples": g.scored_samples})
+        with h5py.File(temporary, "a") as f:
+            f.attrs["resume-state"] = json.dumps(state, sort_keys=True)
+            if sampled:
+                f.create_dataset("sample-losses", data=self.generator.sample_losses)
+        self.writer.submit(temporary, [self.filepath])
+
+
+def read_resume_state(filename):
+    """
+    :param filename: file written by ResumeCheckpoint
+    :type filename: str
+    :return: description of the interrupted run and the epoch and batch at which to resume it
+    :rtype: dict
+    """
+    with h5py.File(filename, "r") as f:
+        state = f.attrs["resume-state"]
+    if isinstance(state, bytes):
+        state = state.decode("utf-8")
+    return json.loads(state)
+
+
+def read_resume_sample_losses(filename):
+    """
+    :param filename: file written by ResumeCheckpoint
+    :type filename: str
+    :return: the recorded losses of the samples of sampled training data or None if the data was not sampled
+    :rtype: numpy.array or None
+    """
+    with h5py.File(filename, "r") as f:
+        if "sample-losses" not in f:
+            return None
+        return f["sample-losses"][()]
+
+
+class BackgroundFileWriter(object):
+    """
+    Copy files into place on a background thread, in the order they were submitted.
+    """
+
+    def __init__(self):
+        self.tasks = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, source, destinations):
+        """
+        Copy a file to destinations, replacing each atomically, and then delete the file.
+
+        :param source: file to copy
+        :type source: str
+        :param destinations: files to write
+        :type destinations: list of str
+        """
+        self.tasks.put((source, destinations))
+
+    def submit_write(self, write, destinations):
+        """
+        Write a temporary file on the background thread, then copy it to destinations as submit does.
+
+        :param write: function that writes the file named by its argument
+        :type write: callable
+        :param destinations: files to write
+        :type destinations: list of str
+        """
+        self.tasks.put((write, destinations))
+
+    def remove(self, filename):
+        self.tasks.put((None, [filename]))
+
+    def close(self):
+        """
+        Wait for all submitted writes to finish.
+
+        :raises: the first error encountered by the background thread
+        """
+        self.tasks.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        for source, destinations in iter(self.tasks.get, None):
+            try:
+                if source is None:
+                    for destination in destinations:
+                        if os.path.exists(destination):
+                            os.remove(destination)
+                else:
+                    if callable(source):
+                        f, temporary = tempfile.mkstemp()
+                        os.close(f)
+                        source(temporary)
+                        source = temporary
+                    for destination in destinations:
+                        atomic_copy(source, destination)
+                    os.remove(source)
+            except Exception as e:
+                logger.error("Failed to write %s: %s" % (destinations, e))
+                if self.error is None:
+                    self.error = e
+
+
+def atomic_copy(source, destination):
+    """
+    Copy a file so that the destination is either absent, its old version, or a complete copy of the source.
+
+    :param source: file to copy
+    :type source: str
+    :param destination: file to write
+    :type destination: str
+    """
+    # A name of its own, so that writers copying to the same destination do not write to the same temporary file.
+    f, temporary = tempfile.mkstemp(dir=os.path.dirname(destination) or ".", prefix=os.path.basename(destination) + ".",
+                                    suffix=".tmp")
+    os.close(f)
+    try:
+        shutil.copyfile(source, temporary)
+        os.replace(temporary, destination)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+class EpochHistoryLog(Callback):
+    """
+    Append the metrics of every epoch to a JSON lines file as soon as the epoch ends.
+
+    Unlike the training history, which is written when training is done, this leaves a record of the completed epochs
+    behind if training is interrupted.
+    """
+
+    def __init__(self, filename, run):
+        """
+        :param filename: JSON lines file to append to
+        :type filename: str
+        :param run: identifier of the training run
+        :type run: str
+        """
+        super().__init__()
+        self.filename = filename
+        self.run = run
+
+    def on_epoch_end(self, epoch, logs=None):
+        record = {"run": self.run, "epoch": epoch + 1}
+        record.update((name, float(value)) for name, value in (logs or {}).items())
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class ThroughputLog(Callback):
+    """
+    Add measurements of the speed and memory use of every epoch to the epoch's metrics.
+
+    These are recorded wherever the loss is, in the training history and the epoch history log:
+
+    * epoch_seconds: time spent training, not counting validation
+    * samples_per_second: samples trained on per second of training
+    * wait_seconds: time the model spent waiting for the next batch, which is high when embedding cannot keep up
+    * peak_memory: the most memory this process has used since it started, in bytes, where the operating system reports
+      it, so it never decreases from one epoch to the next
+
+    The model waits between the end of one batch and the start of the next, while the batch is taken from the queue of
+    embedded batches, so a model starved of data spends much of its time there. The time the other callbacks take at
+    the end of a batch is not waiting, so the wait is timed from the end of the last callback, which is this log's
+    fetch_start callback.
+
+    This must come before the other callbacks so that they see these metrics, and fetch_start must come after them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._start = self._batch_end = time.time()
+        self._samples = 0
+        self._wait = 0
+        self.fetch_start = BatchEndTime()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = self._batch_end = self.fetch_start.time = time.time()
+        self._samples = 0
+        self._wait = 0
+
+    def on_batch_begin(self, batch, logs=None):
+        self._wait += time.time() - self.fetch_start.time
+
+    def on_batch_end(self, batch, logs=None):
+        self._samples += (logs or {}).get("size", 0)
+        self._batch_end = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is None:
+            return
+        seconds = self._batch_end - self._start
+        logs["epoch_seconds"] = seconds
+        logs["samples_per_second"] = self._samples / seconds if seconds else 0.0
+        logs["wait_seconds"] = self._wait
+        memory = peak_memory()
+        if memory is not None:
+            logs["peak_memory"] = float(memory)
+
+
+class BatchEndTime(Callback):
+    """
+    The time at which the most recent batch ended, as seen by the callbacks that come before this one.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.time = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        self.time = time.time()
+
+
+def peak_memory():
+    """
+    :return: the peak resident set size of this process in bytes or None if the operating system does not report it
+    :rtype: int or None
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    maximum = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes.
+    if sys.platform == "darwin":
+        return maximum
+    return maximum * 1024
+
+
+class HardExampleMining(Callback):
+    """
+    Score the samples that a sampling generator drew for each epoch once the epoch ends.
+
+    Keras reports the loss of a batch, not of its samples, so the samples are run through the model again after the
+    epoch and the cross-entropy of each one is recorded with the generator, which draws the samples for later epochs in
+    proportion to it. A sample drawn more than once in an epoch is scored once.
+
+    The generator keeps the samples drawn for each epoch by epoch number, because it draws epochs ahead of training.
+    """
+
+    def __init__(self, generator):
+        """
+        :param generator: training data generator that samples each epoch
+        :type generator: bisemantic.data.TextPairEmbeddingGenerator
+        """
+        super().__init__()
+        self.generator = generator
+
+    def on_epoch_end(self, epoch, logs=None):
+        g = self.generator
+        positions = g.take_epoch_positions(epoch)
+        if positions is None:
+            return
+        g.trained_samples += len(positions)
+        positions = np.unique(positions)
+        probabilities = self.model.predict_generator(g.embedded_texts(positions),
+                                                     math.ceil(len(positions) / g.batch_size))
+        p = probabilities[np.arange(len(positions)), g.label_codes(positions)]
+        g.record_losses(positions, -np.log(np.clip(p, 1e-7, 1)))
+        g.scored_samples += len(positions)
+        g.sampled_epochs += 1
+        logger.debug("Scored %d samples, mean loss %0.4f" % (len(positions), g.sample_losses[positions].mean()))
+
+
+class EpochSnapshot(Callback):
+    """
+    Keep the weights and optimizer state of the model as of the end of the last completed epoch, along with the metrics
+    of every completed epoch, so that training that fails partway through an epoch can carry on from the end of the
+    epoch before instead of starting over.
+
+    Before any epoch is completed the snapshot holds the state training started from.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # The epoch from which to carry on with the snapshot's state.
+        self.next_epoch = None
+        self.weights = self.optimizer_weights = None
+        self.history = {}
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if self.weights is None:
+            self._take(epoch)
+
+    def on_epoch_end(self, epoch, logs=None):
+        for name, value in (logs or {}).items():
+            self.history.setdefault(name, []).append(value)
+        self._take(epoch + 1)
+
+    def restore(self):
+        """
+        Return the model to the state in the snapshot.
+        """
+        self.model.set_weights(self.weights)
+        if self.optimizer_weights:
+            self.model.optimizer.set_weights(self.optimizer_weights)
+
+    def _take(self, next_epoch):
+        self.next_epoch = next_epoch
+        self.weights = self.model.get_weights()
+        self.optimizer_weights = self.model.optimizer.get_weights()
+
+
+def read_epoch_history(filename, run=None):
+    """
+    :param filename: JSON lines file written by EpochHistoryLog
+    :type filename: str
+    :param run: only return epochs from this run or None to return all epochs
+    :type run: str or None
+    :return: epoch records in the order they were written
+    :rtype: list of dict
+    """
+    records = []
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            for line in f:
+                # A crash may leave a partially written last line.
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if run is None or record["run"] == run:
+                    records.append(record)
+    return records
+
+
+def epoch_history_metrics(records):
+    """
+    :param records: epoch records returned by read_epoch_history
+    :type records: list of dict
+    :return: the values of each metric in epoch order, in the format of keras.callbacks.History.history
+    :rtype: dict
+    """
+    metrics = {}
+    for record in records:
+        for name, value in record.items():
+            if name not in ("run", "epoch"):
+                metrics.setdefault(name, []).append(value)
+    return metrics
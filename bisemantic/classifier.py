@@ -1,23 +1,90 @@
 """
 The model that classifies text pairs
 """
+import hashlib
 import json
 import logging
 import math
 import os
+import random
+import re
+import shutil
 import sys
+import tempfile
 import time
+from collections import deque
 from datetime import datetime, timedelta
 from io import StringIO
+from itertools import chain
 
+import numpy as np
 import pandas as pd
-from keras.callbacks import ModelCheckpoint
+from keras import backend as K
 from keras.engine import Model, Input
-from keras.layers import LSTM, multiply, concatenate, Dense, Dropout, Lambda, add, Bidirectional
-from keras.models import load_model
+from keras.layers import LSTM, multiply, concatenate, Dense, Dropout, Lambda, add, average, Bidirectional
+from keras.models import load_model, model_from_json
 
 from bisemantic import logger
-from bisemantic.data import TextPairEmbeddingGenerator, embedding_size, label, text_parser_info
+from bisemantic.callbacks import AsyncModelCheckpoint, EpochHistoryLog, EpochSnapshot, HardExampleMining, \
+    ResumeCheckpoint, ThroughputLog, read_epoch_history, epoch_history_metrics, read_resume_state, \
+    read_resume_sample_losses
+from bisemantic.data import TextPairEmbeddingGenerator, CompiledDataset, ShardedDataset, label, text_1, text_2
+from bisemantic.embedders import load_embedder, canonical_specification, resolve_specification, prune_vectors, \
+    Truncation, read_vocabulary, save_vectors, vectors_filename
+from bisemantic.metrics import StreamingMetrics
+from bisemantic.parallel import DataParallelTrainer
+from bisemantic.weights import save_mapped_weights, load_mapped_weights, is_current
+
+
+def _allocation_errors():
+    errors = (MemoryError,)
+    try:
+        import tensorflow as tf
+        errors += (tf.errors.ResourceExhaustedError,)
+    except ImportError:
+        pass
+    return errors
+
+
+# Exceptions raised when there is not enough memory for a batch.
+allocation_errors = _allocation_errors()
+
+# The settings made by configure_backend, which are recorded with every training run.
+backend_settings = {"seed": None, "intra-op-threads": None, "inter-op-threads": None}
+
+
+def configure_backend(seed=None, intra_op_threads=None, inter_op_threads=None):
+    """
+    Seed the random number generators and size the thread pools of the backend.
+
+    Call this before any model is created. Keras draws the seeds of weight initializers and dropout from numpy's global
+    random number generator, so seeding it along with the TensorFlow graph makes training on a CPU repeatable. GPU
+    kernels may still be nondeterministic.
+
+    The thread pool sizes are set on a new TensorFlow session. Each of several jobs on a host can then be limited to its
+    share of the cores instead of all of them sizing their pools to every core.
+
+    :param seed: random number seed or None to leave the generators as they are
+    :type seed: int or None
+    :param intra_op_threads: number of threads used within an operation or None to let the backend decide
+    :type intra_op_threads: int or None
+    :param inter_op_threads: number of operations run at the same time or None to let the backend decide
+    :type inter_op_threads: int or None
+    """
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    if K.backend() == "tensorflow":
+        import tensorflow as tf
+        if seed is not None:
+            tf.set_random_seed(seed)
+        if intra_op_threads is not None or inter_op_threads is not None:
+            config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads or 0,
+                                    inter_op_parallelism_threads=inter_op_threads or 0)
+            K.set_session(tf.Session(graph=tf.get_default_graph(), config=config))
+    elif intra_op_threads is not None or inter_op_threads is not None:
+        logger.warning("Thread pool sizes can only be set for the TensorFlow backend")
+    backend_settings.update({"seed": seed, "intra-op-threads": intra_op_threads, "inter-op-threads": inter_op_threads})
 
 
 class TextPairClassifier(object):
@@ -27,12 +94,14 @@ class TextPairClassifier(object):
 
     @classmethod
     def train(cls, training_data, bidirectional, lstm_units, epochs, dropout=None, maximum_tokens=None,
-              batch_size=2048, validation_data=None, model_directory=None):
+              batch_size=2048, validation_data=None, model_directory=None, embedder=None, pruned_vectors=None,
+              checkpoint_every=None, keep_checkpoints=None, resume_every=None, rendezvous=None, memory_budget=None,
+              swap_augmentation=False, truncation=None, sample_fraction=None, curriculum_epochs=None, seed=None):
         """
         Train a model from aligned text pairs in data frames.
 
         :param training_data: text pairs and labels
-        :type training_data: pandas.DataFrame
+        :type training_data: pandas.DataFrame, CompiledDataset, or ShardedDataset
         :param bidirectional: should the shared LSTM be bidirectional?
         :type bidirectional: bool
         :param lstm_units: number of hidden units in the LSTM
@@ -49,20 +118,115 @@ class TextPairClassifier(object):
         :type validation_data: pandas.DataFrame or None
         :param model_directory: directory in which to write model checkpoints
         :type model_directory: str or None
-        :return: the trained model and its training history
+        :param embedder: embedder specification or None to use the default embedder
+        :type embedder: str or None
+        :param pruned_vectors: if not None, write a vectors table containing the training vocabulary and this many of
+            the embedder's most frequent words to the model directory and embed with that instead
+        :type pruned_vectors: int or None
+        :param checkpoint_every: keep a copy of the model every this many epochs or None to keep no copies
+        :type checkpoint_every: int or None
+        :param keep_checkpoints: number of model copies to keep or None to keep all of them
+        :type keep_checkpoints: int or None
+        :param resume_every: save the state needed to resume training every this many batches or None to only save it
+            at the end of each epoch
+        :type resume_every: int or None
+        :param rendezvous: connections to the other processes for data-parallel training or None to train in this
+            process alone
+        :type rendezvous: bisemantic.parallel.Rendezvous or None
+        :param memory_budget: bytes of memory that training batches may use, which overrides the batch size, or None
+        :type memory_budget: int or None
+        :param swap_augmentation: also train on every pair with its texts swapped?
+        :type swap_augmentation: bool
+        :param truncation: specification of how to fit texts into the maximum number of tokens or None to keep their
+            first tokens
+        :type truncation: str or None
+        :param sample_fraction: train each epoch on this fraction of the samples, drawn in proportion to their losses,
+            or None to train on all of them
+        :type sample_fraction: float or None
+        :param curriculum_epochs: number of epochs over which to go from the shortest texts to all of them or None for
+            no curriculum
+        :type curriculum_epochs: int or None
+        :param seed: random number seed for sampling
+        :type seed: int or None
+        :return: the trained model and the training history of this run
         :rtype: (TextPairClassifier, TrainingHistory)
         """
-        training = TextPairEmbeddingGenerator(training_data, batch_size=batch_size, maximum_tokens=maximum_tokens)
-        model = cls.create(len(training.classes), training.maximum_tokens, embedding_size(), lstm_units, dropout,
-                           bidirectional)
-        if model_directory is not None:
+        if pruned_vectors is not None:
+            if model_directory is None:
+                raise ValueError("A model directory is required to write pruned vectors")
+            if isinstance(training_data, ShardedDataset):
+                raise ValueError("Pruned vectors cannot be written for sharded data")
+            if getattr(training_data, "tokenized", False):
+                raise ValueError("Pruned vectors cannot be written for compiled data, which only has tokens")
+        embedder = load_embedder(embedder)
+        truncation = Truncation.from_specification(truncation)
+        manifest = {"embedder": embedder.specification, "truncation": truncation.specification}
+        description = embedder.description
+        # In data-parallel training only rank 0 writes to the model directory.
+        writer = rendezvous is None or rendezvous.rank == 0
+        if model_directory is not None and writer:
             os.makedirs(model_directory)
+        if pruned_vectors is not None:
+            directory = cls._pruned_vectors_directory(model_directory)
+            if writer:
+                # Both data frames and indexed data sets select a text column by name.
+                texts = chain(training_data[text_1], training_data[text_2])
+                prune_vectors(embedder, texts, pruned_vectors, directory)
+            if rendezvous is None:
+                embedder = load_embedder("vectors:" + directory)
+            else:
+                embedder = cls._shared_pruned_vectors(rendezvous, directory)
+            # Refer to the pruned vectors relative to the model directory so that it can be moved.
+            manifest["embedder"] = "vectors:" + os.path.relpath(directory, model_directory)
+            description = "%s pruned from %s" % (embedder.description, description)
+        training = TextPairEmbeddingGenerator(training_data, batch_size=batch_size, maximum_tokens=maximum_tokens,
+                                              embedder=embedder, shard=cls._shard(rendezvous),
+                                              swap_augmentation=swap_augmentation, truncation=truncation,
+                                              sample_fraction=sample_fraction, curriculum_epochs=curriculum_epochs,
+                                              seed=seed)
+        manifest["class-names"] = [str(c) for c in training.classes]
+        model = cls.create(len(training.classes), training.maximum_tokens, embedder.embedding_size, lstm_units, dropout,
+                           bidirectional, embedder.specification, truncation.specification)
+        if memory_budget is not None:
+            training.resize(model.batch_size_for_memory(memory_budget, training=True))
+        if model_directory is not None and writer:
             with open(cls._info_filename(model_directory), "w") as f:
-                f.write("%s\n%s\n" % (text_parser_info(), model))
-        return cls._train(epochs, model, model_directory, training, validation_data)
+                f.write("%s\n%s\n" % (description, model))
+            cls._write_manifest(model_directory, manifest)
+        return cls._train(epochs, model, model_directory, training, validation_data, checkpoint_every=checkpoint_every,
+                          keep_checkpoints=keep_checkpoints, resume_every=resume_every, rendezvous=rendezvous)
+
+    @staticmethod
+    def _shared_pruned_vectors(rendezvous, directory):
+        """
+        Load the pruned vectors written by rank 0 on every rank.
+
+        The ranks may not share a file system, so rank 0 sends the table to the others once it has written it, and each
+        of them loads a private copy.
+
+        :param rendezvous: connections to the other ranks
+        :type rendezvous: bisemantic.parallel.Rendezvous
+        :param directory: directory rank 0 wrote the pruned vectors to
+        :type directory: str
+        :return: embedder that looks up the pruned vectors
+        :rtype: bisemantic.embedders.VectorsFileEmbedder
+        """
+        if rendezvous.rank == 0:
+            rendezvous.broadcast((read_vocabulary(directory), np.load(vectors_filename(directory))))
+            return load_embedder("vectors:" + directory)
+        words, vectors = rendezvous.broadcast()
+        local_directory = tempfile.mkdtemp(prefix="pruned-vectors-")
+        save_vectors(local_directory, words, vectors)
+        embedder = load_embedder("vectors:" + local_directory)
+        # The vectors are memory-mapped and the vocabulary read, so the files are no longer needed.
+        shutil.rmtree(local_directory, ignore_errors=True)
+        return embedder
 
     @classmethod
-    def continue_training(cls, training_data, epochs, model_directory, batch_size=2048, validation_data=None):
+    def continue_training(cls, training_data, epochs, model_directory, batch_size=2048, validation_data=None,
+                          checkpoint_every=None, keep_checkpoints=None, resume_every=None, rendezvous=None,
+                          memory_budget=None, swap_augmentation=False, sample_fraction=None, curriculum_epochs=None,
+                          seed=None):
         """
         Continue training a model that was already created by a previous training operation.
 
@@ -76,59 +240,403 @@ class TextPairClassifier(object):
         :type batch_size: int
         :param validation_data: optional validation data
         :type validation_data: pandas.DataFrame or None
-        :return: the trained model and its training history
+        :param checkpoint_every: keep a copy of the model every this many epochs or None to keep no copies
+        :type checkpoint_every: int or None
+        :param keep_checkpoints: number of model copies to keep or None to keep all of them
+        :type keep_checkpoints: int or None
+        :param resume_every: save the state needed to resume training every this many batches or None to only save it
+            at the end of each epoch
+        :type resume_every: int or None
+        :param rendezvous: connections to the other processes for data-parallel training or None to train in this
+            process alone
+        :type rendezvous: bisemantic.parallel.Rendezvous or None
+        :param memory_budget: bytes of memory that training batches may use, which overrides the batch size, or None
+        :type memory_budget: int or None
+        :param swap_augmentation: also train on every pair with its texts swapped?
+        :type swap_augmentation: bool
+        :param sample_fraction: train each epoch on this fraction of the samples, drawn in proportion to their losses,
+            or None to train on all of them
+        :type sample_fraction: float or None
+        :param curriculum_epochs: number of epochs over which to go from the shortest texts to all of them or None for
+            no curriculum
+        :type curriculum_epochs: int or None
+        :param seed: random number seed for sampling
+        :type seed: int or None
+        :return: the trained model and the training history of this run
+        :rtype: (TextPairClassifier, TrainingHistory)
+        """
+        model = cls.load_from_model_directory(model_directory, optimizer_state=True)
+        if memory_budget is not None:
+            batch_size = model.batch_size_for_memory(memory_budget, training=True)
+        training = TextPairEmbeddingGenerator(training_data, maximum_tokens=model.maximum_tokens, batch_size=batch_size,
+                                              embedder=model.embedder, shard=cls._shard(rendezvous),
+                                              swap_augmentation=swap_augmentation, truncation=model.truncation,
+                                              sample_fraction=sample_fraction, curriculum_epochs=curriculum_epochs,
+                                              seed=seed)
+        return cls._train(epochs, model, model_directory, training, validation_data, checkpoint_every=checkpoint_every,
+                          keep_checkpoints=keep_checkpoints, resume_every=resume_every, rendezvous=rendezvous)
+
+    @classmethod
+    def resume_training(cls, training_data, model_directory, validation_data=None, checkpoint_every=None,
+                        keep_checkpoints=None, resume_every=None):
+        """
+        Resume an interrupted training run from the exact batch at which it last saved its state.
+
+        The model and optimizer state are restored from the resume checkpoint, the interrupted epoch is finished, and
+        training continues for the remainder of the originally requested epochs. The resumed training is recorded in
+        the training history as part of the interrupted run. Sampled training data starts from the sample losses saved
+        with the checkpoint, but is not guaranteed to draw the samples the interrupted run would have drawn.
+
+        :param training_data: the text pairs and labels the interrupted run was training on
+        :type training_data: pandas.DataFrame
+        :param model_directory: directory of the interrupted run
+        :type model_directory: str
+        :param validation_data: optional validation data
+        :type validation_data: pandas.DataFrame or None
+        :param checkpoint_every: keep a copy of the model every this many epochs or None to keep no copies
+        :type checkpoint_every: int or None
+        :param keep_checkpoints: number of model copies to keep or None to keep all of them
+        :type keep_checkpoints: int or None
+        :param resume_every: save the state needed to resume training every this many batches or None to only save it
+            at the end of each epoch
+        :type resume_every: int or None
+        :return: the trained model and the training history of this run
+        :rtype: (TextPairClassifier, TrainingHistory)
+        """
+        resume_filename = cls._resume_filename(model_directory)
+        if not os.path.isfile(resume_filename):
+            raise ValueError("There is no interrupted training run to resume in %s" % model_directory)
+        state = read_resume_state(resume_filename)
+        if isinstance(training_data, ShardedDataset) and state.get("shard-seed") is not None:
+            # The order of sharded data is determined by its seed, which must be the one the interrupted run used.
+            training_data.seed = state["shard-seed"]
+        manifest = cls._read_manifest(model_directory)
+        model = cls._load(resume_filename, resolve_specification(manifest.get("embedder"), model_directory),
+                          manifest.get("truncation"))
+        training = TextPairEmbeddingGenerator(training_data, maximum_tokens=model.maximum_tokens,
+                                              batch_size=state["batch-size"], embedder=model.embedder,
+                                              swap_augmentation=state.get("swap-augmentation", False),
+                                              truncation=model.truncation,
+                                              sample_fraction=state.get("sample-fraction"),
+                                              curriculum_epochs=state.get("curriculum-epochs"),
+                                              seed=state.get("seed"))
+        if not len(training) == state["samples"]:
+            raise ValueError("The interrupted run was training on %d samples, not %d" %
+                             (state["samples"], len(training)))
+        if training.sampled:
+            losses = read_resume_sample_losses(resume_filename)
+            if losses is not None:
+                training.record_losses(np.arange(len(training)), losses)
+            training.sampled_epochs = state.get("sampled-epochs", 0)
+            training.trained_samples = state.get("trained-samples", 0)
+            training.scored_samples = state.get("scored-samples", 0)
+        logger.info("Resume run %s at epoch %d, batch %d" % (state["run"], state["epoch"] + 1, state["batch"]))
+        return cls._train(state["epochs"], model, model_directory, training, validation_data,
+                          checkpoint_every=checkpoint_every, keep_checkpoints=keep_checkpoints,
+                          resume_every=resume_every, run=state["run"], initial_epoch=state["epoch"],
+                          initial_batch=state["batch"])
+
+    @classmethod
+    def distill(cls, teacher_directory, data, lstm_units, epochs, dropout=None, bidirectional=False, batch_size=2048,
+                model_directory=None, embedder=None, workers=None, cache=None, checkpoint_every=None,
+                keep_checkpoints=None, memory_budget=None):
+        """
+        Train a small student model to predict the label probabilities of a large teacher model.
+
+        The teacher predicts label probabilities for every text pair in the data once, and the student is trained to
+        match them with cross-entropy. These soft targets say how close each pair is to every class, which is more than
+        a label says, so a student with few units gets closer to the teacher's accuracy than it would trained on the
+        labels. The data need not be labeled, and any labels it has are ignored. The student uses the teacher's maximum
+        number of tokens and truncation and, unless another is specified, its embedder.
+
+        If a cache is specified, the teacher's predictions are taken from it where possible and added to it otherwise,
+        so distilling several students from the same teacher and data only runs the teacher once.
+
+        Training monitors the loss on the soft targets. When it is done, the student is recompiled to train on labels,
+        so it can be used like any other model.
+
+        :param teacher_directory: directory of the teacher model
+        :type teacher_directory: str
+        :param data: text pairs
+        :type data: pandas.DataFrame
+        :param lstm_units: number of hidden units in the student's LSTM
+        :type lstm_units: int
+        :param epochs: number of training epochs
+        :type epochs: int
+        :param dropout:  dropout rate or None for no dropout
+        :type dropout: float or None
+        :param bidirectional: should the student's LSTM be bidirectional?
+        :type bidirectional: bool
+        :param batch_size: number of samples per batch
+        :type batch_size: int
+        :param model_directory: directory in which to write the student or None to not write it
+        :type model_directory: str or None
+        :param embedder: embedder specification for the student or None to use the teacher's embedder
+        :type embedder: str or None
+        :param workers: number of processes used to embed text for the teacher or None to embed in this process
+        :type workers: int or None
+        :param cache: cache of the teacher's predictions or None
+        :type cache: bisemantic.cache.PredictionCache or None
+        :param checkpoint_every: keep a copy of the student every this many epochs or None to keep no copies
+        :type checkpoint_every: int or None
+        :param keep_checkpoints: number of student copies to keep or None to keep all of them
+        :type keep_checkpoints: int or None
+        :param memory_budget: bytes of memory that training batches may use, which overrides the batch size, or None
+        :type memory_budget: int or None
+        :return: the trained student and the training history of this run
         :rtype: (TextPairClassifier, TrainingHistory)
         """
-        model = cls._load(cls._model_filename(model_directory))
-        training = TextPairEmbeddingGenerator(training_data, maximum_tokens=model.maximum_tokens, batch_size=batch_size)
-        return cls._train(epochs, model, model_directory, training, validation_data)
+        teacher = cls.load_from_model_directory(teacher_directory)
+        class_names = cls.class_names_from_model_directory(teacher_directory)
+        logger.info("Predict label probabilities for %d pairs with %s" % (len(data), teacher))
+        targets = teacher.predict(data, batch_size=batch_size, class_names=class_names, workers=workers, cache=cache)
+        if embedder is None:
+            embedder = teacher.embedder
+        else:
+            embedder = load_embedder(embedder)
+        truncation = teacher.truncation
+        training = TextPairEmbeddingGenerator(data, maximum_tokens=teacher.maximum_tokens, batch_size=batch_size,
+                                              embedder=embedder, truncation=truncation, targets=targets)
+        student = cls.create(len(class_names), teacher.maximum_tokens, embedder.embedding_size, lstm_units, dropout,
+                             bidirectional, embedder.specification, truncation.specification)
+        student.model.compile(optimizer="adam", loss="categorical_crossentropy", metrics=["accuracy"])
+        if memory_budget is not None:
+            training.resize(student.batch_size_for_memory(memory_budget, training=True))
+        if model_directory is not None:
+            os.makedirs(model_directory)
+            with open(cls._info_filename(model_directory), "w") as f:
+                f.write("%s\nDistilled from %s\n%s\n" %
+                        (embedder.description, os.path.abspath(teacher_directory), student))
+            cls._write_manifest(model_directory, {"embedder": embedder.specification,
+                                                  "truncation": truncation.specification,
+                                                  "class-names": [str(c) for c in class_names],
+                                                  "teacher": os.path.abspath(teacher_directory)})
+        student, history = cls._train(epochs, student, model_directory, training, None,
+                                      checkpoint_every=checkpoint_every, keep_checkpoints=keep_checkpoints)
+        if model_directory is not None:
+            # Replace the last student with the best one.
+            model_filename = cls._model_filename(model_directory)
+            student = cls._load(model_filename, embedder.specification, truncation.specification)
+        cls._compile(student.model)
+        if model_directory is not None:
+            student.model.save(model_filename)
+        return student, history
+
+    @staticmethod
+    def _shard(rendezvous):
+        if rendezvous is None:
+            return None
+        return rendezvous.rank, rendezvous.world_size
 
     @classmethod
-    def _train(cls, epochs, model, model_directory, training, validation_data):
+    def _train(cls, epochs, model, model_directory, training, validation_data, run=None, rendezvous=None,
+               **fit_options):
+        if rendezvous is not None:
+            # Only rank 0 validates and writes to the model directory.
+            if rendezvous.rank != 0:
+                model_directory = validation_data = None
+            # All ranks record the same run.
+            run = rendezvous.broadcast(run or datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            fit_options["rendezvous"] = rendezvous
         logger.info(repr(model))
+        run = run or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         start = time.time()
-        history = model.fit(training, epochs=epochs, validation_data=validation_data, model_directory=model_directory)
+
+        def fit(batch_size):
+            if not batch_size == training.batch_size:
+                training.resize(batch_size)
+            return model.fit(training, epochs=epochs, validation_data=validation_data, model_directory=model_directory,
+                             run=run, **fit_options)
+
+        if rendezvous is None and not fit_options.get("initial_batch"):
+            snapshot = EpochSnapshot()
+
+            def fit_from_snapshot(batch_size):
+                if snapshot.weights is not None:
+                    # Carry on from the last completed epoch of the same run, so no epoch is trained or recorded twice.
+                    snapshot.restore()
+                    fit_options["initial_epoch"] = snapshot.next_epoch
+                    logger.warning("Continue run %s at epoch %d" % (run, snapshot.next_epoch + 1))
+                return fit(batch_size)
+
+            fit_options["snapshot"] = snapshot
+            history = cls._shrink_batches_on_failure(fit_from_snapshot, training.batch_size)
+            # The history of an attempt that failed is lost, but the snapshot saw every completed epoch.
+            history = snapshot.history
+        else:
+            # Data-parallel processes must keep the same batch size, as must a run resumed from the middle of an epoch.
+            history = fit(training.batch_size).history
         training_time = str(timedelta(seconds=time.time() - start))
-        training_history = cls._training_history(model_directory, training_time, training, history.history)
+        if model_directory is not None:
+            if fit_options.get("initial_epoch") or fit_options.get("initial_batch"):
+                # Include the epochs from before the interruption.
+                history = epoch_history_metrics(read_epoch_history(cls._epoch_history_filename(model_directory), run))
+            resume_filename = cls._resume_filename(model_directory)
+            if os.path.isfile(resume_filename):
+                os.remove(resume_filename)
+        training_history = cls._training_history(model_directory, training_time, training, history, run)
         return model, training_history
 
+    @staticmethod
+    def _shrink_batches_on_failure(operation, batch_size):
+        """
+        Run an operation, halving its batch size and running it again whenever it fails to allocate memory. The
+        operation is responsible for picking up where the failed attempt left off.
+
+        Every batch has the same shape, so an operation that runs out of memory usually does so on its first batch.
+
+        :param operation: function that takes a batch size
+        :type operation: callable
+        :param batch_size: initial batch size
+        :type batch_size: int
+        :return: the return value of the operation
+        :rtype: object
+        """
+        while True:
+            try:
+                return operation(batch_size)
+            except allocation_errors as e:
+                if batch_size == 1:
+                    raise
+                batch_size = max(1, batch_size // 2)
+                logger.warning("Out of memory (%s), reducing the batch size to %d" % (type(e).__name__, batch_size))
+
     @classmethod
-    def _training_history(cls, model_directory, training_time, training, history):
+    def _training_history(cls, model_directory, training_time, training, history, run):
         if model_directory is not None:
             training_history_filename = cls._training_history_filename(model_directory)
-            if os.path.isfile(training_history_filename):
-                training_history = TrainingHistory.load(training_history_filename)
-            else:
-                training_history = TrainingHistory()
-            training_history.add_run(training_time, training, history)
-            training_history.save(training_history_filename)
-        else:
-            training_history = TrainingHistory()
-            training_history.add_run(training_time, training, history)
+            legacy_filename = cls._legacy_training_history_filename(model_directory)
+            if os.path.isfile(legacy_filename) and not os.path.isfile(training_history_filename):
+                # Move the runs of a model directory written by an earlier version to the run log once.
+                TrainingHistory.load(legacy_filename).save(training_history_filename)
+                os.remove(legacy_filename)
+            manifest = cls._read_manifest(model_directory)
+            if "class-names" not in manifest:
+                manifest["class-names"] = [str(c) for c in training.classes]
+                cls._write_manifest(model_directory, manifest)
+        # Only this run is returned, so the earlier runs in the model directory are never read.
+        training_history = TrainingHistory()
+        training_history.add_run(training_time, training, history, run)
+        if model_directory is not None:
+            training_history.append_run(training_history_filename)
         return training_history
 
     @classmethod
-    def _load(cls, filename):
+    def _load(cls, filename, embedder=None, truncation=None):
         """
         :param filename: file name
         :type filename: str
+        :param embedder: specification of the embedder the model was trained with
+        :type embedder: str or None
+        :param truncation: specification of the truncation the model was trained with
+        :type truncation: str or None
         :return: the restored model
         :rtype: TextPairClassifier
         """
-        return cls(load_model(filename))
+        return cls(load_model(filename), embedder, truncation)
+
+    @classmethod
+    def load_from_model_directory(cls, model_directory, optimizer_state=False, write_mapped_weights=False):
+        """
+        Load the model in a model directory.
+
+        Unless the optimizer state is needed, the weights are read from a file alongside the model file that holds the
+        raw arrays, which is quicker than loading the model file. The weights are still copied into the backend's
+        variables, so every page of the file is read and each process has its own copy. If that file is missing or
+        older than the model file, the model file is loaded instead, and the file is only written if requested.
+
+        :param model_directory: directory written by training
+        :type model_directory: str
+        :param optimizer_state: load the optimizer state so that training can continue?
+        :type optimizer_state: bool
+        :param write_mapped_weights: write the weights file if it is missing or out of date?
+        :type write_mapped_weights: bool
+        :return: the model
+        :rtype: TextPairClassifier
+        """
+        manifest = cls._read_manifest(model_directory)
+        embedder = resolve_specification(manifest.get("embedder"), model_directory)
+        truncation = manifest.get("truncation")
+        model_filename = cls._model_filename(model_directory)
+        if optimizer_state:
+            return cls._load(model_filename, embedder, truncation)
+        mapped_filename = cls._mapped_weights_filename(model_directory)
+        if is_current(mapped_filename, model_filename):
+            return cls._load_mapped(mapped_filename, embedder, truncation)
+        model = cls._load(model_filename, embedder, truncation)
+        if write_mapped_weights:
+            temporary = "%s.%d.tmp" % (mapped_filename, os.getpid())
+            try:
+                save_mapped_weights(model.model, temporary)
+                os.replace(temporary, mapped_filename)
+            except OSError as e:
+                # The model directory may be read-only.
+                logger.warning("Could not write %s: %s" % (mapped_filename, e))
+        return model
 
     @classmethod
-    def load_from_model_directory(cls, model_directory):
-        return cls._load(cls._model_filename(model_directory))
+    def _load_mapped(cls, filename, embedder=None, truncation=None):
+        """
+        :param filename: file written by save_mapped_weights
+        :type filename: str
+        :param embedder: specification of the embedder the model was trained with
+        :type embedder: str or None
+        :param truncation: specification of the truncation the model was trained with
+        :type truncation: str or None
+        :return: the restored model, compiled without optimizer state
+        :rtype: TextPairClassifier
+        """
+        architecture, weights = load_mapped_weights(filename)
+        model = model_from_json(architecture)
+        model.set_weights(weights)
+        cls._compile(model)
+        return cls(model, embedder, truncation)
 
     @classmethod
     def class_names_from_model_directory(cls, model_directory):
-        history = TrainingHistory.load(cls._training_history_filename(model_directory))
-        return history.class_names
+        """
+        :param model_directory: directory written by training
+        :type model_directory: str
+        :return: the names of the classes the model predicts
+        :rtype: list of str
+        """
+        manifest = cls._read_manifest(model_directory)
+        if "class-names" in manifest:
+            return manifest["class-names"]
+        # Model directories written by earlier versions only have the class names in their training history.
+        return cls.training_history_from_model_directory(model_directory, last=1).class_names
+
+    @classmethod
+    def embedder_specification_from_model_directory(cls, model_directory):
+        """
+        :param model_directory: directory written by training
+        :type model_directory: str
+        :return: specification of the embedder the model was trained with
+        :rtype: str
+        """
+        manifest = cls._read_manifest(model_directory)
+        return canonical_specification(resolve_specification(manifest.get("embedder"), model_directory))
+
+    @classmethod
+    def training_history_from_model_directory(cls, model_directory, last=None):
+        """
+        :param model_directory: directory written by training
+        :type model_directory: str
+        :param last: only load this many of the most recent runs or None to load all of them
+        :type last: int or None
+        :return: the model's training runs
+        :rtype: TrainingHistory
+        """
+        for filename in [cls._training_history_filename(model_directory),
+                         cls._legacy_training_history_filename(model_directory)]:
+            if os.path.isfile(filename):
+                return TrainingHistory.load(filename, last)
+        return TrainingHistory()
 
     # noinspection PyShadowingNames
     @classmethod
-    def create(cls, classes, maximum_tokens, embedding_size, lstm_units, dropout, bidirectional):
+    def create(cls, classes, maximum_tokens, embedding_size, lstm_units, dropout, bidirectional, embedder=None,
+               truncation=None):
         """
         Create a model that labels semantic relationships between text pairs.
 
@@ -147,6 +655,11 @@ class TextPairClassifier(object):
         :type dropout: float or None
         :param bidirectional: should the shared LSTM be bidirectional?
         :type bidirectional: bool
+        :param embedder: specification of the embedder that produces the input or None for the default embedder
+        :type embedder: str or None
+        :param truncation: specification of how to fit texts into the maximum number of tokens or None to keep their
+            first tokens
+        :type truncation: str or None
         :return: the created model
         :rtype: TextPairClassifier
         """
@@ -162,12 +675,7 @@ class TextPairClassifier(object):
             lstm = LSTM(lstm_units, name="lstm")
         r1 = lstm(input_1)
         r2 = lstm(input_2)
-        # Concatenate the embeddings with their product and squared difference.
-        p = multiply([r1, r2])
-        negative_r2 = Lambda(lambda x: -x)(r2)
-        d = add([r1, negative_r2])
-        q = multiply([d, d])
-        v = [r1, r2, p, q]
+        v = cls._pair_features(r1, r2)
         lstm_output = concatenate(v)
         if dropout is not None:
             lstm_output = Dropout(dropout, name="dropout")(lstm_output)
@@ -177,11 +685,101 @@ class TextPairClassifier(object):
         perceptron = Dense(math.floor(math.sqrt(m)), activation="relu")(lstm_output)
         logistic_regression = Dense(classes, activation="softmax", name="softmax")(perceptron)
         model = Model([input_1, input_2], logistic_regression, "Text pair classifier")
+        cls._compile(model)
+        return cls(model, embedder, truncation)
+
+    @staticmethod
+    def _compile(model):
         model.compile(optimizer="adam", loss="sparse_categorical_crossentropy", metrics=["accuracy"])
-        return cls(model)
 
-    def __init__(self, model):
+    @staticmethod
+    def _pair_features(r1, r2):
+        # Concatenate the embeddings with their product and squared difference.
+        p = multiply([r1, r2])
+        negative_r2 = Lambda(lambda x: -x)(r2)
+        d = add([r1, negative_r2])
+        q = multiply([d, d])
+        return [r1, r2, p, q]
+
+    def __init__(self, model, embedder=None, truncation=None):
         self.model = model
+        self.embedder_specification = canonical_specification(embedder)
+        self.truncation = Truncation.from_specification(truncation)
+        self._fingerprint = None
+
+    @property
+    def model(self):
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+        # The encoder, head, and symmetric models by name. Each adds layers to the backend's graph, so they are only
+        # built once for a model. They share its layers, so they stay up to date when its weights change.
+        self._derived_models = {}
+
+    def _derived_model(self, name, build):
+        if name not in self._derived_models:
+            self._derived_models[name] = build()
+        return self._derived_models[name]
+
+    @property
+    def embedder(self):
+        # Load the embedder lazily because it may be large.
+        return load_embedder(self.embedder_specification)
+
+    @property
+    def fingerprint(self):
+        """
+        A hash of everything that determines the model's predictions: its architecture, its weights, its embedder, and
+        its truncation.
+
+        It is computed the first time it is used and again after the model is trained with fit.
+
+        :rtype: str
+        """
+        if self._fingerprint is None:
+            h = hashlib.sha1()
+            h.update(self.model.to_json().encode("utf-8"))
+            h.update(json.dumps({"embedder": self.embedder_specification,
+                                 "truncation": self.truncation.specification}, sort_keys=True).encode("utf-8"))
+            for weights in self.model.get_weights():
+                h.update(np.ascontiguousarray(weights).tobytes())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def batch_size_for_memory(self, memory_budget, training=False, workers=None):
+        """
+        The largest batch size whose data fits in a memory budget.
+
+        A batch is a pair of matrices of size (batch size, maximum tokens, embedding size) of 32-bit floats. Each batch
+        is held both by the generator and by the backend, and up to twice as many batches as there are workers may be
+        embedded ahead of the model. Training also keeps the gate activations, cell state, and output of the LSTM at
+        every token, and their gradients, for back-propagation. The weights, and when training their gradients and the
+        optimizer's moment estimates, take a fixed amount of memory.
+
+        :param memory_budget: bytes of memory available
+        :type memory_budget: int
+        :param training: is the batch size for training?
+        :type training: bool
+        :param workers: number of processes used to embed text or None to embed in this process
+        :type workers: int or None
+        :return: batch size
+        :rtype: int
+        """
+        float_size = 4
+        directions = 2 if self.bidirectional else 1
+        batches = 2 + 2 * (workers or 0)
+        sample = batches * 2 * self.maximum_tokens * self.embedding_size * float_size
+        fixed = self.model.count_params() * float_size
+        if training:
+            sample += 2 * 2 * self.maximum_tokens * 6 * self.lstm_units * directions * float_size
+            fixed *= 4
+        batch_size = int((memory_budget - fixed) // sample)
+        if batch_size < 1:
+            raise ValueError("A memory budget of %d bytes is too small for %s" % (memory_budget, self))
+        logger.info("Batch size %d fits in a memory budget of %d bytes" % (batch_size, memory_budget))
+        return batch_size
 
     @property
     def maximum_tokens(self):
@@ -235,10 +833,21 @@ class TextPairClassifier(object):
         sys.stdout = old_stdout
         return s.getvalue()
 
-    def fit(self, training, epochs=1, validation_data=None, model_directory=None):
+    def fit(self, training, epochs=1, validation_data=None, model_directory=None, checkpoint_every=None,
+            keep_checkpoints=None, resume_every=None, run=None, initial_epoch=0, initial_batch=0, rendezvous=None,
+            snapshot=None):
         """
         Fit the model to the training data
 
+        If a model directory is specified, the model is written to it in the background whenever the monitored loss
+        improves, and the metrics for each epoch are appended to a log in it as the epoch finishes. The model, optimizer
+        state, and position in the data are also saved at the end of every epoch and optionally every few batches so
+        that training can be resumed if it is interrupted.
+
+        If connections to other processes are specified, training is data-parallel. Each process trains on its own shard
+        of the data, and the processes average their gradients after every batch. Only rank 0 should be given validation
+        data and a model directory. Data-parallel training cannot save resume checkpoints.
+
         :param training: training data generator
         :type training: TextPairEmbeddingGenerator
         :param epochs: number of epochs to train
@@ -247,68 +856,411 @@ class TextPairClassifier(object):
         :type validation_data: pandas.DataFrame or None
         :param model_directory: directory in which to serialize the model
         :type model_directory: str or None
+        :param checkpoint_every: keep a copy of the model every this many epochs or None to keep no copies
+        :type checkpoint_every: int or None
+        :param keep_checkpoints: number of model copies to keep or None to keep all of them
+        :type keep_checkpoints: int or None
+        :param resume_every: save the state needed to resume training every this many batches or None to only save it
+            at the end of each epoch
+        :type resume_every: int or None
+        :param run: identifier of the training run or None to use the current time
+        :type run: str or None
+        :param initial_epoch: epoch at which to start training
+        :type initial_epoch: int
+        :param initial_batch: batch within the initial epoch at which to start training
+        :type initial_batch: int
+        :param rendezvous: connections to the other processes for data-parallel training or None to train in this
+            process alone
+        :type rendezvous: bisemantic.parallel.Rendezvous or None
+        :param snapshot: callback that keeps the state of the model at the end of the last completed epoch or None
+        :type snapshot: bisemantic.callbacks.EpochSnapshot or None
         :return: training history
         :rtype: keras.callbacks.History
         """
         logger.info("Train model: %d samples, %d epochs, batch size %d" % (len(training), epochs, training.batch_size))
+        # Training changes the weights.
+        self._fingerprint = None
         if validation_data is not None:
             g = TextPairEmbeddingGenerator(validation_data, maximum_tokens=self.maximum_tokens,
-                                           batch_size=training.batch_size)
+                                           batch_size=training.batch_size, embedder=self.embedder,
+                                           truncation=self.truncation)
             validation_embeddings, validation_steps = g(), g.batches_per_epoch
         else:
             validation_embeddings = validation_steps = None
         verbose = {logging.INFO: 2, logging.DEBUG: 1}.get(logger.getEffectiveLevel(), 0)
+        run = run or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        model_checkpoint = resume_checkpoint = None
+        throughput = ThroughputLog()
         if model_directory is not None:
             if validation_data is not None:
                 monitor = "val_loss"
             else:
                 monitor = "loss"
-            callbacks = [
-                ModelCheckpoint(filepath=self._model_filename(model_directory), monitor=monitor, save_best_only=True,
-                                verbose=verbose)]
+            epoch_history_filename = self._epoch_history_filename(model_directory)
+            model_checkpoint = AsyncModelCheckpoint(filepath=self._model_filename(model_directory), monitor=monitor,
+                                                    verbose=verbose, every_epochs=checkpoint_every,
+                                                    keep=keep_checkpoints,
+                                                    epoch_filepath=self._epoch_model_filename_template(model_directory),
+                                                    mapped_filepath=self._mapped_weights_filename(model_directory))
+            # A resumed run only replaces the saved model when it improves on the epochs before the interruption.
+            model_checkpoint.best = min((epoch[monitor] for epoch in read_epoch_history(epoch_history_filename, run)
+                                         if monitor in epoch), default=model_checkpoint.best)
+            # The order of sharded data depends on its seed as well as the epoch.
+            shard_seed = training.data.seed if isinstance(training.data, ShardedDataset) else None
+            resume_checkpoint = ResumeCheckpoint(self._resume_filename(model_directory),
+                                                 {"run": run, "epochs": epochs, "batch-size": training.batch_size,
+                                                  "samples": len(training),
+                                                  "swap-augmentation": training.swap_augmentation,
+                                                  "sample-fraction": training.sample_fraction,
+                                                  "curriculum-epochs": training.curriculum_epochs,
+                                                  "seed": training.seed, "shard-seed": shard_seed},
+                                                 every_batches=resume_every, generator=training)
+            callbacks = [throughput, model_checkpoint, EpochHistoryLog(epoch_history_filename, run)]
+            if rendezvous is None:
+                callbacks.append(resume_checkpoint)
         else:
-            callbacks = None
+            callbacks = [throughput]
+        if training.sampled:
+            callbacks.append(HardExampleMining(training))
+        if snapshot is not None:
+            # After HardExampleMining, so that it sees the metrics every other callback adds.
+            callbacks.append(snapshot)
+        # Time spent in the other callbacks is not time spent waiting for data.
+        callbacks.append(throughput.fetch_start)
         logger.info("Start training")
-        return self.model.fit_generator(generator=training(), steps_per_epoch=training.batches_per_epoch, epochs=epochs,
-                                        validation_data=validation_embeddings, validation_steps=validation_steps,
-                                        callbacks=callbacks, verbose=verbose)
+        checkpoints = [c for c in [model_checkpoint, resume_checkpoint] if c is not None]
+        try:
+            if rendezvous is not None:
+                trainer = DataParallelTrainer(self.model, rendezvous)
+                return trainer.fit(training(initial_epoch=initial_epoch), training.batches_per_epoch, epochs,
+                                   initial_epoch=initial_epoch, validation_data=validation_embeddings,
+                                   validation_steps=validation_steps, callbacks=callbacks)
+            history = None
+            if initial_batch and resume_checkpoint is not None:
+                # Finish the interrupted epoch before starting the remaining ones.
+                resume_checkpoint.batch_offset = initial_batch
+                history = self.model.fit_generator(generator=training(initial_batch, initial_epoch),
+                                                   steps_per_epoch=training.batches_per_epoch - initial_batch,
+                                                   epochs=initial_epoch + 1, initial_epoch=initial_epoch,
+                                                   validation_data=validation_embeddings,
+                                                   validation_steps=validation_steps, callbacks=callbacks,
+                                                   verbose=verbose)
+                initial_epoch += 1
+            if initial_epoch < epochs:
+                remaining = self.model.fit_generator(generator=training(initial_epoch=initial_epoch),
+                                                     steps_per_epoch=training.batches_per_epoch,
+                                                     epochs=epochs, initial_epoch=initial_epoch,
+                                                     validation_data=validation_embeddings,
+                                                     validation_steps=validation_steps, callbacks=callbacks,
+                                                     verbose=verbose)
+                if history is None:
+                    history = remaining
+                else:
+                    for metric, values in remaining.history.items():
+                        history.history.setdefault(metric, []).extend(values)
+            return history
+        except BaseException:
+            # Keras does not end training when fit fails, so the writers have to be stopped here before training is
+            # tried again. The error that stopped training is the one to report.
+            for checkpoint in checkpoints:
+                try:
+                    checkpoint.close()
+                except Exception as e:
+                    logger.error("Failed to write checkpoint: %s" % e)
+            raise
 
-    def predict(self, test_data, batch_size=2048, class_names=None):
+    def predict(self, test_data, batch_size=2048, class_names=None, workers=None, output="probabilities", k=1,
+                threshold=None, cache=None, symmetric=False):
         """
         Predict probability distribution over labels for a test set.
 
+        If workers are specified, text embedding is spread across that many processes. The model itself stays in this
+        process, so its weights are only loaded once. If a batch does not fit in memory, the batch size is halved until
+        it does.
+
+        By default the full distribution over labels is returned. The "label" output returns just the most probable
+        label and the "top" output returns the k most probable labels and their probabilities. A threshold restricts the
+        output to the samples for which a label has greater than a given probability. All of these are computed on the
+        matrix of probabilities before a data frame is built. The data frame is indexed by the sample's position in the
+        test set.
+
+        If a cache is specified, only the text pairs that are not in it are embedded and run through the model.
+
+        If symmetric is set, the prediction for each pair is the average of the predictions for the pair in both orders.
+        Each text is still only embedded and encoded once, because only the head of the model is applied twice.
+
         :param test_data: unlabeled text pair data
         :type test_data: pandas.DataFrame
         :param batch_size: number of test samples per batch
         :type batch_size: int
         :param class_names: optional column names to use for the classes
         :type class_names: list or None
+        :param workers: number of processes used to embed text or None to embed in this process
+        :type workers: int or None
+        :param output: "probabilities", "label", or "top"
+        :type output: str
+        :param k: number of labels to return for "top" output
+        :type k: int
+        :param threshold: a label, identified by class name or by column number if there are no class names, and the
+            probability it must exceed for a sample to be returned, or None to return all samples
+        :type threshold: (object, float) or None
+        :param cache: cache from which to take the predictions for text pairs this model has already seen or None
+        :type cache: bisemantic.cache.PredictionCache or None
+        :param symmetric: average the predictions for each pair in both orders?
+        :type symmetric: bool
         :return: data frame of test samples and label probabilities
         :rtype: pandas.DataFrame
         """
-        g = TextPairEmbeddingGenerator(test_data, maximum_tokens=self.maximum_tokens, batch_size=batch_size)
-        probabilities = self.model.predict_generator(generator=g(), steps=g.batches_per_epoch)
-        return pd.DataFrame(probabilities.reshape((len(test_data), self.classes)), columns=class_names)
+        probabilities = self._probabilities(test_data, batch_size, workers, cache, symmetric)
+        return self._prediction_frame(probabilities, class_names, output, k, threshold)
+
+    def _probabilities(self, data, batch_size, workers, cache=None, symmetric=False):
+        """
+        :return: matrix of size (number of samples, classes) of label probabilities
+        :rtype: numpy.array
+        """
+        if cache is None:
+            return self._predict_probabilities(data, batch_size, workers, symmetric)
+        if isinstance(data, CompiledDataset) and data.tokenized:
+            raise ValueError("Predictions for compiled data sets cannot be cached")
+        fingerprint = self.fingerprint
+        if symmetric:
+            fingerprint += ":symmetric"
+        keys = cache.pair_keys(data[text_1], data[text_2])
+        probabilities, found = cache.get(fingerprint, keys, self.classes)
+        missing = np.flatnonzero(~found)
+        if len(missing):
+            if isinstance(data, CompiledDataset):
+                # Indexing a data set with a list selects rows rather than columns.
+                missing_data = data.iloc[missing]
+            else:
+                missing_data = data[[text_1, text_2]].iloc[missing]
+            computed = self._predict_probabilities(missing_data, batch_size, workers, symmetric)
+            cache.put(fingerprint, [keys[i] for i in missing], computed)
+            probabilities[missing] = computed
+        return probabilities
+
+    def _predict_probabilities(self, data, batch_size, workers, symmetric=False):
+        model = self.symmetric_model() if symmetric else self.model
+
+        def predict(batch_size):
+            g = TextPairEmbeddingGenerator(data, maximum_tokens=self.maximum_tokens, batch_size=batch_size,
+                                           workers=workers, embedder=self.embedder, truncation=self.truncation)
+            return model.predict_generator(generator=g(), steps=g.batches_per_epoch)
+
+        probabilities = self._shrink_batches_on_failure(predict, batch_size)
+        return probabilities.reshape((len(data), self.classes))
+
+    @staticmethod
+    def _prediction_frame(probabilities, class_names, output, k, threshold):
+        if class_names is None:
+            class_names = list(range(probabilities.shape[1]))
+        rows = np.arange(len(probabilities))
+        if threshold is not None:
+            name, probability = threshold
+            if name not in class_names:
+                raise ValueError("Invalid threshold label %s. It must be one of %s" % (name, class_names))
+            rows = np.flatnonzero(probabilities[:, class_names.index(name)] > probability)
+            probabilities = probabilities[rows]
+        if output == "probabilities":
+            return pd.DataFrame(probabilities, index=rows, columns=class_names)
+        names = np.asarray(class_names)
+        if output == "label":
+            return pd.DataFrame({label: names[probabilities.argmax(axis=1)]}, index=rows)
+        if output == "top":
+            k = min(k, len(class_names))
+            top = np.argsort(-probabilities, axis=1)[:, :k]
+            columns = {}
+            for i in range(k):
+                columns["label_%d" % (i + 1)] = names[top[:, i]]
+                columns["probability_%d" % (i + 1)] = probabilities[np.arange(len(top)), top[:, i]]
+            order = ["%s_%d" % (column, i + 1) for i in range(k) for column in ["label", "probability"]]
+            return pd.DataFrame(columns, index=rows, columns=order)
+        raise ValueError("Invalid output %s. It must be one of probabilities, label, or top" % output)
+
+    def encoder_model(self):
+        """
+        The shared LSTM on its own.
+
+        :return: model that maps an embedded text to its encoding
+        :rtype: keras.engine.Model
+        """
+        return self._derived_model("encoder", self._encoder_model)
+
+    def _encoder_model(self):
+        return Model(self.model.inputs[0], self.model.get_layer("lstm").get_output_at(0), "Text encoder")
+
+    def head_model(self):
+        """
+        The part of the model that follows the shared LSTM, sharing its weights.
+
+        Dropout is omitted because it has no effect at prediction time. Applying this to the encodings of two texts
+        gives the same probabilities as applying the whole model to the texts.
+
+        :return: model that maps a pair of encodings to a probability distribution over labels
+        :rtype: keras.engine.Model
+        """
+        return self._derived_model("head", self._head_model)
+
+    def _head_model(self):
+        encoding_size = self.model.get_layer("lstm").get_output_shape_at(0)[1]
+        r1 = Input((encoding_size,))
+        r2 = Input((encoding_size,))
+        dense = [layer for layer in self.model.layers if isinstance(layer, Dense)]
+        output = concatenate(self._pair_features(r1, r2))
+        for layer in dense:
+            output = layer(output)
+        return Model([r1, r2], output, "Text pair head")
+
+    def symmetric_model(self):
+        """
+        The model with its head applied to the encodings of a pair in both orders, sharing its weights.
 
-    def score(self, labeled_test_data, batch_size=2048):
+        :return: model that maps a pair of embedded texts to the mean of the label probabilities for both orders
+        :rtype: keras.engine.Model
+        """
+        return self._derived_model("symmetric", self._symmetric_model)
+
+    def _symmetric_model(self):
+        lstm = self.model.get_layer("lstm")
+        r1 = lstm.get_output_at(0)
+        r2 = lstm.get_output_at(1)
+        head = self.head_model()
+        return Model(self.model.inputs, average([head([r1, r2]), head([r2, r1])]), "Symmetric text pair classifier")
+
+    def encode(self, texts, batch_size=2048, workers=None):
+        """
+        Encode texts with the shared LSTM.
+
+        :param texts: texts to encode
+        :type texts: pandas.Series
+        :param batch_size: number of texts per batch
+        :type batch_size: int
+        :param workers: number of processes used to embed text or None to embed in this process
+        :type workers: int or None
+        :return: matrix of size (number of texts, encoding size)
+        :rtype: numpy.array
+        """
+        # Pair every text with an empty one, which costs almost nothing to embed, and only encode the first element.
+        data = pd.DataFrame({text_1: list(texts), text_2: [""] * len(texts)})
+        g = TextPairEmbeddingGenerator(data, maximum_tokens=self.maximum_tokens, batch_size=batch_size,
+                                       workers=workers, embedder=self.embedder, truncation=self.truncation)
+        batches = (embeddings[0] for embeddings in g())
+        return self.encoder_model().predict_generator(generator=batches, steps=g.batches_per_epoch)
+
+    def score(self, labeled_test_data, batch_size=2048, workers=None, cache=None):
         """
         Score the model's performance on a labeled test set.
 
+        If a batch does not fit in memory, the batch size is halved until it does. If a cache is specified, the metrics
+        are computed from cached predictions where possible.
+
         :param labeled_test_data: labeled test data
         :type labeled_test_data: pandas.DataFrame
         :param batch_size: number of test samples per batch
         :type batch_size: int
+        :param workers: number of processes used to embed text or None to embed in this process
+        :type workers: int or None
+        :param cache: cache of predictions for text pairs this model has already seen or None
+        :type cache: bisemantic.cache.PredictionCache or None
         :return: list of metric names and their corresponding values for the test set
         :rtype: list of (str, float)
         """
         assert label in labeled_test_data
-        g = TextPairEmbeddingGenerator(labeled_test_data, maximum_tokens=self.maximum_tokens, batch_size=batch_size)
+        g = TextPairEmbeddingGenerator(labeled_test_data, maximum_tokens=self.maximum_tokens, batch_size=batch_size,
+                                       workers=workers, embedder=self.embedder, truncation=self.truncation)
         if not self.classes == len(g.classes):
             raise ValueError(
                 "Test data categories %s do not align with the %d labels in the model" % (g.classes, self.classes))
-        metrics = self.model.evaluate_generator(generator=g(), steps=g.batches_per_epoch)
+        if cache is None:
+            def evaluate(batch_size):
+                if not batch_size == g.batch_size:
+                    g.resize(batch_size)
+                return self.model.evaluate_generator(generator=g(), steps=g.batches_per_epoch)
+
+            metrics = self._shrink_batches_on_failure(evaluate, batch_size)
+        else:
+            probabilities = self._probabilities(labeled_test_data, batch_size, workers, cache)
+            codes = labeled_test_data[label].cat.codes.values
+            # These are the loss and accuracy the model was compiled with.
+            p = np.clip(probabilities[np.arange(len(codes)), codes], K.epsilon(), 1 - K.epsilon())
+            values = {"loss": float(np.mean(-np.log(p))), "acc": float(np.mean(probabilities.argmax(axis=1) == codes))}
+            metrics = [values[name] for name in self.model.metrics_names]
         return list(zip(self.model.metrics_names, metrics))
 
+    def score_chunks(self, chunks, class_names, batch_size=2048, workers=None, cache=None):
+        """
+        Score the model's performance on labeled test data that arrives in chunks.
+
+        Only one chunk is in memory at a time, and the metrics are accumulated with constant memory. Labels are mapped
+        to the model's class names instead of being taken from the categories in the data, so a chunk need not contain
+        every class. Samples whose labels are not one of the model's classes are skipped.
+
+        :param chunks: labeled test data
+        :type chunks: iterator over pandas.DataFrame or CompiledDataset
+        :param class_names: the model's class names
+        :type class_names: list
+        :param batch_size: number of test samples per batch
+        :type batch_size: int
+        :param workers: number of processes used to embed text or None to embed in this process
+        :type workers: int or None
+        :param cache: cache of predictions for text pairs this model has already seen or None
+        :type cache: bisemantic.cache.PredictionCache or None
+        :return: metrics for all the chunks
+        :rtype: StreamingMetrics
+        """
+        if not len(class_names) == self.classes:
+            raise ValueError("There are %d class names but %d labels in the model" % (len(class_names), self.classes))
+        metrics = StreamingMetrics(class_names)
+        for chunk in chunks:
+            assert label in chunk
+            if isinstance(chunk, CompiledDataset):
+                codes = metrics.label_codes(chunk.labels)
+            else:
+                codes = metrics.label_codes(chunk[label])
+                chunk = chunk[[text_1, text_2]]
+            known = codes >= 0
+            if not known.all():
+                logger.warning("Skipping %d samples with labels that are not in %s" % ((~known).sum(), class_names))
+                chunk = chunk[known]
+                codes = codes[known]
+            if len(codes):
+                metrics.update(self._probabilities(chunk, batch_size, workers, cache), codes, K.epsilon())
+                logger.info(metrics)
+        return metrics
+
+    @classmethod
+    def _read_manifest(cls, model_directory):
+        """
+        The manifest holds the settings needed to use a model along with it.
+
+        Model directories written before there was a manifest have an empty one.
+
+        :param model_directory: model directory
+        :type model_directory: str
+        :return: model settings
+        :rtype: dict
+        """
+        filename = cls._manifest_filename(model_directory)
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                return json.load(f)
+        else:
+            return {}
+
+    @classmethod
+    def _write_manifest(cls, model_directory, manifest):
+        with open(cls._manifest_filename(model_directory), "w") as f:
+            json.dump(manifest, f, sort_keys=True, indent=4, separators=(",", ": "))
+
+    @staticmethod
+    def _manifest_filename(model_directory):
+        return os.path.join(model_directory, "manifest.json")
+
+    @staticmethod
+    def _pruned_vectors_directory(model_directory):
+        return os.path.join(model_directory, "vectors")
+
     @staticmethod
     def _info_filename(model_directory):
         return os.path.join(model_directory, "model.info.txt")
@@ -317,21 +1269,119 @@ class TextPairClassifier(object):
     def _model_filename(model_directory):
         return os.path.join(model_directory, "model.h5")
 
+    @staticmethod
+    def _mapped_weights_filename(model_directory):
+        return os.path.join(model_directory, "model.weights")
+
+    @staticmethod
+    def _epoch_model_filename_template(model_directory):
+        return os.path.join(model_directory, "model.epoch-{epoch:03d}.h5")
+
     @staticmethod
     def _training_history_filename(model_directory):
+        return os.path.join(model_directory, "training-history.jsonl")
+
+    @staticmethod
+    def _legacy_training_history_filename(model_directory):
         return os.path.join(model_directory, "training-history.json")
 
+    @staticmethod
+    def _epoch_history_filename(model_directory):
+        return os.path.join(model_directory, "epoch-history.jsonl")
+
+    @staticmethod
+    def _resume_filename(model_directory):
+        return os.path.join(model_directory, "resume.h5")
+
+
+def _duration_seconds(duration):
+    """
+    :param duration: duration formatted by datetime.timedelta, such as 1 day, 2:03:04.5
+    :type duration: str
+    :return: number of seconds
+    :rtype: float
+    """
+    days = 0
+    if "day" in duration:
+        d, duration = duration.split(", ")
+        days = int(d.split()[0])
+    hours, minutes, seconds = duration.split(":")
+    return days * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def compare_models(models, data, class_names, batch_size=2048, workers=None):
+    """
+    Compare the accuracy and speed of models on the same text pairs.
+
+    Each model predicts label probabilities for all the pairs, and the time this takes, including embedding, gives its
+    throughput. Agreement is the fraction of pairs for which a model predicts the same most probable label as the first
+    model. If the data is labeled, accuracy is the fraction of pairs for which the most probable label is the right one.
+
+    :param models: names and models, the first of which the others are compared with
+    :type models: list of (str, TextPairClassifier)
+    :param data: text pairs with optional labels
+    :type data: pandas.DataFrame
+    :param class_names: the class names of the models
+    :type class_names: list
+    :param batch_size: number of samples per batch
+    :type batch_size: int
+    :param workers: number of processes used to embed text or None to embed in this process
+    :type workers: int or None
+    :return: number of parameters, pairs per second, agreement, and accuracy if the data is labeled for each model
+    :rtype: pandas.DataFrame
+    """
+    columns = ["parameters", "pairs/second", "agreement"]
+    codes = None
+    if label in data:
+        columns.append("accuracy")
+        codes = pd.Categorical(data[label].astype(str), categories=[str(c) for c in class_names]).codes
+    rows = []
+    reference = None
+    for name, model in models:
+        start = time.time()
+        predicted = model.predict(data, batch_size=batch_size, workers=workers).values.argmax(axis=1)
+        seconds = time.time() - start
+        if reference is None:
+            reference = predicted
+        row = {"model": name, "parameters": model.model.count_params(), "pairs/second": len(data) / max(seconds, 1e-9),
+               "agreement": np.mean(predicted == reference)}
+        if codes is not None:
+            row["accuracy"] = np.mean(predicted == codes)
+        rows.append(row)
+    return pd.DataFrame(rows, columns=["model"] + columns).set_index("model")
+
 
 class TrainingHistory(object):
     """
     Record of all the training runs made on a given model. This records the training date, the size of the sample, and
     the training and validation scores.
+
+    The runs are stored one per line in a JSON lines file, so a run is recorded by appending it to the file without
+    reading or rewriting the earlier runs. Earlier versions stored a single JSON list, which can still be loaded.
     """
 
     @classmethod
-    def load(cls, filename):
+    def load(cls, filename, last=None):
+        """
+        :param filename: JSON lines file written by save or append_run, or a JSON list of runs
+        :type filename: str
+        :param last: only load this many of the most recent runs or None to load all of them
+        :type last: int or None
+        :return: the runs in the file
+        :rtype: TrainingHistory
+        """
         with open(filename) as f:
-            return cls(json.load(f))
+            if f.read(1) == "[":
+                f.seek(0)
+                runs = json.load(f)
+                if last is not None:
+                    runs = runs[len(runs) - last:]
+            else:
+                f.seek(0)
+                # Only parse the runs that are kept.
+                lines = deque((line for line in f if line.strip()), maxlen=last)
+                runs = [json.loads(line) for line in lines]
+        return cls(runs)
 
     def __init__(self, runs=None):
         self.runs = runs or []
@@ -339,16 +1389,38 @@ class TrainingHistory(object):
     def __repr__(self):
         return "Training history, %d runs" % (len(self.runs))
 
-    def add_run(self, training_time, training, history):
+    def add_run(self, training_time, training, history, run=None):
         self.runs.append({"training-time": training_time,
                           "training": str(training),
+                          "samples": len(training),
                           "class-names": [str(c) for c in training.classes],
                           "history": history,
-                          "run-date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+                          "run": run,
+                          "run-date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                          "backend": dict(backend_settings)})
+        if getattr(training, "sampled", False):
+            self.runs[-1]["sampling"] = {"samples": len(training), "epochs": training.sampled_epochs,
+                                         "trained-samples": training.trained_samples,
+                                         "scored-samples": training.scored_samples}
 
     def save(self, filename):
-        with open(filename, "w") as f:
-            json.dump(self.runs, f, sort_keys=True, indent=4, separators=(",", ": "))
+        temporary = filename + ".tmp"
+        with open(temporary, "w") as f:
+            for run in self.runs:
+                f.write(json.dumps(run, sort_keys=True) + "\n")
+        os.replace(temporary, filename)
+
+    def append_run(self, filename):
+        """
+        Append the most recent run to a file written by save or append_run.
+
+        :param filename: JSON lines file, created if it does not exist
+        :type filename: str
+        """
+        with open(filename, "a") as f:
+            f.write(json.dumps(self.runs[-1], sort_keys=True) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
 
     @property
     def class_names(self):
@@ -357,6 +1429,47 @@ class TrainingHistory(object):
         else:
             return None
 
+    def summary(self):
+        """
+        :return: a row for each run with its date, number of samples and epochs, seconds per epoch, samples trained on
+            per second, fraction of the time spent waiting for data and peak memory use of the training process since
+            it started if they were measured, and the metrics of its best epoch
+        :rtype: pandas.DataFrame
+        """
+        rows = []
+        for run in self.runs:
+            history = run["history"]
+            metric = "val_loss" if "val_loss" in history else "loss"
+            epochs = len(history.get(metric, []))
+            seconds = _duration_seconds(run["training-time"])
+            samples = run.get("samples")
+            if samples is None:
+                # Runs recorded by earlier versions only describe the number of samples.
+                samples = int(re.search(r"(\d+) samples", run["training"]).group(1))
+            if "sampling" in run:
+                trained = run["sampling"]["trained-samples"]
+            else:
+                trained = samples * epochs
+            row = {"run": run.get("run") or run["run-date"], "date": run["run-date"], "samples": samples,
+                   "epochs": epochs, "seconds/epoch": seconds / epochs if epochs else np.nan,
+                   "samples/second": trained / seconds if seconds else np.nan}
+            if "samples_per_second" in history:
+                # Measured without validation and the other work done between epochs.
+                row["seconds/epoch"] = np.mean(history["epoch_seconds"])
+                row["samples/second"] = np.mean(history["samples_per_second"])
+                row["waiting"] = sum(history["wait_seconds"]) / max(sum(history["epoch_seconds"]), 1e-9)
+            if "peak_memory" in history:
+                row["peak memory"] = max(history["peak_memory"])
+            if epochs:
+                i = int(np.argmin(history[metric]))
+                row.update((name, history[name][i]) for name in ["loss", "acc", "val_loss", "val_acc"]
+                           if name in history)
+            rows.append(row)
+        columns = ["run", "date", "samples", "epochs", "seconds/epoch", "samples/second", "waiting", "peak memory",
+                   "loss", "acc", "val_loss", "val_acc"]
+        columns = [column for column in columns if any(column in row for row in rows)]
+        return pd.DataFrame(rows, columns=columns)
+
     def latest_run_summary(self):
         lines = []
         if self.runs:
@@ -372,4 +1485,20 @@ class TrainingHistory(object):
             lines.append("Training: accuracy=%0.4f, loss=%0.4f" % (history["acc"][i], history["loss"][i]))
             if "val_loss" in history:
                 lines.append("Validation: accuracy=%0.4f, loss=%0.4f" % (history["val_acc"][i], history["val_loss"][i]))
+            if "samples_per_second" in history:
+                seconds = sum(history["epoch_seconds"])
+                waiting = 100 * sum(history["wait_seconds"]) / seconds if seconds else 0
+                lines.append("Throughput: %0.1f samples/second, %0.1f seconds/epoch, %0.1f%% of the time waiting for "
+                             "data" % (np.mean(history["samples_per_second"]), np.mean(history["epoch_seconds"]),
+                                       waiting))
+            if "peak_memory" in history:
+                lines.append("Peak memory: %0.1f MB" % (max(history["peak_memory"]) / 2 ** 20))
+            settings = last_run.get("backend", {})
+            if any(value is not None for value in settings.values()):
+                lines.append("Backend: " + ", ".join("%s=%s" % (name, settings[name]) for name in sorted(settings)))
+            if "sampling" in last_run:
+                sampling = last_run["sampling"]
+                full = sampling["samples"] * sampling["epochs"]
+                lines.append("Sampling: trained on %d and scored %d samples instead of %d in %d full epochs" %
+                             (sampling["trained-samples"], sampling["scored-samples"], full, sampling["epochs"]))
         return "\n".join(lines)
@@ -3,12 +3,14 @@ Command line interface
 """
 
 import argparse
+import contextlib
 import os
+import random
 import textwrap
 
 import bisemantic
 from bisemantic import configure_logger, logger
-from bisemantic.data import data_file
+from bisemantic.data import data_file, text_file
 
 
 def main():
@@ -44,11 +46,72 @@ def create_argument_parser():
     embedding_arguments.add_argument("--batch-size", metavar="SIZE", type=int, default=2048,
                                      help="number samples per batch (default 2048)")
 
+    memory_arguments = argparse.ArgumentParser(add_help=False)
+    memory_arguments.add_argument("--memory-budget", metavar="BYTES", type=memory_size,
+                                  help="memory available for batches, with an optional K, M, G, or T suffix, from " +
+                                       "which the largest batch size that fits is derived instead of using " +
+                                       "--batch-size (default use --batch-size)")
+
+    backend_arguments = argparse.ArgumentParser(add_help=False)
+    backend_group = backend_arguments.add_argument_group("backend options")
+    backend_group.add_argument("--intra-op-threads", metavar="THREADS", type=int,
+                               help="number of threads used within a backend operation (default decided by the " +
+                                    "backend)")
+    backend_group.add_argument("--inter-op-threads", metavar="THREADS", type=int,
+                               help="number of backend operations run at the same time (default decided by the " +
+                                    "backend)")
+
     training_arguments = argparse.ArgumentParser(add_help=False)
-    training_arguments.add_argument("training", metavar="TRAINING", help="training data file")
+    training_arguments.add_argument("training", metavar="TRAINING",
+                                    help="training data file, or a directory or glob pattern of data file shards")
     training_group = training_arguments.add_argument_group("training options")
     training_group.add_argument("--epochs", type=int, default=10, help="training epochs (default 10)")
     training_group.add_argument("--n", type=int, help="number of training samples to use (default all)")
+    training_group.add_argument("--seed", type=int,
+                                help="random number seed for partitioning, shuffling, sampling, and weight " +
+                                     "initialization, so that runs are repeatable (default random)")
+    training_group.add_argument("--deduplicate", choices=["exact", "symmetric"],
+                                help="collapse identical training pairs, or pairs that are identical in either " +
+                                     "order, into single samples weighted by their number (default keep duplicates)")
+    training_group.add_argument("--near-duplicates", metavar="JACCARD", type=float,
+                                help="also collapse training pairs with the same label whose token sets have at " +
+                                     "least this estimated Jaccard similarity (default keep near duplicates)")
+    training_group.add_argument("--index-data", action="store_true",
+                                help="keep an index of the training data file in a TRAINING.index directory next to " +
+                                     "it, from which samples are read directly on this and later runs (default " +
+                                     "read the data file into memory)")
+    training_group.add_argument("--classes", metavar="LABEL", nargs="+",
+                                help="labels to train on when the training data is sharded, skipping samples with " +
+                                     "other labels (default every label found by scanning the shards)")
+    training_group.add_argument("--shuffle-buffer", metavar="ROWS", type=int, default=100000,
+                                help="number of rows from which sharded training data is sampled at random " +
+                                     "(default 100000)")
+    training_group.add_argument("--swap-augmentation", action="store_true",
+                                help="also train on every pair with its texts swapped, for labels that do not depend " +
+                                     "on the order of the texts")
+    training_group.add_argument("--hard-examples", metavar="FRACTION", type=float,
+                                help="train each epoch on this fraction of the samples, drawn in proportion to their " +
+                                     "loss in the previous epochs (default train on every sample every epoch)")
+    training_group.add_argument("--curriculum-epochs", metavar="EPOCHS", type=int,
+                                help="start training on the pairs with the shortest texts and add longer ones over " +
+                                     "this many epochs (default no curriculum)")
+    training_group.add_argument("--checkpoint-every", metavar="EPOCHS", type=int,
+                                help="keep a copy of the model every this many epochs (default only keep the best)")
+    training_group.add_argument("--keep-checkpoints", metavar="K", type=int,
+                                help="number of epoch copies of the model to keep (default all)")
+    training_group.add_argument("--resume-every", metavar="BATCHES", type=int,
+                                help="save the state needed to resume interrupted training every this many batches " +
+                                     "(default at the end of every epoch)")
+    parallel_group = training_arguments.add_argument_group("data-parallel training options")
+    parallel_group.add_argument("--processes", type=int, default=1,
+                                help="number of data-parallel training processes on this host (default 1)")
+    parallel_group.add_argument("--nodes", type=int, default=1,
+                                help="number of hosts taking part in data-parallel training (default 1)")
+    parallel_group.add_argument("--node-rank", metavar="RANK", type=int, default=0,
+                                help="index of this host among the nodes, where node 0 writes the model (default 0)")
+    parallel_group.add_argument("--rendezvous", metavar="HOST:PORT",
+                                help="address on node 0 through which the processes communicate " +
+                                     "(required for multiple nodes)")
     validation_group = training_group.add_mutually_exclusive_group()
     validation_group.add_argument("--validation-set", metavar="FILE",
                                   help="validation data file (default no validation)")
@@ -65,7 +128,9 @@ def create_argument_parser():
     The generated model is saved in a directory.
     
     You may optionally specify either a separate labeled data file for validation or a portion of the training data
-    to use as validation."""), parents=[data_arguments, training_arguments, embedding_arguments], help="train a model")
+    to use as validation."""), parents=[data_arguments, training_arguments, embedding_arguments, memory_arguments,
+                                        backend_arguments],
+                                         help="train a model")
     train_parser.add_argument("--model-directory-name", metavar="DIRECTORY",
                               help="output model directory (default do not save a model)")
     model_group = train_parser.add_argument_group("model configuration options")
@@ -73,8 +138,21 @@ def create_argument_parser():
     model_group.add_argument("--dropout", type=float, help="Dropout rate (default no dropout)")
     model_group.add_argument("--maximum-tokens", metavar="TOKENS", type=int,
                              help="maximum number of tokens to embed per sample (default longest in the data)")
+    model_group.add_argument("--truncation", choices=["head", "tail", "head-tail"], default="head",
+                             help="keep the first tokens, the last tokens, or half from each end of texts longer " +
+                                  "than the maximum number of tokens (default head)")
+    model_group.add_argument("--drop-tokens", choices=["stopwords", "punctuation"], action="append", default=[],
+                             help="leave out stop words or punctuation before truncating, may be repeated " +
+                                  "(default keep all tokens)")
     model_group.add_argument("--bidirectional", action="store_true",
                              help="make LSTM bidirectional (default not bidirectional)")
+    model_group.add_argument("--embedder", metavar="EMBEDDER",
+                             help="a spaCy model name, vectors:DIRECTORY for a vectors table, or subword:FILE for " +
+                                  "hashed subword vectors (default en)")
+    model_group.add_argument("--pruned-vectors", metavar="WORDS", type=int,
+                             help="embed with a vectors table written to the model directory that contains only the " +
+                                  "training vocabulary and this many of the most frequent words (default use the " +
+                                  "full embedder)")
     train_parser.set_defaults(func=lambda args: train(args))
 
     # Continue subcommand
@@ -82,22 +160,53 @@ def create_argument_parser():
     Continue training a model.
     
     The updated model information is written to the original model directory."""),
-                                            parents=[data_arguments, training_arguments, embedding_arguments],
+                                            parents=[data_arguments, training_arguments, embedding_arguments,
+                                                     memory_arguments, backend_arguments],
                                             help="continue training a model")
     continue_parser.add_argument("model_directory_name", metavar="MODEL",
                                  help="directory containing previously trained model")
+    continue_parser.add_argument("--resume", action="store_true",
+                                 help="resume an interrupted training run where it stopped, training for the " +
+                                      "remainder of its epochs on the same data")
     continue_parser.set_defaults(func=lambda args: continue_training(args))
 
     test_arguments = argparse.ArgumentParser(add_help=False)
     test_arguments.add_argument("model_directory_name", metavar="MODEL", help="model directory")
     test_arguments.add_argument("test", metavar="TEST", help="test data")
     test_arguments.add_argument("--n", type=int, help="number of test samples to use (default all)")
+    test_arguments.add_argument("--workers", metavar="PROCESSES", type=int,
+                                help="number of processes used to embed text (default embed in a single process)")
+    test_arguments.add_argument("--cache", metavar="FILE",
+                                help="database of predictions to reuse for text pairs the model has already seen " +
+                                     "(default no cache)")
+    test_arguments.add_argument("--cache-size", metavar="PAIRS", type=int, default=10000000,
+                                help="maximum number of predictions to keep in the cache (default 10000000)")
+    test_arguments.add_argument("--write-weights", action="store_true",
+                                help="write model.weights to the model directory if it is missing or out of date, " +
+                                     "so that later runs load faster")
 
     # Predict subcommand
     predict_parser = subparsers.add_parser("predict", description=textwrap.dedent("""\
     Use a model to predict a probability distribution over the text pair labels."""),
-                                           parents=[data_arguments, embedding_arguments, test_arguments],
+                                           parents=[data_arguments, embedding_arguments, memory_arguments,
+                                                    test_arguments, backend_arguments],
                                            help="predict labels")
+    output_group = predict_parser.add_argument_group("output options")
+    output_group.add_argument("--output", choices=["probabilities", "label", "top"], default="probabilities",
+                              help="the probability of every label, the most probable label, or the K most probable " +
+                                   "labels and their probabilities (default probabilities)")
+    output_group.add_argument("--k", type=int, default=1, help="number of labels for top output (default 1)")
+    output_group.add_argument("--threshold", metavar=("LABEL", "PROBABILITY"), nargs=2,
+                              help="only output samples for which the probability of the label exceeds this value")
+    output_group.add_argument("--symmetric", action="store_true",
+                              help="average the predictions for each pair in both orders")
+    output_group.add_argument("--precision", metavar="DIGITS", type=int,
+                              help="digits after the decimal point in CSV output (default full precision)")
+    output_group.add_argument("--format", choices=["csv", "npz"], default="csv",
+                              help="CSV text or a binary numpy archive with an array for the index and every column " +
+                                   "(default csv)")
+    output_group.add_argument("--output-file", metavar="FILE",
+                              help="file to write the predictions to (default standard output, required for npz)")
     predict_parser.set_defaults(func=lambda args: predict(args))
 
     # Score subcommand
@@ -105,8 +214,13 @@ def create_argument_parser():
     Use a model to score a labeled test set.
     
     This returns the model's cross entropy loss and accuracy on the test set."""),
-                                           parents=[data_arguments, embedding_arguments, test_arguments],
+                                           parents=[data_arguments, embedding_arguments, memory_arguments,
+                                                    test_arguments, backend_arguments],
                                            help="score labeled test set")
+    predict_parser.add_argument("--chunk-size", metavar="ROWS", type=int,
+                                help="read the test set this many rows at a time and report loss, accuracy, " +
+                                     "ROC AUC, calibration error, per-label precision, recall, and F1, and the " +
+                                     "confusion matrix (default read the whole test set and report loss and accuracy)")
     predict_parser.set_defaults(func=lambda args: score(args))
 
     # Cross-validation subcommand
@@ -122,37 +236,239 @@ def create_argument_parser():
     cv_parser.add_argument("--output-directory", metavar="DIRECTORY", type=str, default=".",
                            help="output directory (default working directory)")
     cv_parser.add_argument("--n", type=int, help="number of samples to use (default all)")
+    cv_parser.add_argument("--seed", type=int, help="random number seed for the partitions (default random)")
     cv_parser.set_defaults(func=lambda args: create_cross_validation_partitions(args))
 
+    # Compile subcommand
+    compile_parser = subparsers.add_parser("compile", description=textwrap.dedent("""\
+    Load, clean, and tokenize a data file once, writing the result to a directory.
+    
+    The directory can be used in place of a data file by the train, continue, predict, and score commands, which then
+    skip straight to embedding. The embedder must be the one the model uses."""), parents=[data_arguments],
+                                           help="compile a data file")
+    compile_parser.add_argument("data", metavar="DATA", help="data to compile")
+    compile_parser.add_argument("output", metavar="OUT", help="output directory")
+    compile_parser.add_argument("--n", type=int, help="number of samples to use (default all)")
+    compile_parser.add_argument("--embedder", metavar="EMBEDDER", help="embedder whose tokenizer to use (default en)")
+    compile_parser.add_argument("--workers", metavar="PROCESSES", type=int,
+                                help="number of processes used to tokenize text (default a single process)")
+    compile_parser.set_defaults(func=lambda args: compile_data(args))
+
+    text_arguments = argparse.ArgumentParser(add_help=False)
+    text_group = text_arguments.add_argument_group("input text file parsing options")
+    text_group.add_argument("--text-name", metavar="NAME", default="text",
+                            help="column containing the text (default text)")
+    text_group.add_argument("--index-name", metavar="NAME",
+                            help="column containing a unique index (default use row number)")
+    text_group.add_argument("--not-comma-delimited", action="store_true", help="the data is not comma delimited")
+    text_group.add_argument("--n", type=int, help="number of texts to use (default all)")
+    text_group.add_argument("--workers", metavar="PROCESSES", type=int,
+                            help="number of processes used to embed text (default embed in a single process)")
+
+    # Index subcommand
+    index_parser = subparsers.add_parser("index", description=textwrap.dedent("""\
+    Encode texts with a model's LSTM and write a nearest neighbour index of them to a directory.
+    
+    The texts are in a CSV document with a column labeled text. The index is used by the search command to find
+    candidate pairs without scoring every pair of texts."""), parents=[text_arguments, embedding_arguments],
+                                         help="index texts for search")
+    index_parser.add_argument("model_directory_name", metavar="MODEL", help="model directory")
+    index_parser.add_argument("texts", metavar="TEXTS", help="texts to index")
+    index_parser.add_argument("output", metavar="OUT", help="output index directory")
+    index_parser.add_argument("--clusters", type=int,
+                              help="number of clusters to partition the texts into (default square root of the " +
+                                   "number of texts)")
+    index_parser.set_defaults(func=lambda args: create_index(args))
+
+    # Search subcommand
+    search_parser = subparsers.add_parser("search", description=textwrap.dedent("""\
+    Find the indexed texts most similar to each query text and predict labels for these pairs.
+    
+    The query texts are in a CSV document with a column labeled text. Query texts are the first element of the predicted
+    pairs and indexed texts the second."""), parents=[text_arguments, embedding_arguments],
+                                          help="search an index for candidate pairs")
+    search_parser.add_argument("index", metavar="INDEX", help="index directory")
+    search_parser.add_argument("queries", metavar="QUERIES", help="query texts")
+    search_parser.add_argument("--k", type=int, default=10, help="candidates to return per query (default 10)")
+    search_parser.add_argument("--probes", type=int, default=8,
+                               help="clusters to search per query, trading speed for recall (default 8)")
+    search_parser.set_defaults(func=lambda args: search(args))
+
+    # Distill subcommand
+    distill_parser = subparsers.add_parser("distill", description=textwrap.dedent("""\
+    Train a small, fast student model to predict the label probabilities of a large teacher model.
+    
+    The teacher predicts label probabilities for the text pairs in the data, which need not be labeled, and the student
+    is trained on these. The student and teacher are then compared on the comparison set, reporting their number of
+    parameters, prediction throughput, agreement, and accuracy if the comparison set is labeled."""),
+                                           parents=[data_arguments, embedding_arguments, memory_arguments,
+                                                    backend_arguments],
+                                           help="distill a model into a smaller one")
+    distill_parser.add_argument("teacher", metavar="TEACHER", help="teacher model directory")
+    distill_parser.add_argument("data", metavar="DATA", help="text pairs")
+    distill_parser.add_argument("--model-directory-name", metavar="DIRECTORY",
+                                help="output student model directory (default do not save a model)")
+    distill_parser.add_argument("--n", type=int, help="number of text pairs to use (default all)")
+    distill_parser.add_argument("--epochs", type=int, default=10, help="training epochs (default 10)")
+    distill_parser.add_argument("--seed", type=int,
+                                help="random number seed for shuffling and weight initialization (default random)")
+    distill_parser.add_argument("--checkpoint-every", metavar="EPOCHS", type=int,
+                                help="keep a copy of the student every this many epochs (default only keep the best)")
+    distill_parser.add_argument("--keep-checkpoints", metavar="K", type=int,
+                                help="number of epoch copies of the student to keep (default all)")
+    distill_parser.add_argument("--workers", metavar="PROCESSES", type=int,
+                                help="number of processes used to embed text for prediction (default embed in a " +
+                                     "single process)")
+    distill_parser.add_argument("--cache", metavar="FILE",
+                                help="database of teacher predictions to reuse, so that distilling more students " +
+                                     "from the same data does not run the teacher again (default no cache)")
+    distill_parser.add_argument("--cache-size", metavar="PAIRS", type=int, default=10000000,
+                                help="maximum number of predictions to keep in the cache (default 10000000)")
+    distill_parser.add_argument("--comparison-set", metavar="FILE",
+                                help="data on which to compare the student with the teacher (default the first " +
+                                     "10000 pairs of DATA)")
+    student_group = distill_parser.add_argument_group("student configuration options")
+    student_group.add_argument("--units", type=int, default=64, help="LSTM hidden layer size (default 64)")
+    student_group.add_argument("--dropout", type=float, help="Dropout rate (default no dropout)")
+    student_group.add_argument("--bidirectional", action="store_true",
+                               help="make LSTM bidirectional (default not bidirectional)")
+    student_group.add_argument("--embedder", metavar="EMBEDDER",
+                               help="a spaCy model name, vectors:DIRECTORY for a vectors table, or subword:FILE for " +
+                                    "hashed subword vectors (default the teacher's embedder)")
+    distill_parser.set_defaults(func=lambda args: distill(args))
+
+    # History subcommand
+    history_parser = subparsers.add_parser("history", description=textwrap.dedent("""\
+    Summarize the training runs of models.
+    
+    Each run is a row with its date, number of samples and epochs, seconds per epoch, samples trained on per second,
+    and the metrics of its best epoch."""), help="summarize training runs")
+    history_parser.add_argument("model_directory_names", metavar="MODEL", nargs="+", help="model directories")
+    history_parser.add_argument("--last", metavar="RUNS", type=int,
+                                help="only summarize this many of the most recent runs of each model (default all)")
+    history_parser.set_defaults(func=lambda args: history(args))
+
     return parser
 
 
 def train(args):
+    train_or_continue(args, _train_operation)
+
+
+def _train_operation(args, training, validation, rendezvous):
     from bisemantic.classifier import TextPairClassifier
-    train_or_continue(args,
-                      lambda training, validation:
-                      TextPairClassifier.train(training, args.bidirectional, args.units, args.epochs,
-                                               dropout=args.dropout, maximum_tokens=args.maximum_tokens,
-                                               batch_size=args.batch_size,
-                                               validation_data=validation,
-                                               model_directory=args.model_directory_name))
+    from bisemantic.embedders import Truncation
+    truncation = Truncation(args.truncation, args.drop_tokens)
+    return TextPairClassifier.train(training, args.bidirectional, args.units, args.epochs,
+                                    dropout=args.dropout, maximum_tokens=args.maximum_tokens,
+                                    batch_size=args.batch_size,
+                                    validation_data=validation,
+                                    model_directory=args.model_directory_name,
+                                    embedder=args.embedder, pruned_vectors=args.pruned_vectors,
+                                    checkpoint_every=args.checkpoint_every,
+                                    keep_checkpoints=args.keep_checkpoints,
+                                    resume_every=args.resume_every,
+                                    rendezvous=rendezvous,
+                                    memory_budget=args.memory_budget,
+                                    swap_augmentation=args.swap_augmentation,
+                                    truncation=truncation.specification,
+                                    sample_fraction=args.hard_examples,
+                                    curriculum_epochs=args.curriculum_epochs,
+                                    seed=args.seed)
 
 
 def continue_training(args):
+    if args.resume:
+        train_or_continue(args, _resume_operation)
+    else:
+        train_or_continue(args, _continue_operation)
+
+
+def _continue_operation(args, training, validation, rendezvous):
     from bisemantic.classifier import TextPairClassifier
-    train_or_continue(args,
-                      lambda training, validation:
-                      TextPairClassifier.continue_training(training, args.epochs, args.model_directory_name,
-                                                           batch_size=args.batch_size, validation_data=validation))
+    return TextPairClassifier.continue_training(training, args.epochs, args.model_directory_name,
+                                                batch_size=args.batch_size, validation_data=validation,
+                                                checkpoint_every=args.checkpoint_every,
+                                                keep_checkpoints=args.keep_checkpoints,
+                                                resume_every=args.resume_every,
+                                                rendezvous=rendezvous,
+                                                memory_budget=args.memory_budget,
+                                                swap_augmentation=args.swap_augmentation,
+                                                sample_fraction=args.hard_examples,
+                                                curriculum_epochs=args.curriculum_epochs,
+                                                seed=args.seed)
+
+
+def _resume_operation(args, training, validation, rendezvous):
+    from bisemantic.classifier import TextPairClassifier
+    if rendezvous is not None:
+        raise ValueError("Interrupted runs cannot be resumed with data-parallel training")
+    return TextPairClassifier.resume_training(training, args.model_directory_name,
+                                              validation_data=validation,
+                                              checkpoint_every=args.checkpoint_every,
+                                              keep_checkpoints=args.keep_checkpoints,
+                                              resume_every=args.resume_every)
 
 
 def train_or_continue(args, training_operation):
-    from bisemantic.data import cross_validation_partitions
-
-    training = data_file(args.training, args.n, args.index_name, args.text_1_name, args.text_2_name, args.label_name,
-                         args.invalid_labels, not args.not_comma_delimited)
+    world_size = args.processes * args.nodes
+    if world_size > 1:
+        from bisemantic.data import is_sharded
+        from bisemantic.parallel import run_processes, free_address, environment_authkey, random_authkey
+        if args.rendezvous is not None:
+            host, port = args.rendezvous.rsplit(":", 1)
+            address = (host, int(port))
+        elif args.nodes > 1:
+            raise ValueError("Training on multiple nodes requires a rendezvous address")
+        else:
+            address = free_address()
+        # Processes on other hosts need a shared secret. Processes on this host are handed a random one.
+        authkey = environment_authkey() if args.nodes > 1 else random_authkey()
+        if args.index_data and not is_sharded(args.training):
+            # Build the index once here so that the processes all load it instead of building it at the same time.
+            _indexed_training_data(args)
+        # The subcommand function is a lambda, which cannot be passed to another process.
+        args = argparse.Namespace(**{name: value for name, value in vars(args).items() if name != "func"})
+        ranks = range(args.node_rank * args.processes, (args.node_rank + 1) * args.processes)
+        run_processes(_data_parallel_training,
+                      [(args, training_operation, rank, world_size, address, authkey) for rank in ranks])
+    else:
+        _train_or_continue(args, training_operation)
+
+
+def _data_parallel_training(args, training_operation, rank, world_size, address, authkey):
+    from bisemantic.parallel import Rendezvous
+    configure_logger(args.log.upper(), "%(asctime)-15s %(levelname)-8s rank " + str(rank) + " %(message)s")
+    rendezvous = Rendezvous(rank, world_size, address, authkey)
+    try:
+        _train_or_continue(args, training_operation, rendezvous)
+    finally:
+        rendezvous.close()
+
+
+def _train_or_continue(args, training_operation, rendezvous=None):
+    from bisemantic.data import cross_validation_partitions, is_sharded, ShardedDataset
+
+    configure_backend(args, args.seed)
+    if is_sharded(args.training):
+        if args.n is not None or args.deduplicate is not None or args.near_duplicates is not None or \
+                args.validation_fraction is not None:
+            raise ValueError("Sharded training data cannot be limited, deduplicated, or partitioned for validation")
+        training = ShardedDataset(args.training, args.classes, args.shuffle_buffer, args.index_name, args.text_1_name,
+                                  args.text_2_name, args.label_name, args.invalid_labels, not args.not_comma_delimited,
+                                  seed=args.seed or 0)
+    elif args.index_data:
+        training = _indexed_training_data(args)
+    else:
+        training = data_file(args.training, args.n, args.index_name, args.text_1_name, args.text_2_name,
+                             args.label_name, args.invalid_labels, not args.not_comma_delimited, args.deduplicate,
+                             args.near_duplicates)
     if args.validation_fraction is not None:
-        training, validation = cross_validation_partitions(training, 1 - args.validation_fraction, 1)[0]
+        # Data-parallel processes must all make the same partition.
+        seed = args.seed
+        if seed is None and rendezvous is not None:
+            seed = rendezvous.broadcast(random.randrange(2 ** 32))
+        training, validation = cross_validation_partitions(training, 1 - args.validation_fraction, 1, seed)[0]
     elif args.validation_set is not None:
         validation = data_file(args.validation_set, args.n, args.index_name,
                                args.text_1_name, args.text_2_name, args.label_name, args.invalid_labels,
@@ -160,39 +476,230 @@ def train_or_continue(args, training_operation):
     else:
         validation = None
 
-    _, training_history = training_operation(training, validation)
-    print(training_history.latest_run_summary())
+    _, training_history = training_operation(args, training, validation, rendezvous)
+    if rendezvous is None or rendezvous.rank == 0:
+        print(training_history.latest_run_summary())
+
+
+def _indexed_training_data(args):
+    from bisemantic.data import indexed_data_file
+    from bisemantic.embedders import load_embedder
+    if hasattr(args, "embedder"):
+        specification = args.embedder
+    else:
+        from bisemantic.classifier import TextPairClassifier
+        # Continued training counts tokens with the embedder the model was trained with.
+        specification = TextPairClassifier.embedder_specification_from_model_directory(args.model_directory_name)
+    embedder = load_embedder(specification)
+    return indexed_data_file(args.training, args.n, args.index_name, args.text_1_name, args.text_2_name,
+                             args.label_name, args.invalid_labels, not args.not_comma_delimited, args.deduplicate,
+                             args.near_duplicates, embedder)
 
 
 def predict(args):
     from bisemantic.classifier import TextPairClassifier
 
+    configure_backend(args)
     test = data_file(args.test, args.n, args.index_name, args.text_1_name, args.text_2_name, args.label_name,
                      args.invalid_labels, not args.not_comma_delimited)
     logger.info("Predict labels for %d pairs" % len(test))
-    model = TextPairClassifier.load_from_model_directory(args.model_directory_name)
+    if args.format == "npz" and args.output_file is None:
+        raise ValueError("Binary output must be written to an output file")
+    model = TextPairClassifier.load_from_model_directory(args.model_directory_name,
+                                                         write_mapped_weights=args.write_weights)
     class_names = TextPairClassifier.class_names_from_model_directory(args.model_directory_name)
-    predictions = model.predict(test, batch_size=args.batch_size, class_names=class_names)
-    print(predictions.to_csv())
+    threshold = None
+    if args.threshold is not None:
+        name, probability = args.threshold
+        # Class names may be numbers, but on the command line they are strings.
+        names = {str(class_name): class_name for class_name in class_names}
+        if name not in names:
+            raise ValueError("Invalid threshold label %s. It must be one of %s" % (name, ", ".join(names)))
+        threshold = (names[name], float(probability))
+    with prediction_cache(args) as cache:
+        predictions = model.predict(test, batch_size=test_batch_size(args, model), class_names=class_names,
+                                    workers=args.workers, output=args.output, k=args.k, threshold=threshold,
+                                    cache=cache, symmetric=args.symmetric)
+    write_predictions(predictions, args.format, args.output_file, args.precision)
+
+
+def write_predictions(predictions, output_format, filename=None, precision=None):
+    """
+    :param predictions: predictions returned by TextPairClassifier.predict
+    :type predictions: pandas.DataFrame
+    :param output_format: "csv" or "npz"
+    :type output_format: str
+    :param filename: file to write to or None to write CSV to standard output
+    :type filename: str or None
+    :param precision: digits after the decimal point in CSV output or None for full precision
+    :type precision: int or None
+    """
+    if output_format == "npz":
+        import numpy as np
+
+        def array(values):
+            # Object arrays would be pickled, and numpy does not load pickled arrays by default.
+            return values.astype(str) if values.dtype == object else values
+
+        np.savez(filename, index=array(predictions.index.values),
+                 **{str(column): array(predictions[column].values) for column in predictions.columns})
+    else:
+        float_format = None
+        if precision is not None:
+            float_format = "%%.%df" % precision
+        if filename is None:
+            print(predictions.to_csv(float_format=float_format))
+        else:
+            predictions.to_csv(filename, float_format=float_format)
 
 
 def score(args):
     from bisemantic.classifier import TextPairClassifier
 
+    configure_backend(args)
+    if args.chunk_size is not None:
+        score_chunks(args)
+        return
     test = data_file(args.test, args.n, args.index_name, args.text_1_name, args.text_2_name, args.label_name,
                      args.invalid_labels, not args.not_comma_delimited)
     logger.info("Score predictions for %d pairs" % len(test))
-    model = TextPairClassifier.load_from_model_directory(args.model_directory_name)
-    scores = model.score(test, batch_size=args.batch_size)
+    model = TextPairClassifier.load_from_model_directory(args.model_directory_name,
+                                                         write_mapped_weights=args.write_weights)
+    with prediction_cache(args) as cache:
+        scores = model.score(test, batch_size=test_batch_size(args, model), workers=args.workers, cache=cache)
     print(", ".join("%s=%0.5f" % s for s in scores))
 
 
+def score_chunks(args):
+    from bisemantic.classifier import TextPairClassifier
+    from bisemantic.data import data_file_chunks
+
+    test = data_file_chunks(args.test, args.chunk_size, args.n, args.index_name, args.text_1_name, args.text_2_name,
+                            args.label_name, args.invalid_labels, not args.not_comma_delimited)
+    model = TextPairClassifier.load_from_model_directory(args.model_directory_name,
+                                                         write_mapped_weights=args.write_weights)
+    class_names = TextPairClassifier.class_names_from_model_directory(args.model_directory_name)
+    with prediction_cache(args) as cache:
+        metrics = model.score_chunks(test, class_names, batch_size=test_batch_size(args, model), workers=args.workers,
+                                     cache=cache)
+    print(metrics.report())
+
+
+def test_batch_size(args, model):
+    if args.memory_budget is None:
+        return args.batch_size
+    return model.batch_size_for_memory(args.memory_budget, workers=args.workers)
+
+
+def memory_size(s):
+    """
+    :param s: number of bytes with an optional K, M, G, or T suffix for powers of 1024
+    :type s: str
+    :return: number of bytes
+    :rtype: int
+    """
+    units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+    size = s.strip().upper()
+    if size.endswith("B"):
+        size = size[:-1]
+    multiplier = units.get(size[-1:], 1)
+    if size[-1:] in units:
+        size = size[:-1]
+    try:
+        return int(float(size) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid memory size %s" % s)
+
+
+def distill(args):
+    from bisemantic.classifier import TextPairClassifier, compare_models
+
+    configure_backend(args, args.seed)
+    data = data_file(args.data, args.n, args.index_name, args.text_1_name, args.text_2_name, args.label_name,
+                     args.invalid_labels, not args.not_comma_delimited)
+    with prediction_cache(args) as cache:
+        student, training_history = TextPairClassifier.distill(args.teacher, data, args.units, args.epochs,
+                                                               dropout=args.dropout, bidirectional=args.bidirectional,
+                                                               batch_size=args.batch_size,
+                                                               model_directory=args.model_directory_name,
+                                                               embedder=args.embedder, workers=args.workers,
+                                                               cache=cache, checkpoint_every=args.checkpoint_every,
+                                                               keep_checkpoints=args.keep_checkpoints,
+                                                               memory_budget=args.memory_budget)
+    print(training_history.latest_run_summary())
+    if args.comparison_set is not None:
+        comparison = data_file(args.comparison_set, None, args.index_name, args.text_1_name, args.text_2_name,
+                               args.label_name, args.invalid_labels, not args.not_comma_delimited)
+    else:
+        comparison = data.head(10000)
+    teacher = TextPairClassifier.load_from_model_directory(args.teacher)
+    class_names = TextPairClassifier.class_names_from_model_directory(args.teacher)
+    print(compare_models([("teacher", teacher), ("student", student)], comparison, class_names,
+                         batch_size=args.batch_size, workers=args.workers).to_string())
+
+
+def history(args):
+    import pandas as pd
+    from bisemantic.classifier import TextPairClassifier
+
+    summaries = []
+    for model_directory in args.model_directory_names:
+        summary = TextPairClassifier.training_history_from_model_directory(model_directory, args.last).summary()
+        summary.insert(0, "model", model_directory)
+        summaries.append(summary)
+    print(pd.concat(summaries, ignore_index=True).to_string(index=False))
+
+
+def configure_backend(args, seed=None):
+    from bisemantic.classifier import configure_backend
+    configure_backend(seed, args.intra_op_threads, args.inter_op_threads)
+
+
+def prediction_cache(args):
+    if args.cache is None:
+        # A context manager that provides no cache.
+        return contextlib.nullcontext()
+    from bisemantic.cache import PredictionCache
+    return PredictionCache(args.cache, args.cache_size)
+
+
 def create_cross_validation_partitions(args):
-    from bisemantic.data import cross_validation_partitions
+    from bisemantic.data import cross_validation_partitions, is_sharded
+    # Check before loading the data, which may be large.
+    if os.path.isdir(args.data) or is_sharded(args.data):
+        raise ValueError("Cross validation partitions can only be made from a CSV data file")
     data = data_file(args.data, args.n, args.index_name, args.text_1_name, args.text_2_name, args.label_name,
                      args.invalid_labels, not args.not_comma_delimited)
-    for i, (train_partition, validate_partition) in enumerate(cross_validation_partitions(data, args.fraction, args.k)):
+    partitions = cross_validation_partitions(data, args.fraction, args.k, args.seed)
+    for i, (train_partition, validate_partition) in enumerate(partitions):
         train_name, validate_name = [os.path.join(args.output_directory, "%s.%d.%s.csv" % (args.prefix, i + 1, name))
                                      for name in ["train", "validate"]]
         train_partition.to_csv(train_name)
         validate_partition.to_csv(validate_name)
+
+
+def compile_data(args):
+    from bisemantic.data import compile_dataset
+    from bisemantic.embedders import load_embedder
+    data = data_file(args.data, args.n, args.index_name, args.text_1_name, args.text_2_name, args.label_name,
+                     args.invalid_labels, not args.not_comma_delimited)
+    compile_dataset(data, args.output, load_embedder(args.embedder), args.workers)
+
+
+def create_index(args):
+    from bisemantic.search import EncodingIndex
+    texts = text_file(args.texts, args.n, args.index_name, args.text_name, not args.not_comma_delimited)
+    EncodingIndex.build(args.model_directory_name, texts, args.output, clusters=args.clusters,
+                        batch_size=args.batch_size, workers=args.workers)
+
+
+def search(args):
+    from bisemantic.classifier import TextPairClassifier
+    from bisemantic.search import EncodingIndex
+    index = EncodingIndex(args.index)
+    queries = text_file(args.queries, args.n, args.index_name, args.text_name, not args.not_comma_delimited)
+    class_names = TextPairClassifier.class_names_from_model_directory(index.model_directory)
+    candidates = index.search(queries, k=args.k, probes=args.probes, batch_size=args.batch_size,
+                              workers=args.workers, class_names=class_names)
+    print(candidates.to_csv(index=False))
+
@@ -1,21 +1,34 @@
 """
 Parse text and represent it as embedding matrices.
 """
+import copy
+import glob
+import json
 import math
-from itertools import cycle
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+from array import array
+from collections import deque
+from itertools import count, cycle, islice
 
 import numpy as np
 import pandas as pd
-import spacy
 from pandas import DataFrame
 from toolz import partition_all
 
 from bisemantic import logger
+from bisemantic.embedders import load_embedder, tokenize, Truncation
 
 # Column labels in DataFrame input.
 text_1 = "text1"
 text_2 = "text2"
 label = "label"
+weight = "weight"
+# Column that carries the row of each sample's label probabilities through batching.
+_target_row = "target row"
 
 
 class TextPairEmbeddingGenerator(object):
@@ -24,34 +37,164 @@ class TextPairEmbeddingGenerator(object):
     into batches that can be fed into the classifier.
 
     The batches are yielded by a generator so that the memory usage is a constant proportional to batch size.
+
+    The data may also be a CompiledDataset, in which case the text has already been tokenized, or an IndexedDataset, in
+    which case the batches are read from memory-mapped arrays without going through the data in order.
+
+    If labeled data has a weight column, such as the one added by deduplicate, the batches include sample weights.
     """
 
-    def __init__(self, data, maximum_tokens=None, batch_size=2048):
+    def __init__(self, data, maximum_tokens=None, batch_size=2048, workers=None, embedder=None, shard=None,
+                 swap_augmentation=False, truncation=None, sample_fraction=None, curriculum_epochs=None, seed=None,
+                 targets=None):
         """Create a generator of embedded data batches.
 
         The data for each batch with be an array of size (batch size, maximum tokens, embeddings). If maximum tokens is
         not specified to the constructor, the number of tokens in the longest text in all the text pairs is used.
 
+        If a number of workers is specified, text is embedded in that many forked processes. The embedder is loaded
+        before the processes are forked, so they all share a single copy of its vector table.
+
+        If a shard is specified, only every Nth sample starting at the Kth one is generated. The classes and maximum
+        tokens are still taken from all the data, and every shard has the same number of batches per epoch, so that the
+        generators of all the shards are interchangeable.
+
+        With swap augmentation, every batch is followed by the same batch with its first and second texts swapped. The
+        swapped batch reuses the embeddings of the original one, so augmentation doubles the number of batches without
+        doubling the cost of embedding.
+
+        Texts longer than the maximum number of tokens are cut down to size by the truncation, which by default keeps
+        their first tokens.
+
+        Sharded data is read from its files a batch at a time on every pass and requires a maximum number of tokens.
+
+        Labeled data in memory may instead be sampled. Each epoch is then a random selection of a fraction of the
+        samples. Once the losses of samples are recorded with record_losses, samples are drawn with replacement in
+        proportion to their losses, so hard samples are seen often and easy ones rarely. Samples whose loss is not known
+        yet count as the hardest. With a curriculum, the first epochs draw only from the shortest texts, adding longer
+        ones every epoch until all the samples are available. Batches are prepared ahead of training, so an epoch may
+        be drawn before the losses of the epoch before it have been recorded. For the same reason a resumed run draws
+        from the recorded losses but not necessarily the same samples the interrupted run would have.
+
+        Instead of labels, the batches may contain given label probabilities, such as those predicted by another model.
+        Any labels in the data are then ignored.
+
         :param data: data frame with text1, text2, and optional label columns
-        :type data: pandas.DataFrame
+        :type data: pandas.DataFrame, CompiledDataset, IndexedDataset, or ShardedDataset
         :param maximum_tokens: maximum number of tokens in an embedding
         :type maximum_tokens: int or None
         :param batch_size: number of samples per batch
         :type batch_size: int
+        :param workers: number of processes used to embed text or None to embed in this process
+        :type workers: int or None
+        :param embedder: embedder or None to use the default one
+        :type embedder: bisemantic.embedders.Embedder or None
+        :param shard: index K of the shard to generate and number of shards N, or None to generate all the data
+        :type shard: (int, int) or None
+        :param swap_augmentation: also generate every batch with its texts swapped?
+        :type swap_augmentation: bool
+        :param truncation: how to fit texts into the maximum number of tokens or None to keep their first tokens
+        :type truncation: bisemantic.embedders.Truncation or None
+        :param sample_fraction: fraction of the samples to draw for each epoch or None to use all of them
+        :type sample_fraction: float or None
+        :param curriculum_epochs: number of epochs over which to go from the shortest texts to all of them or None for
+            no curriculum
+        :type curriculum_epochs: int or None
+        :param seed: random number seed for sampling
+        :type seed: int or None
+        :param targets: label probabilities to generate instead of labels, with a column named for each class and a row
+            for each sample, or None to generate the labels in the data
+        :type targets: pandas.DataFrame or None
         """
         self.data = data
+        self.sample_fraction = sample_fraction
+        self.curriculum_epochs = curriculum_epochs
+        self.seed = seed
+        self.truncation = truncation or Truncation()
+        self.swap_augmentation = swap_augmentation
         self.batch_size = batch_size
-        self.batches_per_epoch = math.ceil(len(self) / self.batch_size)
-        self._labeled = label in self.data.columns
-        if self._labeled:
+        self.workers = workers
+        self.embedder = embedder or load_embedder()
+        self._epoch_samples = len(self)
+        self._labeled = label in self.data.columns and targets is None
+        self._indexed = isinstance(self.data, CompiledDataset)
+        self._tokenized = self._indexed and self.data.tokenized
+        self._sharded = isinstance(self.data, ShardedDataset)
+        self._weighted = (self._labeled or targets is not None) and weight in self.data.columns
+        self.targets = targets
+        if targets is not None:
+            if self._sharded:
+                raise ValueError("Label probabilities cannot be generated for sharded data")
+            if not len(targets) == len(self):
+                raise ValueError("There are %d label probabilities for %d samples" % (len(targets), len(self)))
+            self._target_values = np.asarray(targets.values, dtype=np.float32)
+        if self._tokenized and not self.data.embedder == self.embedder.specification:
+            logger.warning("Data was tokenized by %s but is being embedded by %s" %
+                           (self.data.embedder, self.embedder.specification))
+        if self._labeled and not (self._indexed or self._sharded):
             self.data.loc[:, label] = self.data.loc[:, label].astype("category")
-        if maximum_tokens is None:
-            m1 = max(len(document) for document in parse_texts(self.data[text_1]))
-            m2 = max(len(document) for document in parse_texts(self.data[text_2]))
+        if maximum_tokens is None and self._sharded:
+            raise ValueError("The maximum number of tokens must be specified for sharded data")
+        elif maximum_tokens is None and (self._tokenized or self._indexed and not self.truncation.drop and
+                                         self.data.embedder == self.embedder.specification):
+            # An index holds the number of tokens the embedder that built it found in each text.
+            maximum_tokens = int(max(self.data.lengths(text_1).max(), self.data.lengths(text_2).max()))
+        elif maximum_tokens is None:
+            m1 = max(len(self.embedder.filter_tokens(tokens, self.truncation.drop))
+                     for tokens in self.embedder.tokenize(self.data[text_1]))
+            m2 = max(len(self.embedder.filter_tokens(tokens, self.truncation.drop))
+                     for tokens in self.embedder.tokenize(self.data[text_2]))
             maximum_tokens = max(m1, m2)
         self.maximum_tokens = maximum_tokens
+        if shard is not None:
+            k, n = shard
+            self._epoch_samples = math.ceil(len(self) / n)
+            if self._sharded:
+                self.data = self.data.partition(k, n)
+            else:
+                self.data = self.data.iloc[k::n]
+                if targets is not None:
+                    self._target_values = self._target_values[k::n]
+        if self.sampled:
+            if self._sharded or shard is not None:
+                raise ValueError("Sharded data and data-parallel training cannot be sampled")
+            if not self._labeled:
+                raise ValueError("Only labeled data can be sampled")
+            if sample_fraction is not None:
+                self._epoch_samples = math.ceil(sample_fraction * len(self))
+            self.sample_losses = np.full(len(self), np.nan)
+            # Positions of the samples drawn for each epoch that has not been scored yet, by epoch. The Keras prefetch
+            # thread adds to this while HardExampleMining takes from it, so both hold the lock.
+            self.epoch_positions = {}
+            self._positions_lock = threading.Lock()
+            self.sampled_epochs = self.trained_samples = self.scored_samples = 0
+            self._random_state = np.random.RandomState(seed)
+        self.batches_per_epoch = self._batches_per_epoch()
+        # Batches are embedded on a Keras prefetch thread while HardExampleMining embeds samples to score them.
+        self._embedding_lock = threading.Lock()
         logger.info(self)
 
+    @property
+    def sampled(self):
+        return self.sample_fraction is not None or self.curriculum_epochs is not None
+
+    def resize(self, batch_size):
+        """
+        Change the batch size. This takes effect the next time the generator is called.
+
+        :param batch_size: number of samples per batch
+        :type batch_size: int
+        """
+        self.batch_size = batch_size
+        self.batches_per_epoch = self._batches_per_epoch()
+        logger.info(self)
+
+    def _batches_per_epoch(self):
+        batches = math.ceil(self._epoch_samples / self.batch_size)
+        if self.swap_augmentation:
+            batches *= 2
+        return batches
+
     def __len__(self):
         """
         :return: number of samples in the data
@@ -63,54 +206,233 @@ class TextPairEmbeddingGenerator(object):
         s = "%s: %d samples" % (self.__class__.__name__, len(self))
         if self._labeled:
             s += ", classes %s" % self.classes
-        return s + ", batch size %d, maximum tokens %s" % (self.batch_size, self.maximum_tokens)
+        elif self.targets is not None:
+            s += ", label probabilities for classes %s" % self.classes
+        s += ", batch size %d, maximum tokens %s" % (self.batch_size, self.maximum_tokens)
+        if not self.truncation == Truncation():
+            s += ", truncation %s" % self.truncation.specification
+        if self.swap_augmentation:
+            s += ", swap augmentation"
+        if self.sample_fraction is not None:
+            s += ", sample fraction %0.2f" % self.sample_fraction
+        if self.curriculum_epochs is not None:
+            s += ", curriculum %d epochs" % self.curriculum_epochs
+        return s
 
-    def __call__(self):
+    def __call__(self, initial_batch=0, initial_epoch=0):
         """
         Iterate eternally over the data yielding batches.
 
+        Sharded and sampled data are drawn in a different order on every pass, so a generator for a training run that
+        starts partway through must be told the pass at which it starts.
+
+        :param initial_batch: index of the batch at which to start the first pass through the data
+        :type initial_batch: int
+        :param initial_epoch: index of the first pass through the data
+        :type initial_epoch: int
         :return: batches of embedded text matrices and optionally labels
         :rtype: [numpy.array, numpy.array] or ([numpy.array, numpy.array], numpy.array)
         """
-        for batch_data in cycle(self._batches()):
-            yield self._embed_batch(batch_data)
+        if self.swap_augmentation:
+            # Every other batch is a swapped copy of the one before it.
+            initial_batch, skip = divmod(initial_batch, 2)
+        batch_data = islice(self._epochs(initial_epoch), initial_batch, None)
+        if self.workers:
+            batches = self._embed_batches_in_workers(batch_data)
+        else:
+            batches = (self._embed_batch_exclusively(b) for b in batch_data)
+        if self.swap_augmentation:
+            batches = islice(self._with_swapped_batches(batches), skip, None)
+        yield from batches
 
-    def _batches(self):
+    @staticmethod
+    def _with_swapped_batches(batches):
+        for batch in batches:
+            yield batch
+            if isinstance(batch, tuple):
+                (embeddings_1, embeddings_2), *rest = batch
+                yield tuple([[embeddings_2, embeddings_1]] + rest)
+            else:
+                embeddings_1, embeddings_2 = batch
+                yield [embeddings_2, embeddings_1]
+
+    def _embed_batches_in_workers(self, batch_data):
+        """
+        Embed batches in a pool of forked worker processes.
+
+        The workers inherit this process's embedder copy-on-write, so its vector table is resident in memory only
+        once no matter how many workers there are. Only raw text goes out to the workers and only embedding matrices
+        come back. A bounded number of batches is kept in flight so that the embeddings are returned in order without
+        racing ahead of the consumer.
+
+        :param batch_data: batches of data to embed
+        :type batch_data: iterator over DataFrame
+        :return: embedded batches
+        :rtype: iterator over [numpy.array, numpy.array] or ([numpy.array, numpy.array], numpy.array)
+        """
+        # The generator is handed to each worker as it starts rather than through a global in this process, which
+        # another generator with workers could replace before the pool forks. Forked workers inherit it unpickled.
+        pool = multiprocessing.get_context("fork").Pool(self.workers, initializer=_start_embedding_worker,
+                                                        initargs=(self,))
+        try:
+            pending = deque()
+            for b in batch_data:
+                pending.append(pool.apply_async(_embed_batch_in_worker, (b,)))
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    def _epochs(self, initial_epoch=0):
+        """
+        :param initial_epoch: index of the first pass through the data
+        :type initial_epoch: int
+        :return: batched data, repeated forever
+        :rtype: DataFrame iterator
+        """
+        if self._sharded:
+            # Sharded data is read again on every pass instead of being kept in memory.
+            for epoch in count(initial_epoch):
+                yield from self.data.batches(self.batch_size, epoch)
+        elif self.sampled:
+            for epoch in count(initial_epoch):
+                positions = self._epoch_positions(epoch)
+                with self._positions_lock:
+                    self.epoch_positions[epoch] = positions
+                yield from self._batches(positions)
+        else:
+            yield from cycle(self._batches())
+
+    def _epoch_positions(self, epoch):
+        n = len(self)
+        m = self._epoch_samples
+        if self.curriculum_epochs is not None and epoch < self.curriculum_epochs:
+            pool = self._length_order()[:math.ceil((epoch + 1) * n / self.curriculum_epochs)]
+            return self._random_state.choice(pool, m, replace=len(pool) < m)
+        known = ~np.isnan(self.sample_losses)
+        if not known.any():
+            return self._random_state.choice(n, m, replace=False)
+        losses = np.where(known, self.sample_losses, self.sample_losses[known].max())
+        # Every sample keeps some chance of being drawn, however easy it was.
+        p = losses + 0.1 * losses.mean() + 1e-12
+        return self._random_state.choice(n, m, p=p / p.sum())
+
+    def _length_order(self):
+        if self._indexed:
+            lengths = self.data.lengths(text_1) + self.data.lengths(text_2)
+        else:
+            lengths = self.data[text_1].str.len().values + self.data[text_2].str.len().values
+        return np.argsort(lengths, kind="mergesort")
+
+    def take_epoch_positions(self, epoch):
+        """
+        Remove the samples drawn for an epoch, along with those of any earlier epochs, which may have been drawn by a
+        run that was abandoned.
+
+        :param epoch: index of the epoch
+        :type epoch: int
+        :return: positions of the samples drawn for the epoch or None if it has not been drawn
+        :rtype: numpy.array or None
+        """
+        with self._positions_lock:
+            for earlier in [e for e in list(self.epoch_positions) if e < epoch]:
+                del self.epoch_positions[earlier]
+            return self.epoch_positions.pop(epoch, None)
+
+    def record_losses(self, positions, losses):
+        """
+        :param positions: positions of samples in the data
+        :type positions: numpy.array
+        :param losses: the current loss of each of these samples
+        :type losses: numpy.array
+        """
+        self.sample_losses[positions] = losses
+
+    def label_codes(self, positions):
+        """
+        :param positions: positions of samples in the data
+        :type positions: numpy.array
+        :return: the label code of each of these samples
+        :rtype: numpy.array
+        """
+        if self._indexed:
+            return np.asarray(self.data.labels.codes)[positions]
+        return self.data[label].cat.codes.values[positions]
+
+    def embedded_texts(self, positions):
+        """
+        :param positions: positions of samples in the data
+        :type positions: numpy.array
+        :return: batches of embedded text matrices for these samples, without labels
+        :rtype: iterator over [numpy.array, numpy.array]
+        """
+        for batch_data in self._batches(positions):
+            yield self._embed_batch_exclusively(batch_data)[0]
+
+    def _batches(self, positions=None):
         """
         Partition the data into consecutive data sets of the specified batch size.
 
+        :param positions: positions of the samples to partition in the order to partition them or None for all the data
+        :type positions: sequence of int or None
         :return: batched data
         :rtype: DataFrame iterator
         """
-        t1 = partition_all(self.batch_size, self.data[text_1])
-        t2 = partition_all(self.batch_size, self.data[text_2])
+        if self._indexed:
+            for rows in partition_all(self.batch_size, range(len(self)) if positions is None else positions):
+                batch = self.data.batch(rows)
+                if self.targets is not None:
+                    batch[_target_row] = list(rows)
+                yield batch
+            return
+        columns = [text_1, text_2]
+        values = [self.data[text_1], self.data[text_2]]
         if self._labeled:
-            l = partition_all(self.batch_size, self.data[label].cat.codes)
-            batches = zip(t1, t2, l)
-        else:
-            batches = zip(t1, t2)
-        for batch in batches:
-            if self._labeled:
-                columns = [text_1, text_2, label]
-            else:
-                columns = [text_1, text_2]
+            columns.append(label)
+            values.append(self.data[label].cat.codes)
+        if self.targets is not None:
+            columns.append(_target_row)
+            values.append(np.arange(len(self)))
+        if self._weighted:
+            columns.append(weight)
+            values.append(self.data[weight])
+        if positions is not None:
+            values = [np.asarray(v)[positions] for v in values]
+        for batch in zip(*(partition_all(self.batch_size, v) for v in values)):
             yield DataFrame(dict(zip(columns, batch)), columns=columns)
 
+    def _embed_batch_exclusively(self, batch_data):
+        with self._embedding_lock:
+            return self._embed_batch(batch_data)
+
     def _embed_batch(self, batch_data):
         batch = [self._embed_text_set(batch_data[text_1]), self._embed_text_set(batch_data[text_2])]
-        if self._labeled:
-            batch = (batch, batch_data[label])
-        return batch
+        if self.targets is not None:
+            labels = self._target_values[batch_data[_target_row].values]
+        elif self._labeled:
+            labels = batch_data[label]
+        else:
+            return batch
+        if self._weighted:
+            return batch, labels, batch_data[weight]
+        return batch, labels
 
     def _embed_text_set(self, text_set):
+        drop = self.truncation.drop
+        if self._tokenized:
+            text_embeddings = (self.embedder.embed_tokens(self.embedder.filter_tokens(tokens, drop))
+                               for tokens in text_set)
+        else:
+            text_embeddings = self.embedder.embed(text_set, drop)
         embeddings = []
-        for parsed_text in parse_texts(text_set):
-            embeddings.append(self._pad(np.array([token.vector for token in parsed_text])))
+        for text_embedding in text_embeddings:
+            embeddings.append(self._pad(text_embedding))
         return np.stack(embeddings)
 
     def _pad(self, text_embedding):
         m = max(self.maximum_tokens - text_embedding.shape[0], 0)
-        uniform_length_document_embedding = np.pad(text_embedding[:self.maximum_tokens], ((m, 0), (0, 0)), "constant")
+        text_embedding = self.truncation.truncate(text_embedding, self.maximum_tokens)
+        uniform_length_document_embedding = np.pad(text_embedding, ((m, 0), (0, 0)), "constant")
         return uniform_length_document_embedding
 
     @property
@@ -119,13 +441,30 @@ class TextPairEmbeddingGenerator(object):
         :return: the classes used to label the data or None is the data is unlabeled
         :rtype: list or None
         """
-        if self._labeled:
+        if self.targets is not None:
+            return list(self.targets.columns)
+        if self._labeled and (self._indexed or self._sharded):
+            return self.data.classes
+        elif self._labeled:
             return list(self.data[label].cat.categories)
         else:
             return None
 
 
-def cross_validation_partitions(data, fraction, k):
+# Generator whose batches are embedded by a forked worker process, set when the worker starts.
+_worker_generator = None
+
+
+def _start_embedding_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+
+def _embed_batch_in_worker(batch_data):
+    return _worker_generator._embed_batch(batch_data)
+
+
+def cross_validation_partitions(data, fraction, k, seed=None):
     """
     Partition data into cross-validation sets.
 
@@ -135,14 +474,17 @@ def cross_validation_partitions(data, fraction, k):
     :type fraction: float
     :param k: number of cross-validation splits
     :type k: int
+    :param seed: seed for the random shuffling of the data or None to seed it randomly
+    :type seed: int or None
     :return: tuples of (training data, validation data) for each split
     :rtype: list(tuple(pandas.DateFrame, pandas.DateFrame))
     """
     logger.info("Cross validation %0.2f, %d partitions" % (fraction, k))
     n = int(fraction * len(data))
     partitions = []
+    random_state = np.random.RandomState(seed)
     for i in range(k):
-        data = data.sample(frac=1)
+        data = data.sample(frac=1, random_state=random_state)
         train = data[:n]
         validate = data[n:]
         partitions.append((train, validate))
@@ -150,13 +492,18 @@ def cross_validation_partitions(data, fraction, k):
 
 
 def data_file(filename, n=None, index=None, text_1_name=None, text_2_name=None, label_name=None,
-              invalid_labels=None, comma_delimited=True):
+              invalid_labels=None, comma_delimited=True, duplicates=None, near_duplicates=None):
     """
     Load a data file and put it in the format expected by the classifier.
 
     A data file is a CSV file. Any rows with null values in the columns of interest or with optional invalid label
     values are dropped. The file may optionally be clipped to a specified length.
 
+    Duplicate text pairs may optionally be collapsed into single weighted samples with deduplicate.
+
+    A data file may also be a directory written by compile_dataset or index_dataset, in which case all the loading
+    options but the length were applied when it was written.
+
     Rename columns in an input data frame to the ones bisemantic expects. Drop unused columns. If an argument is not
     None the corresponding column must already be in the raw data.
 
@@ -176,10 +523,60 @@ def data_file(filename, n=None, index=None, text_1_name=None, text_2_name=None,
     :type invalid_labels: list of str
     :param comma_delimited: is the data file comma-delimited?
     :type comma_delimited: bool
+    :param duplicates: None to keep duplicates, "exact" to collapse identical pairs, or "symmetric" to also collapse
+        pairs that are identical when their texts are swapped
+    :type duplicates: str or None
+    :param near_duplicates: if not None, also collapse pairs whose estimated Jaccard similarity is at least this
+    :type near_duplicates: float or None
     :return: data frame of the desired size containing just the needed columns
-    :rtype: pandas.DataFrame
+    :rtype: pandas.DataFrame or CompiledDataset
     """
+    if os.path.isdir(filename):
+        if duplicates is not None or near_duplicates is not None:
+            raise ValueError("Compiled data sets and indexes cannot be deduplicated")
+        if IndexedDataset.read_metadata(filename) is not None:
+            return IndexedDataset(filename).head(n)
+        if not os.path.isfile(os.path.join(filename, "dataset.json")):
+            raise ValueError("%s is not a compiled data set or an index" % filename)
+        return CompiledDataset(filename).head(n)
     data = load_data_file(filename, index, comma_delimited).head(n)
+    data = _clean_data(data, filename, text_1_name, text_2_name, label_name, invalid_labels)
+    if duplicates is not None or near_duplicates is not None:
+        data = deduplicate(data, duplicates == "symmetric", near_duplicates)
+    return data
+
+
+def data_file_chunks(filename, chunk_size, n=None, index=None, text_1_name=None, text_2_name=None, label_name=None,
+                     invalid_labels=None, comma_delimited=True):
+    """
+    Load a data file a chunk at a time, so that memory use does not depend on the size of the file.
+
+    The arguments are the same as those of data_file. Each chunk is cleaned in the same way.
+
+    :param chunk_size: number of rows of the file per chunk
+    :type chunk_size: int
+    :return: chunks of the data
+    :rtype: iterator over pandas.DataFrame or CompiledDataset
+    """
+    if os.path.isdir(filename):
+        data = CompiledDataset(filename).head(n)
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+        return
+    if comma_delimited:
+        chunks = pd.read_csv(filename, index_col=index, chunksize=chunk_size)
+    else:
+        chunks = pd.read_csv(filename, index_col=index, sep=None, engine="python", chunksize=chunk_size)
+    for chunk in chunks:
+        if n is not None:
+            if n <= 0:
+                break
+            chunk = chunk.head(n)
+            n -= len(chunk)
+        yield _clean_data(chunk, filename, text_1_name, text_2_name, label_name, invalid_labels)
+
+
+def _clean_data(data, filename, text_1_name, text_2_name, label_name, invalid_labels):
     data = fix_columns(data, text_1_name, text_2_name, label_name)
     m = len(data)
     data = data.dropna()
@@ -191,6 +588,149 @@ def data_file(filename, n=None, index=None, text_1_name=None, text_2_name=None,
     return data
 
 
+def deduplicate(data, symmetric=False, near_duplicates=None, seed=0):
+    """
+    Collapse duplicate text pairs into single samples weighted by the number of pairs they replace.
+
+    Pairs are exact duplicates if their texts and labels are identical, which is determined by hashing them. If
+    symmetric is True the texts of each pair are put in a canonical order first, so that (a, b) and (b, a) are
+    duplicates. Pairs are near duplicates if they have the same label and the estimated Jaccard similarity between
+    their sets of lower-cased tokens is at least a threshold. This is found with MinHash signatures and
+    locality-sensitive hashing, so no pairs of samples are compared exhaustively.
+
+    The first sample in each set of duplicates is kept. The weight column of the result holds the total weight of the
+    samples it replaces, so that weighting the samples preserves the label distribution of the original data.
+
+    :param data: text pairs, optionally with labels and weights
+    :type data: pandas.DataFrame
+    :param symmetric: are pairs duplicates regardless of the order of their texts?
+    :type symmetric: bool
+    :param near_duplicates: Jaccard similarity threshold for near duplicates or None to only collapse exact duplicates
+    :type near_duplicates: float or None
+    :param seed: seed for the MinHash permutations
+    :type seed: int
+    :return: the deduplicated data with a weight column
+    :rtype: pandas.DataFrame
+    """
+    n = len(data)
+    weights = data[weight].values if weight in data.columns else np.ones(n)
+    first, second = data[text_1].values, data[text_2].values
+    if symmetric:
+        swap = np.asarray(first > second, dtype=bool)
+        first, second = np.where(swap, second, first), np.where(swap, first, second)
+    keys = {text_1: first, text_2: second}
+    if label in data.columns:
+        keys[label] = data[label].values
+    groups = pd.factorize(pd.util.hash_pandas_object(DataFrame(keys), index=False).values)[0]
+    logger.info("%d exact duplicates" % (n - (groups.max() + 1 if n else 0)))
+    if near_duplicates is not None:
+        labels = keys.get(label, np.zeros(n))
+        groups = _near_duplicate_groups(groups, first, second, labels, near_duplicates, seed)
+    kept = ~pd.Series(groups).duplicated().values
+    totals = np.bincount(groups, weights=weights)
+    data = data[kept].copy()
+    data[weight] = totals[groups[kept]]
+    logger.info("Collapsed %d samples into %d" % (n, len(data)))
+    return data
+
+
+def _near_duplicate_groups(groups, first, second, labels, threshold, seed, bands=16, rows=4):
+    """
+    Merge groups of samples that contain near duplicates.
+
+    Locality-sensitive hashing puts samples whose MinHash signatures agree in all the rows of any band in the same
+    bucket. Each sample in a bucket is compared with the first one, and merged with it if the fraction of agreeing
+    signature values, which estimates the Jaccard similarity, is at least the threshold. Only samples with the same
+    label are put in the same bucket.
+
+    :return: group number of each sample
+    :rtype: numpy.array
+    """
+    representatives = np.flatnonzero(~pd.Series(groups).duplicated().values)
+    token_sets = (["1:" + token for token in tokenize(first[i].lower())] +
+                  ["2:" + token for token in tokenize(second[i].lower())] for i in representatives)
+    signatures = minhash_signatures(token_sets, len(representatives), bands * rows, seed)
+    # Union-find over the representatives.
+    parents = np.arange(len(representatives))
+
+    def root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    positions = np.arange(len(representatives))
+    band_labels = labels[representatives]
+    for band in range(bands):
+        columns = {str(j): signatures[:, band * rows + j] for j in range(rows)}
+        columns[label] = band_labels
+        buckets = pd.factorize(pd.util.hash_pandas_object(DataFrame(columns), index=False).values)[0]
+        _, leaders = np.unique(buckets, return_index=True)
+        leaders = leaders[buckets]
+        similarity = (signatures == signatures[leaders]).mean(axis=1)
+        for i in np.flatnonzero((leaders != positions) & (similarity >= threshold)):
+            parents[root(i)] = root(leaders[i])
+    near_duplicates = np.array([root(i) for i in positions], dtype=int)
+    logger.info("%d near duplicates" % (len(representatives) - len(np.unique(near_duplicates))))
+    # Map every sample to the component of the representative of its exact duplicate group.
+    return pd.factorize(near_duplicates[groups])[0]
+
+
+# A prime just below 2^32, so that MinHash values fit in 32 bits.
+_minhash_prime = 4294967291
+
+
+def minhash_signatures(token_sets, n, permutations, seed=0):
+    """
+    :param token_sets: sets of tokens
+    :type token_sets: iterable of sequences of str
+    :param n: number of sets
+    :type n: int
+    :param permutations: number of hash permutations, which is the length of each signature
+    :type permutations: int
+    :param seed: seed for the permutations, which must be the same for signatures that are compared
+    :type seed: int
+    :return: matrix of size (n, permutations) containing the MinHash signature of each set
+    :rtype: numpy.array
+    """
+    random_state = np.random.RandomState(seed)
+    a = random_state.randint(1, _minhash_prime, size=permutations).astype(np.uint64)
+    b = random_state.randint(0, _minhash_prime, size=permutations).astype(np.uint64)
+    # The empty set has the largest possible signature.
+    signatures = np.full((n, permutations), _minhash_prime - 1, dtype=np.uint32)
+    for i, tokens in enumerate(token_sets):
+        if tokens:
+            hashes = pd.util.hash_array(np.array(tokens, dtype=object)) & np.uint64(0xffffffff)
+            signatures[i] = ((np.outer(hashes, a) + b) % np.uint64(_minhash_prime)).min(axis=0)
+    return signatures
+
+
+def text_file(filename, n=None, index=None, text_name="text", comma_delimited=True):
+    """
+    Load a file of single texts, such as a corpus to search for pairs.
+
+    :param filename: name of data file
+    :type filename: str
+    :param n: number of texts to use, or None to use all of them
+    :type n: int or None
+    :param index: optional name of the index column
+    :type index: str or None
+    :param text_name: name of the column containing the text
+    :type text_name: str
+    :param comma_delimited: is the data file comma-delimited?
+    :type comma_delimited: bool
+    :return: the texts
+    :rtype: pandas.Series
+    """
+    data = load_data_file(filename, index, comma_delimited)
+    if text_name not in data.columns:
+        raise ValueError("Missing column %s" % text_name)
+    texts = data[text_name].dropna().astype(str)
+    if n is not None:
+        texts = texts.head(n)
+    return texts
+
+
 def load_data_file(filename, index=None, comma_delimited=True):
     """
     Load a CSV data file.
@@ -240,41 +780,651 @@ def fix_columns(data, text_1_name=None, text_2_name=None, label_name=None):
     return data[columns]
 
 
-def parse_texts(texts):
+class CompiledDataset(object):
     """
-    Create a set of parsed documents from a set of texts.
+    Text pairs that have already been loaded, cleaned, and tokenized by compile_dataset, memory-mapped from the
+    directory it wrote.
 
-    Parsed documents are sequences of tokens whose embedding vectors can be looked up.
+    The directory contains the vocabulary, the concatenated token IDs of each text column with the offsets at which each
+    text starts, the label codes and their classes, and the original index.
 
-    :param texts: text documents to parse
-    :type texts: sequence of strings
-    :return: parsed documents
-    :rtype: sequence of spacy.Doc
+    This supports enough of the DataFrame interface to be used in place of a data frame by TextPairEmbeddingGenerator,
+    cross_validation_partitions, and the classifier. Slicing and sampling return views that share the memory-mapped
+    arrays.
     """
-    return _load_text_parser().pipe(texts)
 
+    # The batches contain tokens rather than text.
+    tokenized = True
 
-def embedding_size():
-    return _load_text_parser().vocab.vectors_length
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "dataset.json")) as f:
+            metadata = json.load(f)
+        self.classes = metadata["classes"]
+        self.embedder = metadata["embedder"]
+        with open(os.path.join(directory, "vocabulary.json"), encoding="utf-8") as f:
+            self.vocabulary = np.array(json.load(f), dtype=object)
+        self._tokens = {}
+        self._offsets = {}
+        for column in [text_1, text_2]:
+            self._tokens[column] = np.load(os.path.join(directory, "%s.tokens.npy" % column), mmap_mode="r")
+            self._offsets[column] = np.load(os.path.join(directory, "%s.offsets.npy" % column), mmap_mode="r")
+        if self.classes is not None:
+            self._labels = np.load(os.path.join(directory, "labels.npy"), mmap_mode="r")
+            self.columns = [text_1, text_2, label]
+        else:
+            self._labels = None
+            self.columns = [text_1, text_2]
+        self._index = pd.Index(pd.read_csv(os.path.join(directory, "index.csv")).iloc[:, 0])
+        self.rows = np.arange(metadata["samples"])
 
+    def __repr__(self):
+        return "%s(%s, %d samples)" % (self.__class__.__name__, self.directory, len(self))
 
-def text_parser_info():
-    _load_text_parser()
-    return _text_parser_description()
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __getitem__(self, rows):
+        return self._view(self.rows[rows])
+
+    @property
+    def iloc(self):
+        return self
+
+    @property
+    def index(self):
+        return self._index[self.rows]
+
+    def head(self, n=None):
+        return self[:n]
 
+    def sample(self, frac=1, random_state=None):
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        rows = random_state.permutation(self.rows)
+        return self._view(rows[:int(round(frac * len(rows)))])
 
-# Singleton instance of text tokenizer and embedder.
-text_parser = None
+    @property
+    def labels(self):
+        """
+        :return: the label of each sample
+        :rtype: pandas.Categorical
+        """
+        return pd.Categorical.from_codes(self._labels[self.rows], self.classes)
+
+    def lengths(self, column):
+        """
+        :param column: text column
+        :type column: str
+        :return: the number of tokens in each text in the column
+        :rtype: numpy.array
+        """
+        offsets = self._offsets[column]
+        return offsets[self.rows + 1] - offsets[self.rows]
 
+    def batch(self, positions):
+        """
+        :param positions: positions of samples in this data set
+        :type positions: sequence of int
+        :return: data frame with the tokens of the texts and the label codes of the samples
+        :rtype: pandas.DataFrame
+        """
+        rows = self.rows[list(positions)]
+        batch = {column: [self._text_tokens(column, row) for row in rows] for column in [text_1, text_2]}
+        if self._labels is not None:
+            batch[label] = self._labels[rows]
+        return DataFrame(batch, columns=self.columns)
 
-def _load_text_parser():
-    global text_parser
-    if text_parser is None:
-        text_parser = spacy.load("en", tagger=None, parser=None, entity=None)
-        logger.info(_text_parser_description())
-    return text_parser
+    def _text_tokens(self, column, row):
+        offsets = self._offsets[column]
+        return list(self.vocabulary[self._tokens[column][offsets[row]:offsets[row + 1]]])
 
+    def _view(self, rows):
+        view = copy.copy(self)
+        view.rows = rows
+        return view
+
+
+class IndexedDataset(CompiledDataset):
+    """
+    Text pairs that have been loaded and cleaned, memory-mapped from an index written by index_dataset.
+
+    The index is a directory containing the UTF-8 encoded texts of each text column concatenated with the offsets at
+    which each text starts, the number of tokens in each text, the label codes and their classes, any sample weights,
+    and the original index. Any set of samples can be read in time proportional to its size, so batches can be drawn in
+    any order without going through the data, and an index is loaded without reading the data at all.
+
+    Unlike a compiled data set, this holds the texts themselves, so it can be embedded by any embedder. The numbers of
+    tokens are those found by the embedder that built the index.
+    """
+
+    tokenized = False
+
+    def __init__(self, directory):
+        self.directory = directory
+        metadata = self.read_metadata(directory)
+        self.key = metadata["key"]
+        self.classes = metadata["classes"]
+        self.embedder = metadata["embedder"]
+        self._texts = {}
+        self._offsets = {}
+        self._lengths = {}
+        for column in [text_1, text_2]:
+            self._texts[column] = np.load(os.path.join(directory, "%s.text.npy" % column), mmap_mode="r")
+            self._offsets[column] = np.load(os.path.join(directory, "%s.offsets.npy" % column), mmap_mode="r")
+            self._lengths[column] = np.load(os.path.join(directory, "%s.lengths.npy" % column), mmap_mode="r")
+        self.columns = [text_1, text_2]
+        self._labels = self._weights = None
+        if self.classes is not None:
+            self._labels = np.load(os.path.join(directory, "labels.npy"), mmap_mode="r")
+            self.columns.append(label)
+        if metadata["weighted"]:
+            self._weights = np.load(os.path.join(directory, "weights.npy"), mmap_mode="r")
+            self.columns.append(weight)
+        # The original index is only read if it is used.
+        self._index = None
+        self.rows = np.arange(metadata["samples"])
+
+    def __getitem__(self, rows):
+        # A column name selects a text column, as it does in a data frame.
+        if isinstance(rows, str):
+            return self.texts(rows)
+        return super().__getitem__(rows)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = pd.Index(pd.read_csv(os.path.join(self.directory, "index.csv")).iloc[:, 0])
+        return self._index[self.rows]
+
+    @staticmethod
+    def read_metadata(directory):
+        """
+        :param directory: index directory
+        :type directory: str
+        :return: the contents of the index's metadata file or None if there is no index
+        :rtype: dict or None
+        """
+        filename = os.path.join(directory, "index.json")
+        if not os.path.isfile(filename):
+            return None
+        with open(filename) as f:
+            return json.load(f)
+
+    def lengths(self, column):
+        """
+        :param column: text column
+        :type column: str
+        :return: the number of tokens in each text in the column
+        :rtype: numpy.array
+        """
+        return self._lengths[column][self.rows]
+
+    def texts(self, column):
+        """
+        :param column: text column
+        :type column: str
+        :return: the texts in the column
+        :rtype: pandas.Series
+        """
+        return pd.Series([self._text(column, row) for row in self.rows], index=self.index, name=column)
+
+    def batch(self, positions):
+        """
+        :param positions: positions of samples in this data set
+        :type positions: sequence of int
+        :return: data frame with the texts, the label codes, and the weights of the samples
+        :rtype: pandas.DataFrame
+        """
+        rows = self.rows[list(positions)]
+        batch = {column: [self._text(column, row) for row in rows] for column in [text_1, text_2]}
+        if self._labels is not None:
+            batch[label] = self._labels[rows]
+        if self._weights is not None:
+            batch[weight] = self._weights[rows]
+        return DataFrame(batch, columns=self.columns)
+
+    def _text(self, column, row):
+        offsets = self._offsets[column]
+        return self._texts[column][offsets[row]:offsets[row + 1]].tobytes().decode("utf-8")
+
+
+class ShardedDataset(object):
+    """
+    Text pairs in many data files that are read a chunk at a time, so that memory use does not depend on the total size
+    of the data.
+
+    The shards are either the files in a directory or the files matching a glob pattern. They are pre-scanned once to
+    count their samples and labels. The counts are stored in a SHARD.meta.json file next to each shard and reused as
+    long as the shard and the loading options are unchanged. The classes are the labels found by this scan unless they
+    are specified explicitly, in which case samples with other labels are skipped.
+
+    Each pass through the data opens a few shards at a time in a random order, interleaves their chunks, and draws
+    samples at random from a buffer of a fixed number of rows. Passes are seeded, so the same pass always returns the
+    samples in the same order.
+
+    This supports enough of the DataFrame interface to be used in place of a data frame by TextPairEmbeddingGenerator
+    for training.
+    """
+
+    def __init__(self, shards, classes=None, shuffle_buffer=100000, index=None, text_1_name=None, text_2_name=None,
+                 label_name=None, invalid_labels=None, comma_delimited=True, seed=0, interleave=4, chunk_size=10000):
+        """
+        :param shards: directory of data files or glob pattern matching them
+        :type shards: str
+        :param classes: the labels to train on or None to use every label in the data
+        :type classes: list or None
+        :param shuffle_buffer: number of rows from which samples are drawn at random
+        :type shuffle_buffer: int
+        :param index: optional name of the index column
+        :type index: str or None
+        :param text_1_name: name of column in data that should be mapped to text1
+        :type text_1_name: str or None
+        :param text_2_name: name of column in data that should be mapped to text2
+        :type text_2_name: str or None
+        :param label_name: name of column in data that should be mapped to label
+        :type label_name: str or None
+        :param invalid_labels: disallowed label values
+        :type invalid_labels: list of str
+        :param comma_delimited: are the data files comma-delimited?
+        :type comma_delimited: bool
+        :param seed: random number seed for the order of the samples
+        :type seed: int
+        :param interleave: number of shards read at the same time
+        :type interleave: int
+        :param chunk_size: number of rows read from a shard at a time
+        :type chunk_size: int
+        """
+        self.pattern = shards
+        if os.path.isdir(shards):
+            self.shards = sorted(os.path.join(shards, name) for name in os.listdir(shards)
+                                 if not name.startswith(".") and not name.endswith(_sidecar_suffixes))
+        else:
+            self.shards = sorted(glob.glob(shards))
+        if not self.shards:
+            raise ValueError("No data files in %s" % shards)
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.interleave = interleave
+        self.chunk_size = chunk_size
+        self._options = {"index": index, "text-1-name": text_1_name, "text-2-name": text_2_name,
+                         "label-name": label_name, "invalid-labels": invalid_labels,
+                         "comma-delimited": comma_delimited}
+        metadata = [self._shard_metadata(shard) for shard in self.shards]
+        labeled = all(m["labels"] is not None for m in metadata)
+        if labeled:
+            if classes is None:
+                classes = sorted(set(value for m in metadata for value, _ in m["labels"]))
+            self.classes = list(classes)
+            self.columns = [text_1, text_2, label]
+            names = set(str(c) for c in self.classes)
+            self._samples = sum(n for m in metadata for value, n in m["labels"] if str(value) in names)
+        else:
+            self.classes = None
+            self.columns = [text_1, text_2]
+            self._samples = sum(m["samples"] for m in metadata)
+        # Take every Nth sample starting at the Kth one.
+        self.part = (0, 1)
+
+    def __repr__(self):
+        return "%s(%s, %d shards, %d samples)" % (self.__class__.__name__, self.pattern, len(self.shards), len(self))
+
+    def __len__(self):
+        k, n = self.part
+        return len(range(k, self._samples, n))
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def partition(self, k, n):
+        """
+        :param k: index of the partition
+        :type k: int
+        :param n: number of partitions
+        :type n: int
+        :return: every Nth sample starting at the Kth one
+        :rtype: ShardedDataset
+        """
+        view = copy.copy(self)
+        view.part = (k, n)
+        return view
 
-def _text_parser_description():
-    # This assumes the text parser has already been loaded.
-    return "%s: %s Embedding size %d" % (text_parser.meta["name"], text_parser.meta["description"], embedding_size())
+    def label_codes(self, labels):
+        """
+        :param labels: label values
+        :type labels: pandas.Series
+        :return: the position of each label in the classes, or -1 for labels that are not one of the classes
+        :rtype: numpy.array
+        """
+        codes = {str(name): code for code, name in enumerate(self.classes)}
+        return labels.astype(str).map(codes).fillna(-1).values.astype(int)
+
+    def batches(self, batch_size, epoch=0):
+        """
+        :param batch_size: number of samples per batch
+        :type batch_size: int
+        :param epoch: pass through the data, which determines the order of the samples
+        :type epoch: int
+        :return: data frames with the texts and the label codes of the samples
+        :rtype: iterator over pandas.DataFrame
+        """
+        random_state = np.random.RandomState(self.seed + epoch)
+        shards = [self.shards[i] for i in random_state.permutation(len(self.shards))]
+        pending, size = [], 0
+        for samples in self._shuffled(self._samples_in(shards), random_state):
+            while len(samples):
+                taken = samples.iloc[:batch_size - size]
+                samples = samples.iloc[len(taken):]
+                pending.append(taken)
+                size += len(taken)
+                if size == batch_size:
+                    yield pd.concat(pending)
+                    pending, size = [], 0
+        if pending:
+            yield pd.concat(pending)
+
+    def _samples_in(self, shards):
+        k, n = self.part
+        position = 0
+        for chunk in self._interleaved_chunks(shards):
+            if self.classes is not None:
+                codes = self.label_codes(chunk[label])
+                chunk = DataFrame({text_1: chunk[text_1], text_2: chunk[text_2], label: codes},
+                                  columns=self.columns)[codes >= 0]
+            # All the partitions read the data in the same order, so they get disjoint samples.
+            positions = np.arange(position, position + len(chunk))
+            position += len(chunk)
+            yield chunk[positions % n == k]
+
+    def _interleaved_chunks(self, shards):
+        shards = iter(shards)
+        readers = []
+        while True:
+            while len(readers) < self.interleave:
+                shard = next(shards, None)
+                if shard is None:
+                    break
+                readers.append(self._read(shard))
+            if not readers:
+                return
+            for reader in list(readers):
+                chunk = next(reader, None)
+                if chunk is None:
+                    readers.remove(reader)
+                else:
+                    yield chunk
+
+    def _shuffled(self, chunks, random_state):
+        buffer = DataFrame(columns=self.columns)
+        for chunk in chunks:
+            buffer = pd.concat([buffer, chunk])
+            if len(buffer) > self.shuffle_buffer:
+                buffer = buffer.iloc[random_state.permutation(len(buffer))]
+                excess = len(buffer) - self.shuffle_buffer
+                yield buffer.iloc[:excess]
+                buffer = buffer.iloc[excess:]
+        yield buffer.iloc[random_state.permutation(len(buffer))]
+
+    def _read(self, shard):
+        o = self._options
+        return data_file_chunks(shard, self.chunk_size, None, o["index"], o["text-1-name"], o["text-2-name"],
+                                o["label-name"], o["invalid-labels"], o["comma-delimited"])
+
+    def _shard_metadata(self, shard):
+        """
+        Count the samples and labels in a shard, or read the counts from the shard's metadata file if they were made
+        from the same version of the shard with the same options.
+
+        :param shard: data file
+        :type shard: str
+        :return: the number of samples, and each label and its number of samples or None if the shard is unlabeled
+        :rtype: dict
+        """
+        filename = shard + _metadata_suffix
+        status = os.stat(shard)
+        key = {"size": status.st_size, "modified": status.st_mtime, "options": self._options}
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                metadata = json.load(f)
+            if metadata.get("key") == key:
+                return metadata
+        logger.info("Scan %s" % shard)
+        samples = 0
+        labels = None
+        for chunk in self._read(shard):
+            samples += len(chunk)
+            if label in chunk.columns:
+                labels = labels if labels is not None else {}
+                for value, n in chunk[label].value_counts().items():
+                    value = value.item() if isinstance(value, np.generic) else value
+                    labels[value] = labels.get(value, 0) + int(n)
+        metadata = {"key": key, "samples": samples,
+                    "labels": [[value, n] for value, n in labels.items()] if labels is not None else None}
+        temporary = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            with open(temporary, "w") as f:
+                json.dump(metadata, f, sort_keys=True)
+            os.replace(temporary, filename)
+        except OSError as e:
+            logger.warning("Could not write %s: %s" % (filename, e))
+        return metadata
+
+
+# Files written next to a data file that are not data.
+_metadata_suffix = ".meta.json"
+_index_suffix = ".index"
+_sidecar_suffixes = (_metadata_suffix, _index_suffix)
+
+
+def is_sharded(filename):
+    """
+    :param filename: data file name
+    :type filename: str
+    :return: is this a glob pattern or a directory of data files rather than a data file, a compiled data set, or an
+        index?
+    :rtype: bool
+    """
+    if os.path.isdir(filename):
+        return not any(os.path.isfile(os.path.join(filename, metadata)) for metadata in ["dataset.json", "index.json"])
+    return re.search(r"[*?[]", filename) is not None
+
+
+def compile_dataset(data, directory, embedder=None, workers=None):
+    """
+    Tokenize text pairs once and write them in the format read by CompiledDataset.
+
+    :param data: data frame with text1, text2, and optional label columns
+    :type data: pandas.DataFrame
+    :param directory: directory to create
+    :type directory: str
+    :param embedder: embedder whose tokenizer to use or None to use the default one
+    :type embedder: bisemantic.embedders.Embedder or None
+    :param workers: number of processes used to tokenize text or None to tokenize in this process
+    :type workers: int or None
+    :return: the compiled data
+    :rtype: CompiledDataset
+    """
+    embedder = embedder or load_embedder()
+    os.makedirs(directory)
+    vocabulary = {}
+    pool = None
+    if workers:
+        pool = multiprocessing.get_context("fork").Pool(workers, initializer=_start_tokenizing_worker,
+                                                        initargs=(embedder,))
+    try:
+        for column in [text_1, text_2]:
+            tokens = array("i")
+            offsets = array("q", [0])
+            chunks = partition_all(10000, data[column])
+            if pool is not None:
+                tokenized_chunks = pool.imap(_tokenize_chunk, chunks)
+            else:
+                tokenized_chunks = (embedder.tokenize(chunk) for chunk in chunks)
+            for tokenized_chunk in tokenized_chunks:
+                for text_tokens in tokenized_chunk:
+                    tokens.extend(vocabulary.setdefault(token, len(vocabulary)) for token in text_tokens)
+                    offsets.append(len(tokens))
+            np.save(os.path.join(directory, "%s.tokens.npy" % column), np.frombuffer(tokens, dtype=np.int32))
+            np.save(os.path.join(directory, "%s.offsets.npy" % column), np.frombuffer(offsets, dtype=np.int64))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    # Tokens may contain newlines, so the vocabulary is stored as JSON rather than one token per line.
+    with open(os.path.join(directory, "vocabulary.json"), "w", encoding="utf-8") as f:
+        json.dump(list(vocabulary), f)
+    if label in data.columns:
+        labels = data[label].astype("category")
+        classes = labels.cat.categories.tolist()
+        np.save(os.path.join(directory, "labels.npy"), labels.cat.codes.values.astype(np.int32))
+    else:
+        classes = None
+    pd.DataFrame({data.index.name or "index": data.index}).to_csv(os.path.join(directory, "index.csv"), index=False)
+    with open(os.path.join(directory, "dataset.json"), "w") as f:
+        json.dump({"samples": len(data), "classes": classes, "embedder": embedder.specification}, f,
+                  sort_keys=True, indent=4, separators=(",", ": "))
+    logger.info("Compiled %d samples with %d token types into %s" % (len(data), len(vocabulary), directory))
+    return CompiledDataset(directory)
+
+
+# Embedder used by a forked worker process to tokenize text, set when the worker starts.
+_worker_embedder = None
+
+
+def _start_tokenizing_worker(embedder):
+    global _worker_embedder
+    _worker_embedder = embedder
+
+
+def _tokenize_chunk(texts):
+    return list(_worker_embedder.tokenize(texts))
+
+
+def indexed_data_file(filename, n=None, index=None, text_1_name=None, text_2_name=None, label_name=None,
+                      invalid_labels=None, comma_delimited=True, duplicates=None, near_duplicates=None, embedder=None):
+    """
+    Load a data file like data_file, but through an index of it stored in a DATA.index directory next to the file.
+
+    The first time a file is loaded the index is built from it. After that the index is memory-mapped instead of reading
+    the file, as long as the file, the loading options, and the embedder are unchanged. The whole file is indexed, and
+    the length limit is applied to the indexed samples.
+
+    The arguments are the same as those of data_file.
+
+    :param embedder: embedder that counts the tokens in the texts or None to use the default one
+    :type embedder: bisemantic.embedders.Embedder or None
+    :return: data set of the desired size
+    :rtype: IndexedDataset or CompiledDataset
+    """
+    if os.path.isdir(filename):
+        return data_file(filename, n, index, text_1_name, text_2_name, label_name, invalid_labels, comma_delimited,
+                         duplicates, near_duplicates)
+    embedder = embedder or load_embedder()
+    directory = filename + _index_suffix
+    status = os.stat(filename)
+    key = {"size": status.st_size, "modified": status.st_mtime, "embedder": embedder.specification,
+           "options": {"index": index, "text-1-name": text_1_name, "text-2-name": text_2_name,
+                       "label-name": label_name, "invalid-labels": invalid_labels,
+                       "comma-delimited": comma_delimited, "duplicates": duplicates,
+                       "near-duplicates": near_duplicates}}
+    metadata = IndexedDataset.read_metadata(directory)
+    if metadata is not None and metadata["key"] == key:
+        data = IndexedDataset(directory)
+    else:
+        logger.info("Index %s" % filename)
+        data = data_file(filename, None, index, text_1_name, text_2_name, label_name, invalid_labels, comma_delimited,
+                         duplicates, near_duplicates)
+        data = index_dataset(data, directory, embedder, key)
+    return data.head(n)
+
+
+def index_dataset(data, directory, embedder=None, key=None):
+    """
+    Write an index of text pairs in the format read by IndexedDataset, replacing any index already in the directory.
+
+    :param data: data frame with text1, text2, and optional label and weight columns
+    :type data: pandas.DataFrame
+    :param directory: index directory
+    :type directory: str
+    :param embedder: embedder that counts the tokens in the texts or None to use the default one
+    :type embedder: bisemantic.embedders.Embedder or None
+    :param key: description of the data that was indexed, which is stored in the index
+    :type key: dict or None
+    :return: the indexed data
+    :rtype: IndexedDataset
+    """
+    embedder = embedder or load_embedder()
+    # Build the index alongside the directory and move it into place so that readers never see part of one.
+    temporary = "%s.%d.tmp" % (directory, os.getpid())
+    os.makedirs(temporary)
+    try:
+        for column in [text_1, text_2]:
+            text = bytearray()
+            offsets = array("q", [0])
+            for value in data[column]:
+                text.extend(value.encode("utf-8"))
+                offsets.append(len(text))
+            lengths = np.fromiter((len(tokens) for tokens in embedder.tokenize(data[column])), np.int32, len(data))
+            np.save(os.path.join(temporary, "%s.text.npy" % column), np.frombuffer(text, dtype=np.uint8))
+            np.save(os.path.join(temporary, "%s.offsets.npy" % column), np.frombuffer(offsets, dtype=np.int64))
+            np.save(os.path.join(temporary, "%s.lengths.npy" % column), lengths)
+        if label in data.columns:
+            labels = data[label].astype("category")
+            classes = labels.cat.categories.tolist()
+            np.save(os.path.join(temporary, "labels.npy"), labels.cat.codes.values.astype(np.int32))
+        else:
+            classes = None
+        weighted = weight in data.columns
+        if weighted:
+            np.save(os.path.join(temporary, "weights.npy"), data[weight].values.astype(np.float64))
+        pd.DataFrame({data.index.name or "index": data.index}).to_csv(os.path.join(temporary, "index.csv"),
+                                                                      index=False)
+        with open(os.path.join(temporary, "index.json"), "w") as f:
+            json.dump({"key": key, "samples": len(data), "classes": classes, "weighted": weighted,
+                       "embedder": embedder.specification}, f, sort_keys=True, indent=4, separators=(",", ": "))
+        _install_index(temporary, directory, key)
+    except BaseException:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise
+    logger.info("Indexed %d samples into %s" % (len(data), directory))
+    return IndexedDataset(directory)
+
+
+def _install_index(temporary, directory, key):
+    """
+    Move a newly built index into place.
+
+    Other processes may be building the same index at the same time. An index with the same key that one of them
+    installed first is kept and this one is discarded. A stale index is renamed out of the way before it is deleted, so
+    that two processes never delete and replace the same directory at once.
+
+    :param temporary: directory containing the new index
+    :type temporary: str
+    :param directory: index directory
+    :type directory: str
+    :param key: description of the data that was indexed
+    :type key: dict or None
+    """
+    def installed():
+        metadata = IndexedDataset.read_metadata(directory)
+        return metadata is not None and metadata["key"] == key
+
+    if installed():
+        shutil.rmtree(temporary)
+        return
+    if os.path.isdir(directory):
+        stale = "%s.%d.old" % (directory, os.getpid())
+        try:
+            os.rename(directory, stale)
+        except FileNotFoundError:
+            pass
+        else:
+            shutil.rmtree(stale, ignore_errors=True)
+    try:
+        os.rename(temporary, directory)
+    except OSError:
+        if not installed():
+            raise
+        shutil.rmtree(temporary)
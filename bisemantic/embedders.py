@@ -0,0 +1,527 @@
+"""
+Tokenize text and map the tokens to embedding vectors.
+"""
+import json
+import os
+import re
+from abc import ABC, abstractmethod
+from functools import lru_cache
+
+import numpy as np
+
+from bisemantic import logger
+
+default_embedder = "spacy:en"
+
+
+class Embedder(ABC):
+    """
+    Splits text into tokens and looks up an embedding vector for each token.
+
+    An embedder is identified by a specification string of the form KIND:ARGUMENT. The specification is stored in the
+    model directory so that a model is always used with the embedder it was trained with.
+
+    Subclasses must implement embedding_size, tokenize, and embed_tokens.
+    """
+    kind = None
+
+    def __init__(self, argument):
+        self.argument = argument
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.specification)
+
+    @property
+    def specification(self):
+        return "%s:%s" % (self.kind, self.argument)
+
+    @property
+    @abstractmethod
+    def embedding_size(self):
+        pass
+
+    @property
+    def description(self):
+        return "%s Embedding size %d" % (self.specification, self.embedding_size)
+
+    @abstractmethod
+    def tokenize(self, texts):
+        """
+        :param texts: text documents to tokenize
+        :type texts: sequence of str
+        :return: the tokens in each document
+        :rtype: iterator over lists of str
+        """
+        pass
+
+    def frequent_words(self, n):
+        """
+        Embedders without a vocabulary ranked by frequency return no words.
+
+        :param n: number of words
+        :type n: int
+        :return: the n most frequent words that have vectors
+        :rtype: list of str
+        """
+        return []
+
+    @abstractmethod
+    def embed_tokens(self, tokens):
+        """
+        :param tokens: tokens of a single document
+        :type tokens: list of str
+        :return: matrix of size (number of tokens, embedding size)
+        :rtype: numpy.array
+        """
+        pass
+
+    def embed(self, texts, drop=()):
+        """
+        :param texts: text documents to embed
+        :type texts: sequence of str
+        :param drop: kinds of tokens to leave out, "stopwords" or "punctuation"
+        :type drop: collection of str
+        :return: a matrix of size (number of tokens, embedding size) for each document
+        :rtype: iterator over numpy.array
+        """
+        for tokens in self.tokenize(texts):
+            yield self.embed_tokens(self.filter_tokens(tokens, drop))
+
+    def filter_tokens(self, tokens, drop):
+        """
+        :param tokens: tokens of a single document
+        :type tokens: list of str
+        :param drop: kinds of tokens to leave out, "stopwords" or "punctuation"
+        :type drop: collection of str
+        :return: the tokens that are not of the kinds to leave out
+        :rtype: list of str
+        """
+        if not drop:
+            return tokens
+        stopwords = "stopwords" in drop
+        punctuation = "punctuation" in drop
+        return [token for token in tokens
+                if not (stopwords and self.is_stopword(token) or punctuation and self.is_punctuation(token))]
+
+    def is_stopword(self, token):
+        return token.lower() in stopwords()
+
+    def is_punctuation(self, token):
+        return _punctuation_pattern.fullmatch(token) is not None
+
+    def _stack(self, vectors):
+        if vectors:
+            return np.stack(vectors)
+        else:
+            return np.zeros((0, self.embedding_size), dtype=np.float32)
+
+
+class SpacyEmbedder(Embedder):
+    """
+    Tokenize and embed with a spaCy language model.
+    """
+    kind = "spacy"
+
+    def __init__(self, name):
+        import spacy
+        super().__init__(name)
+        self.text_parser = spacy.load(name, tagger=None, parser=None, entity=None)
+
+    @property
+    def embedding_size(self):
+        return self.text_parser.vocab.vectors_length
+
+    @property
+    def description(self):
+        return "%s: %s Embedding size %d" % \
+               (self.text_parser.meta["name"], self.text_parser.meta["description"], self.embedding_size)
+
+    def tokenize(self, texts):
+        for document in self.text_parser.pipe(texts):
+            yield [token.orth_ for token in document]
+
+    def frequent_words(self, n):
+        lexemes = sorted((lexeme for lexeme in self.text_parser.vocab if lexeme.has_vector),
+                         key=lambda lexeme: lexeme.prob, reverse=True)
+        return [lexeme.orth_ for lexeme in lexemes[:n]]
+
+    def embed_tokens(self, tokens):
+        return self._stack([self.text_parser.vocab[token].vector for token in tokens])
+
+    def embed(self, texts, drop=()):
+        # Take the vectors straight from the parsed documents instead of looking the tokens up again.
+        stopwords = "stopwords" in drop
+        punctuation = "punctuation" in drop
+        for document in self.text_parser.pipe(texts):
+            yield self._stack([token.vector for token in document
+                               if not (stopwords and token.is_stop or punctuation and token.is_punct)])
+
+    # Stop words and punctuation are lexeme attributes, so these do not require parsing.
+    def is_stopword(self, token):
+        return self.text_parser.vocab[token].is_stop
+
+    def is_punctuation(self, token):
+        return self.text_parser.vocab[token].is_punct
+
+
+# Words and punctuation marks.
+_token_pattern = re.compile(r"\w+|[^\w\s]")
+_punctuation_pattern = re.compile(r"[^\w\s]+")
+
+
+class RegexTokenizerEmbedder(Embedder):
+    """
+    Base class for embedders that use a fast regular expression tokenizer instead of a language model.
+    """
+
+    def tokenize(self, texts):
+        for text in texts:
+            yield tokenize(text)
+
+
+def tokenize(text):
+    return _token_pattern.findall(text)
+
+
+@lru_cache()
+def stopwords():
+    """
+    :return: spaCy's English stop words
+    :rtype: set of str
+    """
+    try:
+        from spacy.lang.en.stop_words import STOP_WORDS
+    except ImportError:
+        # spaCy 1
+        from spacy.en.language_data import STOP_WORDS
+    return STOP_WORDS
+
+
+class Truncation(object):
+    """
+    How to fit a text into a maximum number of tokens.
+
+    Stop words, punctuation, or both may be dropped first. The text is then truncated to its first tokens, its last
+    tokens, or its first and last tokens with half of the maximum taken from each end, which keeps the end of a long
+    question where the question itself usually is.
+
+    A truncation is identified by a specification string of the form STRATEGY or STRATEGY:DROP,... that is stored in
+    the model directory, so that predictions are made from the same tokens as training.
+    """
+    strategies = ["head", "tail", "head-tail"]
+    droppable = ["punctuation", "stopwords"]
+
+    def __init__(self, strategy="head", drop=()):
+        """
+        :param strategy: "head", "tail", or "head-tail"
+        :type strategy: str
+        :param drop: kinds of tokens to drop before truncating, "stopwords" or "punctuation"
+        :type drop: collection of str
+        """
+        if strategy not in self.strategies:
+            raise ValueError("Invalid truncation %s. It must be one of %s" % (strategy, ", ".join(self.strategies)))
+        invalid = set(drop) - set(self.droppable)
+        if invalid:
+            raise ValueError("Invalid tokens to drop %s. They must be in %s" %
+                             (", ".join(sorted(invalid)), ", ".join(self.droppable)))
+        self.strategy = strategy
+        self.drop = tuple(sorted(set(drop)))
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.specification)
+
+    def __eq__(self, other):
+        return isinstance(other, Truncation) and self.specification == other.specification
+
+    @property
+    def specification(self):
+        if self.drop:
+            return "%s:%s" % (self.strategy, ",".join(self.drop))
+        return self.strategy
+
+    @classmethod
+    def from_specification(cls, specification=None):
+        """
+        :param specification: truncation specification or None for the default of keeping the first tokens
+        :type specification: str or None
+        :return: the truncation
+        :rtype: Truncation
+        """
+        if specification is None:
+            return cls()
+        strategy, _, drop = specification.partition(":")
+        return cls(strategy, [d for d in drop.split(",") if d])
+
+    def truncate(self, embedding, maximum_tokens):
+        """
+        :param embedding: matrix of size (number of tokens, embedding size)
+        :type embedding: numpy.array
+        :param maximum_tokens: maximum number of tokens
+        :type maximum_tokens: int
+        :return: at most maximum tokens rows of the embedding
+        :rtype: numpy.array
+        """
+        n = len(embedding)
+        if n <= maximum_tokens:
+            return embedding
+        if self.strategy == "head":
+            return embedding[:maximum_tokens]
+        if self.strategy == "tail":
+            return embedding[n - maximum_tokens:]
+        head = (maximum_tokens + 1) // 2
+        return np.concatenate([embedding[:head], embedding[n - (maximum_tokens - head):]])
+
+
+class VectorsFileEmbedder(RegexTokenizerEmbedder):
+    """
+    Look up tokens in a precomputed vectors table, for example one exported from word2vec or fastText.
+
+    The argument is a directory containing a vectors.npy matrix and a vocabulary.json file with a list of the
+    corresponding words. Directories written by earlier versions have a vocabulary.txt file with a word on each line
+    instead. The matrix is memory-mapped, so it is only paged in as needed and is shared by all processes on a host.
+    Tokens are looked up as written and then lower-cased. Tokens not in the vocabulary are embedded as zero vectors.
+    """
+    kind = "vectors"
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.vectors = np.load(vectors_filename(directory), mmap_mode="r")
+        self.vocabulary = {word: i for i, word in enumerate(read_vocabulary(directory))}
+        self._oov = np.zeros(self.embedding_size, dtype=self.vectors.dtype)
+
+    @property
+    def embedding_size(self):
+        return self.vectors.shape[1]
+
+    def frequent_words(self, n):
+        # Vectors tables conventionally list words in order of descending frequency.
+        return sorted(self.vocabulary, key=self.vocabulary.get)[:n]
+
+    def embed_tokens(self, tokens):
+        return self._stack([self._vector(token) for token in tokens])
+
+    def _vector(self, token):
+        i = self.vocabulary.get(token)
+        if i is None:
+            i = self.vocabulary.get(token.lower())
+        if i is None:
+            return self._oov
+        return self.vectors[i]
+
+
+class HashedSubwordEmbedder(RegexTokenizerEmbedder):
+    """
+    Embed tokens as the average of hashed character n-gram vectors, as fastText does.
+
+    The argument is a .npy file containing a matrix of bucket vectors. The character 3- through 6-grams of a token
+    delimited by angle brackets, along with the whole delimited token, are hashed into the rows of this matrix with
+    32-bit FNV-1a. Every token gets a vector, including ones never seen before.
+    """
+    kind = "subword"
+    minimum_n = 3
+    maximum_n = 6
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.buckets = np.load(filename, mmap_mode="r")
+        self._vector = lru_cache(maxsize=2 ** 16)(self._vector)
+
+    @property
+    def embedding_size(self):
+        return self.buckets.shape[1]
+
+    def embed_tokens(self, tokens):
+        return self._stack([self._vector(token) for token in tokens])
+
+    def _vector(self, token):
+        return self.buckets[self.ngram_buckets(token)].mean(axis=0)
+
+    def ngram_buckets(self, token):
+        word = "<%s>" % token
+        ngrams = [word]
+        for n in range(self.minimum_n, self.maximum_n + 1):
+            ngrams.extend(word[i:i + n] for i in range(len(word) - n + 1))
+        return [fnv1a(ngram) % len(self.buckets) for ngram in ngrams]
+
+
+def fnv1a(s):
+    """
+    :param s: string to hash
+    :type s: str
+    :return: 32-bit FNV-1a hash of the UTF-8 encoding of the string
+    :rtype: int
+    """
+    h = 2166136261
+    for b in s.encode("utf-8"):
+        h = ((h ^ b) * 16777619) & 0xffffffff
+    return h
+
+
+embedder_kinds = {e.kind: e for e in [SpacyEmbedder, VectorsFileEmbedder, HashedSubwordEmbedder]}
+
+# Embedders that have been loaded, keyed by specification.
+_embedders = {}
+
+
+def load_embedder(specification=None):
+    """
+    Load an embedder, reusing it if it has already been loaded in this process.
+
+    A specification without a KIND: prefix is taken to be the name of a spaCy model.
+
+    :param specification: embedder specification or None to use the default spaCy English model
+    :type specification: str or None
+    :return: the embedder
+    :rtype: Embedder
+    """
+    specification = canonical_specification(specification)
+    if specification not in _embedders:
+        kind, argument = specification.split(":", 1)
+        embedder = embedder_kinds[kind](argument)
+        logger.info(embedder.description)
+        _embedders[specification] = embedder
+    return _embedders[specification]
+
+
+def canonical_specification(specification):
+    """
+    Files named in specifications are made absolute relative to the working directory.
+
+    :param specification: embedder specification or None
+    :type specification: str or None
+    :return: embedder specification of the form KIND:ARGUMENT
+    :rtype: str
+    """
+    if specification is None:
+        return default_embedder
+    kind, _, argument = specification.partition(":")
+    if not argument:
+        return "%s:%s" % (SpacyEmbedder.kind, specification)
+    if kind not in embedder_kinds:
+        raise ValueError("Invalid embedder %s. The kind must be one of %s" % (specification, sorted(embedder_kinds)))
+    if kind != SpacyEmbedder.kind:
+        specification = "%s:%s" % (kind, os.path.abspath(argument))
+    return specification
+
+
+def resolve_specification(specification, directory):
+    """
+    Make files named in an embedder specification relative to a directory.
+
+    :param specification: embedder specification or None
+    :type specification: str or None
+    :param directory: directory relative to which file names are resolved
+    :type directory: str
+    :return: embedder specification or None
+    :rtype: str or None
+    """
+    if specification is not None:
+        kind, _, argument = specification.partition(":")
+        if kind in embedder_kinds and kind != SpacyEmbedder.kind and not os.path.isabs(argument):
+            specification = "%s:%s" % (kind, os.path.join(directory, argument))
+    return specification
+
+
+def prune_vectors(embedder, texts, frequent_words, directory):
+    """
+    Write a vectors table containing only the words needed for a data set.
+
+    The table contains the most frequent words known to the embedder followed by every token in the texts. The texts are
+    tokenized the way VectorsFileEmbedder tokenizes them, so a model trained with the table sees the same tokens when it
+    is used, even if the embedder tokenizes them differently. Tokens outside the table all share the zero vector, which
+    is also what spaCy assigns to words it does not have vectors for.
+
+    :param embedder: embedder whose vectors are copied
+    :type embedder: Embedder
+    :param texts: texts whose tokens should be in the table
+    :type texts: iterable of str
+    :param frequent_words: number of most frequent words to include
+    :type frequent_words: int
+    :param directory: directory to create
+    :type directory: str
+    :return: number of words in the table
+    :rtype: int
+    """
+    if not isinstance(embedder, RegexTokenizerEmbedder):
+        logger.warning("The pruned vectors of %s will be looked up with the regular expression tokenizer instead of "
+                       "its own tokenizer" % embedder.specification)
+    words = embedder.frequent_words(frequent_words)
+    vocabulary = set(words)
+    for text in texts:
+        for token in tokenize(text):
+            if token not in vocabulary:
+                vocabulary.add(token)
+                words.append(token)
+    save_vectors(directory, words, embedder.embed_tokens(words))
+    logger.info("Pruned %s to %d words" % (embedder.specification, len(words)))
+    return len(words)
+
+
+def save_vectors(directory, words, vectors):
+    """
+    Write a vectors table in the format read by VectorsFileEmbedder.
+
+    :param directory: directory to create
+    :type directory: str
+    :param words: vocabulary
+    :type words: sequence of str
+    :param vectors: matrix whose rows are the vectors of the corresponding words
+    :type vectors: numpy.array
+    """
+    os.makedirs(directory, exist_ok=True)
+    np.save(vectors_filename(directory), np.asarray(vectors, dtype=np.float32))
+    # Words may contain line breaks, so the vocabulary is stored as JSON rather than one word per line.
+    with open(vocabulary_filename(directory), "w", encoding="utf-8") as f:
+        json.dump(list(words), f)
+
+
+def read_vocabulary(directory):
+    """
+    :param directory: directory written by save_vectors
+    :type directory: str
+    :return: the words of the vectors table in the order of its rows
+    :rtype: list of str
+    """
+    filename = vocabulary_filename(directory)
+    if os.path.isfile(filename):
+        with open(filename, encoding="utf-8") as f:
+            return json.load(f)
+    # Earlier versions wrote a word on each line. Only newlines end a line, not the other line breaks splitlines knows.
+    with open(legacy_vocabulary_filename(directory), encoding="utf-8", newline="\n") as f:
+        return f.read().split("\n")[:-1]
+
+
+def convert_text_vectors(filename, directory):
+    """
+    Convert vectors in the word2vec/fastText text format to the format read by VectorsFileEmbedder.
+
+    The text format has a header line with the vocabulary size and dimension followed by one line per word containing
+    the word and its vector components separated by spaces.
+
+    :param filename: text vectors file
+    :type filename: str
+    :param directory: directory to create
+    :type directory: str
+    """
+    # Words may contain carriage returns, so only newlines end a line.
+    with open(filename, encoding="utf-8", newline="\n") as f:
+        n, dimension = (int(x) for x in f.readline().split())
+        words = []
+        vectors = np.zeros((n, dimension), dtype=np.float32)
+        for i, line in enumerate(f):
+            fields = line.rstrip("\n").rstrip(" ").split(" ")
+            words.append(fields[0])
+            vectors[i] = [float(x) for x in fields[1:]]
+    save_vectors(directory, words, vectors[:len(words)])
+
+
+def vectors_filename(directory):
+    return os.path.join(directory, "vectors.npy")
+
+
+def vocabulary_filename(directory):
+    return os.path.join(directory, "vocabulary.json")
+
+
+def legacy_vocabulary_filename(directory):
+    return os.path.join(directory, "vocabulary.txt")
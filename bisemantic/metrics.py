@@ -0,0 +1,160 @@
+"""
+Classification metrics accumulated over a stream of predictions
+"""
+import numpy as np
+import pandas as pd
+
+
+class StreamingMetrics(object):
+    """
+    Running classification metrics that use a constant amount of memory however many samples are scored.
+
+    Loss and accuracy are running sums. Precision, recall, and F1 are derived from a confusion matrix. ROC AUC is
+    computed one class against the rest from histograms of the predicted probability of each class, and calibration
+    error from a histogram of the probability of the predicted class, so neither requires keeping the predictions.
+    """
+
+    def __init__(self, class_names, auc_bins=1000, calibration_bins=10):
+        """
+        :param class_names: the model's classes, in the order of its outputs
+        :type class_names: list
+        :param auc_bins: number of probability bins used to compute ROC AUC
+        :type auc_bins: int
+        :param calibration_bins: number of probability bins used to compute calibration error
+        :type calibration_bins: int
+        """
+        self.class_names = list(class_names)
+        self.auc_bins = auc_bins
+        self.calibration_bins = calibration_bins
+        classes = len(self.class_names)
+        self.samples = 0
+        self.loss_sum = 0.0
+        self.confusion_matrix = np.zeros((classes, classes), dtype=np.int64)
+        # Histograms of the probability assigned to each class by samples of that class and samples of other classes.
+        self.positive = np.zeros((classes, auc_bins), dtype=np.int64)
+        self.negative = np.zeros((classes, auc_bins), dtype=np.int64)
+        # Number of samples, total confidence, and number correct in each bin of the predicted class's probability.
+        self.confidence_counts = np.zeros(calibration_bins, dtype=np.int64)
+        self.confidence_sums = np.zeros(calibration_bins)
+        self.correct_counts = np.zeros(calibration_bins)
+
+    def __repr__(self):
+        return "%s(%d samples, classes %s)" % (self.__class__.__name__, self.samples, self.class_names)
+
+    def label_codes(self, labels):
+        """
+        Map labels to the positions of the model's classes. Labels are matched by their string values, so that numeric
+        labels read from a file match numeric class names.
+
+        :param labels: label values
+        :type labels: pandas.Series
+        :return: the class position of each label, or -1 for labels that are not one of the model's classes
+        :rtype: numpy.array
+        """
+        codes = {str(name): code for code, name in enumerate(self.class_names)}
+        return pd.Series(labels).astype(str).map(codes).fillna(-1).values.astype(int)
+
+    def update(self, probabilities, codes, epsilon=1e-7):
+        """
+        :param probabilities: matrix of size (samples, classes) of predicted probabilities
+        :type probabilities: numpy.array
+        :param codes: the class position of each sample's true label
+        :type codes: numpy.array
+        :param epsilon: probabilities are clipped to this distance from 0 and 1 when computing the loss
+        :type epsilon: float
+        """
+        rows = np.arange(len(codes))
+        p = np.clip(probabilities[rows, codes], epsilon, 1 - epsilon)
+        self.samples += len(codes)
+        self.loss_sum += float(-np.log(p).sum())
+        predicted = probabilities.argmax(axis=1)
+        np.add.at(self.confusion_matrix, (codes, predicted), 1)
+        bins = self._bins(probabilities, self.auc_bins)
+        for k in range(len(self.class_names)):
+            is_k = codes == k
+            self.positive[k] += np.bincount(bins[is_k, k], minlength=self.auc_bins)
+            self.negative[k] += np.bincount(bins[~is_k, k], minlength=self.auc_bins)
+        confidence = probabilities[rows, predicted]
+        bins = self._bins(confidence, self.calibration_bins)
+        self.confidence_counts += np.bincount(bins, minlength=self.calibration_bins)
+        self.confidence_sums += np.bincount(bins, weights=confidence, minlength=self.calibration_bins)
+        self.correct_counts += np.bincount(bins, weights=predicted == codes, minlength=self.calibration_bins)
+
+    @staticmethod
+    def _bins(probabilities, bins):
+        return np.minimum((probabilities * bins).astype(int), bins - 1)
+
+    @property
+    def loss(self):
+        return self.loss_sum / self.samples
+
+    @property
+    def accuracy(self):
+        return np.trace(self.confusion_matrix) / self.samples
+
+    @property
+    def support(self):
+        return self.confusion_matrix.sum(axis=1)
+
+    @property
+    def precision(self):
+        return _ratio(np.diag(self.confusion_matrix), self.confusion_matrix.sum(axis=0))
+
+    @property
+    def recall(self):
+        return _ratio(np.diag(self.confusion_matrix), self.support)
+
+    @property
+    def f1(self):
+        return _ratio(2 * self.precision * self.recall, self.precision + self.recall)
+
+    @property
+    def roc_auc(self):
+        """
+        The area under the ROC curve of each class against the rest. Samples in the same bin are counted as ties.
+
+        :return: AUC of each class, NaN for classes without both positive and negative samples
+        :rtype: numpy.array
+        """
+        auc = np.full(len(self.class_names), np.nan)
+        for k, (positive, negative) in enumerate(zip(self.positive, self.negative)):
+            if positive.sum() and negative.sum():
+                positive_above = positive[::-1].cumsum()[::-1] - positive
+                auc[k] = (negative * (positive_above + 0.5 * positive)).sum() / (positive.sum() * negative.sum())
+        return auc
+
+    @property
+    def calibration_error(self):
+        """
+        :return: expected calibration error, the sample-weighted mean difference between accuracy and confidence
+        :rtype: float
+        """
+        return float(np.abs(self.correct_counts - self.confidence_sums).sum() / self.samples)
+
+    def results(self):
+        """
+        :return: names and values of the summary metrics: loss, accuracy, macro-averaged AUC, and calibration error
+        :rtype: list of (str, float)
+        """
+        auc = self.roc_auc
+        auc = float(np.nanmean(auc)) if not np.isnan(auc).all() else np.nan
+        return [("loss", self.loss), ("acc", float(self.accuracy)), ("auc", auc), ("ece", self.calibration_error)]
+
+    def report(self):
+        """
+        :return: the summary metrics, a table of per-class metrics, and the confusion matrix
+        :rtype: str
+        """
+        classes = pd.DataFrame({"precision": self.precision, "recall": self.recall, "f1": self.f1,
+                                "auc": self.roc_auc, "support": self.support},
+                               index=self.class_names, columns=["precision", "recall", "f1", "auc", "support"])
+        confusion_matrix = pd.DataFrame(self.confusion_matrix, index=self.class_names, columns=self.class_names)
+        return "\n\n".join([", ".join("%s=%0.5f" % s for s in self.results()),
+                            classes.to_string(float_format="%0.5f"),
+                            "Confusion matrix (rows are true labels, columns predicted labels)\n" +
+                            confusion_matrix.to_string()])
+
+
+def _ratio(numerator, denominator):
+    # Zero where the denominator is zero.
+    return np.divide(numerator, denominator, out=np.zeros(len(numerator)), where=denominator != 0)
@@ -0,0 +1,274 @@
+"""
+Data-parallel training across processes and hosts
+"""
+import multiprocessing
+import os
+import socket
+import time
+from multiprocessing.connection import Listener, Client, wait
+
+import numpy as np
+from keras import backend as K
+from keras.callbacks import CallbackList, BaseLogger, History
+
+from bisemantic import logger
+
+
+class Rendezvous(object):
+    """
+    Connections between the processes taking part in data-parallel training.
+
+    Rank 0 listens at an address and all the other ranks connect to it, so rank 0 is the hub through which values are
+    averaged and broadcast. The connections are authenticated with a secret key, since the ranks exchange pickled
+    values and anyone who can connect could otherwise run code in them.
+    """
+
+    def __init__(self, rank, world_size, address, authkey=None, timeout=600):
+        """
+        :param rank: rank of this process
+        :type rank: int
+        :param world_size: total number of processes
+        :type world_size: int
+        :param address: host and port at which rank 0 listens
+        :type address: (str, int)
+        :param authkey: secret key shared by all the ranks or None to use the one in the BISEMANTIC_AUTHKEY
+            environment variable
+        :type authkey: bytes or None
+        :param timeout: seconds to keep trying to connect to rank 0
+        :type timeout: int
+        """
+        self.rank = rank
+        self.world_size = world_size
+        if authkey is None:
+            authkey = environment_authkey()
+        if rank == 0:
+            connections = {}
+            listener = Listener(address, authkey=authkey)
+            try:
+                while len(connections) < world_size - 1:
+                    connection = listener.accept()
+                    connections[connection.recv()] = connection
+            finally:
+                listener.close()
+            self.connections = [connections[r] for r in sorted(connections)]
+        else:
+            self.connections = [self._connect(address, authkey, timeout)]
+            self.connections[0].send(rank)
+        logger.info(self)
+
+    def __repr__(self):
+        return "%s: rank %d of %d" % (self.__class__.__name__, self.rank, self.world_size)
+
+    @staticmethod
+    def _connect(address, authkey, timeout):
+        # Rank 0 may not be listening yet.
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return Client(address, authkey=authkey)
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(1)
+
+    def average(self, arrays, weight):
+        """
+        Weighted average of arrays across all ranks.
+
+        :param arrays: this rank's values
+        :type arrays: list of numpy.array
+        :param weight: this rank's weight
+        :type weight: float
+        :return: the average of every array across ranks and the total weight
+        :rtype: (list of numpy.array, float)
+        """
+        total = [a * weight for a in arrays]
+        if self.rank == 0:
+            total_weight = weight
+            for connection in self.connections:
+                values, w = connection.recv()
+                total = [t + v for t, v in zip(total, values)]
+                total_weight += w
+            average = ([t / total_weight for t in total], total_weight)
+            for connection in self.connections:
+                connection.send(average)
+            return average
+        else:
+            self.connections[0].send((total, weight))
+            return self.connections[0].recv()
+
+    def broadcast(self, value=None):
+        """
+        Send a value from rank 0 to all ranks. This also serves as a barrier.
+
+        :param value: value to send, ignored on ranks other than 0
+        :type value: object
+        :return: rank 0's value
+        :rtype: object
+        """
+        if self.rank == 0:
+            for connection in self.connections:
+                connection.send(value)
+            return value
+        else:
+            return self.connections[0].recv()
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+
+class DataParallelTrainer(object):
+    """
+    Train a Keras model with synchronous data-parallel gradient averaging.
+
+    Every rank computes the gradient of the loss on a batch from its own shard of the training data. The gradients are
+    averaged across ranks, weighted by batch size, and every rank applies the averaged gradient with its own copy of the
+    optimizer. All ranks start from rank 0's weights, so they remain identical throughout training.
+    """
+
+    def __init__(self, model, rendezvous):
+        """
+        :param model: compiled model
+        :type model: keras.engine.Model
+        :param rendezvous: connections to the other ranks
+        :type rendezvous: Rendezvous
+        """
+        self.model = model
+        self.rendezvous = rendezvous
+        weights = model.trainable_weights
+        inputs = model._feed_inputs + model._feed_targets + model._feed_sample_weights
+        self._learning_phase = model.uses_learning_phase and not isinstance(K.learning_phase(), int)
+        if self._learning_phase:
+            inputs += [K.learning_phase()]
+        gradients = K.gradients(model.total_loss, weights)
+        self.gradient_function = K.function(inputs, [model.total_loss] + model.metrics_tensors + gradients)
+        # The gradient of this loss with respect to the weights is the averaged gradient fed into the placeholders.
+        averaged_gradients = [K.placeholder(shape=K.int_shape(w)) for w in weights]
+        loss = sum(K.sum(w * g) for w, g in zip(weights, averaged_gradients))
+        optimizer = model.optimizer
+        # Carry over optimizer state restored from a saved model.
+        state = K.batch_get_value(optimizer.weights)
+        try:
+            updates = optimizer.get_updates(loss=loss, params=weights)
+        except TypeError:
+            # Keras before 2.0.7 has a different signature.
+            updates = optimizer.get_updates(params=weights, constraints=getattr(model, "constraints", {}), loss=loss)
+        if state and [s.shape for s in state] == [K.int_shape(w) for w in optimizer.weights]:
+            optimizer.set_weights(state)
+        self.update_function = K.function(averaged_gradients, [], updates=updates)
+
+    def train_on_batch(self, x, y, sample_weight=None):
+        """
+        :param x: this rank's input batch
+        :type x: list of numpy.array
+        :param y: this rank's labels
+        :type y: numpy.array
+        :param sample_weight: this rank's sample weights or None to weight all samples equally
+        :type sample_weight: numpy.array or None
+        :return: metrics averaged across all ranks and the total number of samples in the batch across all ranks
+        :rtype: (list of float, int)
+        """
+        x, y, sample_weights = self.model._standardize_user_data(x, y, sample_weight=sample_weight)
+        inputs = x + y + sample_weights
+        if self._learning_phase:
+            inputs += [1.]
+        outputs = [np.asarray(output) for output in self.gradient_function(inputs)]
+        averages, size = self.rendezvous.average(outputs, len(y[0]))
+        n = len(self.model.metrics_names)
+        self.update_function(averages[n:])
+        return [float(metric) for metric in averages[:n]], int(size)
+
+    def fit(self, generator, steps_per_epoch, epochs, initial_epoch=0, validation_data=None, validation_steps=None,
+            callbacks=None):
+        """
+        Train on batches from this rank's shard, in lock step with the other ranks.
+
+        This takes the same arguments as the Keras fit_generator method. Validation data and callbacks should only be
+        passed to rank 0.
+
+        :return: training history
+        :rtype: keras.callbacks.History
+        """
+        self.model.set_weights(self.rendezvous.broadcast(self.model.get_weights()))
+        history = History()
+        callbacks = CallbackList([BaseLogger()] + (callbacks or []) + [history])
+        callbacks.set_model(self.model)
+        metrics = list(self.model.metrics_names)
+        if validation_data is not None:
+            metrics += ["val_" + name for name in self.model.metrics_names]
+        callbacks.set_params({"epochs": epochs, "steps": steps_per_epoch, "verbose": 0,
+                              "do_validation": validation_data is not None, "metrics": metrics})
+        callbacks.on_train_begin()
+        for epoch in range(initial_epoch, epochs):
+            callbacks.on_epoch_begin(epoch)
+            for batch in range(steps_per_epoch):
+                # The generator yields (x, y) or (x, y, sample weights).
+                x, y, *sample_weight = next(generator)
+                callbacks.on_batch_begin(batch, {"batch": batch, "size": len(y)})
+                values, size = self.train_on_batch(x, y, *sample_weight)
+                batch_logs = dict(zip(self.model.metrics_names, values), batch=batch, size=size)
+                callbacks.on_batch_end(batch, batch_logs)
+            epoch_logs = {}
+            if validation_data is not None:
+                values = self.model.evaluate_generator(validation_data, validation_steps)
+                epoch_logs.update(("val_" + name, value) for name, value in zip(self.model.metrics_names, values))
+            callbacks.on_epoch_end(epoch, epoch_logs)
+        callbacks.on_train_end()
+        return history
+
+
+def run_processes(target, arguments):
+    """
+    Run a function in a set of processes and wait for them all to finish.
+
+    If any process fails the others are terminated, since they would otherwise wait forever for it in the rendezvous.
+
+    :param target: function to run
+    :type target: callable
+    :param arguments: arguments for each process
+    :type arguments: list of tuple
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=target, args=a) for a in arguments]
+    for process in processes:
+        process.start()
+    running = list(processes)
+    while running:
+        for sentinel in wait([process.sentinel for process in running]):
+            process = next(process for process in running if process.sentinel == sentinel)
+            process.join()
+            running.remove(process)
+            if process.exitcode != 0:
+                for other in running:
+                    other.terminate()
+                raise RuntimeError("A training process failed with exit code %d" % process.exitcode)
+
+
+def environment_authkey():
+    """
+    :return: the secret key in the BISEMANTIC_AUTHKEY environment variable
+    :rtype: bytes
+    """
+    authkey = os.environ.get("BISEMANTIC_AUTHKEY")
+    if not authkey:
+        raise ValueError("Set the BISEMANTIC_AUTHKEY environment variable to the same secret on every host")
+    return authkey.encode("utf-8")
+
+
+def random_authkey():
+    """
+    :return: a random secret key for processes started on this host
+    :rtype: bytes
+    """
+    return os.urandom(32)
+
+
+def free_address():
+    """
+    :return: an address on this host with a port that is not in use
+    :rtype: (str, int)
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()
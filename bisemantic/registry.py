@@ -0,0 +1,315 @@
+"""
+Batch prediction from many threads or coroutines with models that are loaded on demand
+"""
+import asyncio
+import contextlib
+import queue
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+from itertools import groupby
+
+import pandas as pd
+
+from bisemantic import logger
+from bisemantic.data import text_1, text_2
+
+# A model held by a registry, with the backend session its graph belongs to, if the backend has sessions.
+LoadedModel = namedtuple("LoadedModel", ["model", "class_names", "size", "session"])
+
+
+class ModelRegistry(object):
+    """
+    Models identified by their model directories, loaded the first time they are used and kept in memory until space
+    is needed for other models.
+
+    Predictions are made on a single inference thread. Requests from any number of threads wait in a queue, and every
+    request for the same model that is waiting when the thread becomes free is predicted in a single pass through the
+    model, so concurrent callers share batches. Loading models on this thread too keeps the backend's graph and session
+    on one thread.
+
+    Models share embedders with each other and with the rest of the process, since load_embedder caches them. With the
+    TensorFlow backend each model has a graph and session of its own, so that dropping a model frees its variables and
+    operations. When the total size of the loaded models' weights exceeds the memory limit, the least recently used
+    models are dropped.
+    """
+
+    def __init__(self, maximum_memory=None, batch_size=2048, workers=None):
+        """
+        :param maximum_memory: maximum total size in bytes of the weights of loaded models or None for no limit; the
+            most recently used model is kept even if it is larger than this
+        :type maximum_memory: int or None
+        :param batch_size: number of samples per batch
+        :type batch_size: int
+        :param workers: number of processes used to embed text or None to embed on the inference thread
+        :type workers: int or None
+        """
+        self.maximum_memory = maximum_memory
+        self.batch_size = batch_size
+        self.workers = workers
+        # Model directory: LoadedModel, least recently used first.
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="model-registry", daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return "%s(%d models, %d bytes)" % (self.__class__.__name__, len(self.loaded), self.memory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @property
+    def loaded(self):
+        """
+        :return: directories of the loaded models, least recently used first
+        :rtype: list of str
+        """
+        with self._lock:
+            return list(self._models)
+
+    @property
+    def memory(self):
+        """
+        :return: total size in bytes of the weights of the loaded models
+        :rtype: int
+        """
+        with self._lock:
+            return sum(loaded.size for loaded in self._models.values())
+
+    def submit(self, model_directory, pairs):
+        """
+        Queue text pairs for prediction.
+
+        :param model_directory: directory of the model to use
+        :type model_directory: str
+        :param pairs: text pairs
+        :type pairs: list of (str, str)
+        :return: future label probabilities of the pairs, with a column for each class and a row for each pair
+        :rtype: concurrent.futures.Future
+        :raises RuntimeError: if the registry has been closed
+        """
+        future = Future()
+        # Queue the request under the lock so that it cannot follow the request that stops the inference thread.
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("registry closed")
+            self._requests.put((model_directory, list(pairs), future))
+        return future
+
+    def predict_pairs(self, model_directory, pairs, timeout=None):
+        """
+        Predict label probabilities for text pairs. This may be called from any thread.
+
+        :param model_directory: directory of the model to use
+        :type model_directory: str
+        :param pairs: text pairs
+        :type pairs: list of (str, str)
+        :param timeout: maximum number of seconds to wait or None to wait as long as it takes
+        :type timeout: float or None
+        :return: label probabilities, with a column for each class and a row for each pair
+        :rtype: pandas.DataFrame
+        """
+        return self.submit(model_directory, pairs).result(timeout)
+
+    def close(self):
+        """
+        Finish the queued requests, stop the inference thread, and drop the loaded models. Requests cannot be submitted
+        afterwards.
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._requests.put(None)
+        self._thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            requests = [self._requests.get()]
+            # Take all the requests that are waiting so that requests for the same model are predicted together.
+            while True:
+                try:
+                    requests.append(self._requests.get_nowait())
+                except queue.Empty:
+                    break
+            if None in requests:
+                running = False
+                i = requests.index(None)
+                self._reject(requests[i + 1:])
+                requests = requests[:i]
+            # Drop requests that were cancelled while they were waiting.
+            requests = [r for r in requests if r[2].set_running_or_notify_cancel()]
+            requests.sort(key=lambda r: r[0])
+            for model_directory, group in groupby(requests, key=lambda r: r[0]):
+                self._predict(model_directory, list(group))
+        # Nothing is queued after the registry is closed, but make sure no caller is left waiting.
+        while True:
+            try:
+                self._reject([self._requests.get_nowait()])
+            except queue.Empty:
+                break
+        with self._lock:
+            for loaded in self._models.values():
+                _close_session(loaded.session)
+            self._models.clear()
+
+    @staticmethod
+    def _reject(requests):
+        for request in requests:
+            if request is not None and request[2].set_running_or_notify_cancel():
+                request[2].set_exception(RuntimeError("registry closed"))
+
+    def _predict(self, model_directory, requests):
+        try:
+            loaded = self._model(model_directory)
+            data = pd.DataFrame([pair for _, pairs, _ in requests for pair in pairs], columns=[text_1, text_2])
+            logger.debug("Predict %d pairs from %d requests with %s" % (len(data), len(requests), model_directory))
+            if len(data):
+                with _in_session(loaded.session):
+                    probabilities = loaded.model.predict(data, batch_size=self.batch_size,
+                                                         class_names=loaded.class_names, workers=self.workers)
+            else:
+                probabilities = pd.DataFrame(columns=loaded.class_names)
+        except Exception as e:
+            for _, _, future in requests:
+                future.set_exception(e)
+            return
+        start = 0
+        for _, pairs, future in requests:
+            future.set_result(probabilities.iloc[start:start + len(pairs)].reset_index(drop=True))
+            start += len(pairs)
+
+    def _model(self, model_directory):
+        from bisemantic.classifier import TextPairClassifier
+
+        with self._lock:
+            if model_directory in self._models:
+                self._models.move_to_end(model_directory)
+                return self._models[model_directory]
+        session = _new_session()
+        try:
+            with _in_session(session):
+                model = TextPairClassifier.load_from_model_directory(model_directory)
+                size = sum(w.nbytes for w in model.model.get_weights())
+        except Exception:
+            _close_session(session)
+            raise
+        class_names = TextPairClassifier.class_names_from_model_directory(model_directory)
+        logger.info("Load %s from %s, %d bytes" % (model, model_directory, size))
+        loaded = LoadedModel(model, class_names, size, session)
+        with self._lock:
+            self._models[model_directory] = loaded
+            while self.maximum_memory is not None and len(self._models) > 1 and \
+                    sum(m.size for m in self._models.values()) > self.maximum_memory:
+                evicted, evicted_model = self._models.popitem(last=False)
+                _close_session(evicted_model.session)
+                logger.info("Evict %s" % evicted)
+        return loaded
+
+
+def _new_session():
+    """
+    :return: a session with a graph of its own or None if the backend does not have sessions
+    :rtype: tensorflow.Session or None
+    """
+    from keras import backend as K
+
+    if K.backend() != "tensorflow":
+        return None
+    import tensorflow as tf
+    return tf.Session(graph=tf.Graph())
+
+
+@contextlib.contextmanager
+def _in_session(session):
+    """
+    Make a session and its graph the ones that Keras builds and runs models in.
+
+    :param session: session returned by _new_session
+    :type session: tensorflow.Session or None
+    """
+    if session is None:
+        yield
+    else:
+        with session.graph.as_default(), session.as_default():
+            yield
+
+
+def _close_session(session):
+    """
+    Close a session returned by _new_session and drop the references Keras keeps to its graph.
+
+    :param session: session returned by _new_session
+    :type session: tensorflow.Session or None
+    """
+    if session is None:
+        return
+    from keras.backend import tensorflow_backend
+
+    session.close()
+    for graph_state in ["_GRAPH_LEARNING_PHASES", "_GRAPH_UID_DICTS"]:
+        getattr(tensorflow_backend, graph_state, {}).pop(session.graph, None)
+
+
+class AsyncTextPairClassifier(object):
+    """
+    Prediction with a model from asyncio code.
+
+    Predictions are made by a ModelRegistry, so parsing and inference happen on its inference thread and optionally its
+    embedding processes, never on the event loop. Concurrent calls are coalesced into shared batches by the registry. A
+    cancelled call is dropped if its prediction has not started yet. At most a given number of calls are queued at a
+    time, and further calls wait on the event loop until earlier ones finish.
+    """
+
+    def __init__(self, model_directory, registry=None, maximum_pending=64):
+        """
+        :param model_directory: directory of the model to use
+        :type model_directory: str
+        :param registry: registry that makes the predictions or None to create one for this classifier
+        :type registry: ModelRegistry or None
+        :param maximum_pending: maximum number of calls queued for prediction at a time or None for no limit
+        :type maximum_pending: int or None
+        """
+        self.model_directory = model_directory
+        self._owns_registry = registry is None
+        self.registry = registry or ModelRegistry()
+        self.maximum_pending = maximum_pending
+        # Created on first use so that it belongs to the running event loop.
+        self._pending = None
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.model_directory)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def predict(self, pairs):
+        """
+        :param pairs: text pairs
+        :type pairs: list of (str, str)
+        :return: label probabilities, with a column for each class and a row for each pair
+        :rtype: pandas.DataFrame
+        """
+        if self.maximum_pending is None:
+            return await asyncio.wrap_future(self.registry.submit(self.model_directory, pairs))
+        if self._pending is None:
+            self._pending = asyncio.Semaphore(self.maximum_pending)
+        async with self._pending:
+            # Cancelling the wrapping future cancels the registry's future.
+            return await asyncio.wrap_future(self.registry.submit(self.model_directory, pairs))
+
+    async def close(self):
+        """
+        Stop the registry if this classifier created it, without blocking the event loop.
+        """
+        if self._owns_registry:
+            await asyncio.get_running_loop().run_in_executor(None, self.registry.close)
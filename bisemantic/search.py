@@ -0,0 +1,252 @@
+"""
+Approximate nearest neighbour search for text pair candidates
+"""
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from bisemantic import logger
+
+
+class EncodingIndex(object):
+    """
+    An inverted file index of the encodings that the shared LSTM of a trained model assigns to a set of texts.
+
+    The encodings are partitioned into clusters with spherical k-means. A query is only compared with the encodings in
+    the clusters whose centroids are most similar to it, so finding candidate pairs for every text in a corpus takes
+    time roughly linear in the size of the corpus instead of quadratic. Similarity is the cosine of the angle between
+    encodings. The candidates are then scored by the head of the model, which is the part that follows the LSTM, so only
+    the queries need to be encoded at search time.
+
+    The index is a directory containing the encodings grouped by cluster, which are memory-mapped when the index is
+    loaded, along with the texts in the same order and the name of the model directory.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: index directory written by build
+        :type directory: str
+        """
+        self.directory = directory
+        with open(self._metadata_filename(directory)) as f:
+            metadata = json.load(f)
+        self.model_directory = metadata["model"]
+        self.centroids = np.load(self._centroids_filename(directory))
+        self.offsets = np.load(self._offsets_filename(directory))
+        self.encodings = np.load(self._encodings_filename(directory), mmap_mode="r")
+        self.texts = pd.read_csv(self._texts_filename(directory), index_col=0, keep_default_na=False)["text"]
+        self._model = None
+
+    def __repr__(self):
+        return "%s(%d texts, %d clusters)" % (self.__class__.__name__, len(self), self.clusters)
+
+    def __len__(self):
+        return len(self.texts)
+
+    @property
+    def clusters(self):
+        return len(self.centroids)
+
+    @property
+    def model(self):
+        if self._model is None:
+            from bisemantic.classifier import TextPairClassifier
+            self._model = TextPairClassifier.load_from_model_directory(self.model_directory)
+        return self._model
+
+    @classmethod
+    def build(cls, model_directory, texts, directory, clusters=None, batch_size=2048, workers=None, iterations=10,
+              seed=None):
+        """
+        Encode texts and write an index of them.
+
+        :param model_directory: directory of the model whose encoder is used
+        :type model_directory: str
+        :param texts: texts to index
+        :type texts: pandas.Series
+        :param directory: index directory to create
+        :type directory: str
+        :param clusters: number of clusters or None to use the square root of the number of texts
+        :type clusters: int or None
+        :param batch_size: number of texts per batch
+        :type batch_size: int
+        :param workers: number of processes used to embed text or None to embed in this process
+        :type workers: int or None
+        :param iterations: number of k-means iterations
+        :type iterations: int
+        :param seed: random number seed for k-means
+        :type seed: int or None
+        :return: the index
+        :rtype: EncodingIndex
+        """
+        from bisemantic.classifier import TextPairClassifier
+        model = TextPairClassifier.load_from_model_directory(model_directory)
+        logger.info("Encode %d texts" % len(texts))
+        encodings = model.encode(texts, batch_size=batch_size, workers=workers).astype(np.float32)
+        if clusters is None:
+            clusters = int(math.sqrt(len(encodings)))
+        clusters = max(1, min(clusters, len(encodings)))
+        normalized = normalize(encodings)
+        centroids = spherical_k_means(normalized, clusters, iterations, seed)
+        assignments = nearest_centroids(normalized, centroids)
+        order = np.argsort(assignments, kind="mergesort")
+        offsets = np.searchsorted(assignments[order], np.arange(clusters + 1))
+        os.makedirs(directory, exist_ok=True)
+        np.save(cls._centroids_filename(directory), centroids)
+        np.save(cls._offsets_filename(directory), offsets)
+        np.save(cls._encodings_filename(directory), encodings[order])
+        texts.iloc[order].to_frame("text").to_csv(cls._texts_filename(directory))
+        with open(cls._metadata_filename(directory), "w") as f:
+            json.dump({"model": os.path.abspath(model_directory), "clusters": clusters, "texts": len(texts)}, f,
+                      sort_keys=True, indent=4)
+        index = cls(directory)
+        index._model = model
+        logger.info(index)
+        return index
+
+    def search(self, queries, k=10, probes=8, batch_size=2048, workers=None, class_names=None):
+        """
+        Find the indexed texts most similar to each query and predict a label distribution for each of these pairs.
+
+        :param queries: query texts
+        :type queries: pandas.Series
+        :param k: maximum number of candidates to return per query
+        :type k: int
+        :param probes: number of clusters to search per query
+        :type probes: int
+        :param batch_size: number of texts per batch
+        :type batch_size: int
+        :param workers: number of processes used to embed text or None to embed in this process
+        :type workers: int or None
+        :param class_names: optional column names to use for the classes
+        :type class_names: list or None
+        :return: query and candidate indexes, their similarity, and label probabilities for query, candidate pairs
+        :rtype: pandas.DataFrame
+        """
+        logger.info("Encode %d queries" % len(queries))
+        query_encodings = self.model.encode(queries, batch_size=batch_size, workers=workers)
+        nearest_clusters = top_k(normalize(query_encodings).dot(self.centroids.T), probes)
+        query_positions, candidate_positions, similarities = [], [], []
+        for i, clusters in enumerate(nearest_clusters):
+            positions = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in clusters])
+            if not len(positions):
+                continue
+            candidates = np.concatenate([self.encodings[self.offsets[c]:self.offsets[c + 1]] for c in clusters])
+            s = normalize(candidates).dot(query_encodings[i] / max(np.linalg.norm(query_encodings[i]), 1e-12))
+            nearest = top_k(s[np.newaxis, :], k)[0]
+            query_positions.append(np.full(len(nearest), i))
+            candidate_positions.append(positions[nearest])
+            similarities.append(s[nearest])
+        if query_positions:
+            query_positions = np.concatenate(query_positions)
+            candidate_positions = np.concatenate(candidate_positions)
+            similarities = np.concatenate(similarities)
+        else:
+            query_positions = candidate_positions = np.zeros(0, dtype=int)
+            similarities = np.zeros(0)
+        logger.info("Score %d candidate pairs" % len(query_positions))
+        probabilities = self.model.head_model().predict(
+            [query_encodings[query_positions], self.encodings[candidate_positions]], batch_size=batch_size)
+        candidates = pd.DataFrame({"query": queries.index[query_positions],
+                                   "candidate": self.texts.index[candidate_positions],
+                                   "similarity": similarities},
+                                  columns=["query", "candidate", "similarity"])
+        probabilities = pd.DataFrame(probabilities.reshape((len(candidates), self.model.classes)),
+                                     columns=class_names)
+        return pd.concat([candidates, probabilities], axis=1)
+
+    @staticmethod
+    def _metadata_filename(directory):
+        return os.path.join(directory, "index.json")
+
+    @staticmethod
+    def _centroids_filename(directory):
+        return os.path.join(directory, "centroids.npy")
+
+    @staticmethod
+    def _offsets_filename(directory):
+        return os.path.join(directory, "offsets.npy")
+
+    @staticmethod
+    def _encodings_filename(directory):
+        return os.path.join(directory, "encodings.npy")
+
+    @staticmethod
+    def _texts_filename(directory):
+        return os.path.join(directory, "texts.csv")
+
+
+def spherical_k_means(vectors, clusters, iterations=10, seed=None, sample=100000):
+    """
+    Cluster unit vectors by cosine similarity.
+
+    :param vectors: unit vectors to cluster
+    :type vectors: numpy.array
+    :param clusters: number of clusters
+    :type clusters: int
+    :param iterations: number of iterations
+    :type iterations: int
+    :param seed: random number seed
+    :type seed: int or None
+    :param sample: maximum number of vectors to cluster, sampled at random from the vectors
+    :type sample: int
+    :return: unit centroid vectors
+    :rtype: numpy.array
+    """
+    random_state = np.random.RandomState(seed)
+    if len(vectors) > sample:
+        vectors = vectors[random_state.choice(len(vectors), sample, replace=False)]
+    centroids = vectors[random_state.choice(len(vectors), clusters, replace=False)]
+    for _ in range(iterations):
+        assignments = nearest_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        # Move clusters that lost all their members to a random vector.
+        empty = np.bincount(assignments, minlength=clusters) == 0
+        sums[empty] = vectors[random_state.choice(len(vectors), empty.sum())]
+        centroids = normalize(sums)
+    return centroids
+
+
+def nearest_centroids(vectors, centroids, chunk_size=65536):
+    """
+    :param vectors: unit vectors
+    :type vectors: numpy.array
+    :param centroids: unit centroid vectors
+    :type centroids: numpy.array
+    :param chunk_size: number of vectors compared with the centroids at a time, which bounds memory use
+    :type chunk_size: int
+    :return: index of the centroid most similar to each vector
+    :rtype: numpy.array
+    """
+    return np.concatenate([vectors[i:i + chunk_size].dot(centroids.T).argmax(axis=1)
+                           for i in range(0, len(vectors), chunk_size)])
+
+
+def top_k(scores, k):
+    """
+    :param scores: matrix of scores
+    :type scores: numpy.array
+    :param k: number of scores
+    :type k: int
+    :return: column indexes of the k highest scores in each row in descending order of score
+    :rtype: numpy.array
+    """
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    rows = np.arange(len(scores))[:, np.newaxis]
+    return top[rows, np.argsort(-scores[rows, top], axis=1)]
+
+
+def normalize(vectors):
+    """
+    :param vectors: matrix of row vectors
+    :type vectors: numpy.array
+    :return: the vectors scaled to unit length, with zero vectors left as they are
+    :rtype: numpy.array
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
@@ -0,0 +1,104 @@
+"""
+Model weights stored in a single file that can be memory-mapped
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+# Every weight array starts on a page boundary so that it can be read without copying the arrays around it.
+alignment = 4096
+
+
+def save_mapped_weights(model, filename):
+    """
+    Write a model's architecture and weights to a file that load_mapped_weights can memory-map.
+
+    The file starts with the length of a JSON header followed by the header itself, which contains the architecture and
+    the data type, shape, and offset of each weight array. The raw arrays follow in the order of model.get_weights.
+
+    :param model: model to save
+    :type model: keras.engine.Model
+    :param filename: file to write
+    :type filename: str
+    """
+    save_weight_arrays(model.to_json(), model.get_weights(), filename)
+
+
+def save_weight_arrays(architecture, weights, filename):
+    """
+    Write a model's architecture and weights, as returned by its to_json and get_weights methods, in the format written
+    by save_mapped_weights. This does not use the model, so it can run on any thread.
+
+    :param architecture: model architecture as JSON
+    :type architecture: str
+    :param weights: the model's weights
+    :type weights: list of numpy.array
+    :param filename: file to write
+    :type filename: str
+    """
+    weights = [np.ascontiguousarray(w) for w in weights]
+    # Lay out the arrays assuming a header of at most one page, and use more pages if it turns out to be longer.
+    header_pages = 1
+    while True:
+        offset = header_pages * alignment
+        arrays = []
+        for w in weights:
+            arrays.append({"dtype": w.dtype.str, "shape": list(w.shape), "offset": offset})
+            offset += _aligned(w.nbytes)
+        header = json.dumps({"architecture": architecture, "weights": arrays}, sort_keys=True).encode("utf-8")
+        if 8 + len(header) <= header_pages * alignment:
+            break
+        header_pages = _aligned(8 + len(header)) // alignment
+    with open(filename, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for w, array in zip(weights, arrays):
+            f.seek(array["offset"])
+            f.write(w.tobytes())
+        f.truncate(offset)
+
+
+def load_mapped_weights(filename):
+    """
+    Memory-map the weights written by save_mapped_weights.
+
+    The arrays are read-only views of the file, so nothing is read from disk until they are used. Setting them as a
+    model's weights copies them, which reads the whole file.
+
+    :param filename: file written by save_mapped_weights
+    :type filename: str
+    :return: the model architecture as JSON and its weights
+    :rtype: (str, list of numpy.array)
+    """
+    with open(filename, "rb") as f:
+        header_length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    if not header["weights"]:
+        return header["architecture"], []
+    data = np.memmap(filename, dtype=np.uint8, mode="r")
+    weights = []
+    for array in header["weights"]:
+        dtype = np.dtype(array["dtype"])
+        shape = tuple(array["shape"])
+        size = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        weights.append(data[array["offset"]:array["offset"] + size].view(dtype).reshape(shape))
+    return header["architecture"], weights
+
+
+def is_current(mapped_filename, model_filename):
+    """
+    :param mapped_filename: file written by save_mapped_weights
+    :type mapped_filename: str
+    :param model_filename: the model file it was derived from
+    :type model_filename: str
+    :return: does the mapped weights file exist and was it written no earlier than the model file?
+    :rtype: bool
+    """
+    return os.path.isfile(mapped_filename) and \
+        (not os.path.isfile(model_filename) or os.path.getmtime(mapped_filename) >= os.path.getmtime(model_filename))
+
+
+def _aligned(n):
+    return -(-n // alignment) * alignment
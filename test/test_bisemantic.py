@@ -1,19 +1,33 @@
+import asyncio
+import json
 import os
 import shutil
 import sys
 import tempfile
+import time
 from io import StringIO
 from itertools import islice
 from unittest import TestCase
 
+import numpy as np
 import pandas as pd
 from numpy import ones
 from numpy.testing import assert_array_equal, assert_allclose
 
-from bisemantic.classifier import TextPairClassifier, TrainingHistory
-from bisemantic.console import main
+from bisemantic.cache import PredictionCache
+from bisemantic.callbacks import read_epoch_history, ResumeCheckpoint, read_resume_state, read_resume_sample_losses, \
+    ThroughputLog
+from bisemantic.classifier import TextPairClassifier, TrainingHistory, compare_models, configure_backend
+from bisemantic.console import main, memory_size
 from bisemantic.data import cross_validation_partitions, TextPairEmbeddingGenerator, data_file, load_data_file, \
-    fix_columns
+    fix_columns, compile_dataset, CompiledDataset, text_1, text_2, data_file_chunks, deduplicate, label, weight, \
+    ShardedDataset, is_sharded, IndexedDataset, indexed_data_file, index_dataset
+from bisemantic.embedders import load_embedder, canonical_specification, save_vectors, VectorsFileEmbedder, \
+    HashedSubwordEmbedder, SpacyEmbedder, Truncation, read_vocabulary, RegexTokenizerEmbedder
+from bisemantic.metrics import StreamingMetrics
+from bisemantic.registry import ModelRegistry, AsyncTextPairClassifier
+from bisemantic.search import EncodingIndex, spherical_k_means, nearest_centroids, top_k, normalize
+from bisemantic.weights import load_mapped_weights
 
 
 class TestPreprocess(TestCase):
@@ -44,6 +58,36 @@ class TestPreprocess(TestCase):
         self.assertEqual(3, len(actual))
         assert_array_equal([1, 3, 5], actual.index)
 
+    def test_load_data_in_chunks(self):
+        chunks = list(data_file_chunks("test/resources/train.csv", 30))
+        self.assertEqual([30, 30, 30, 10], [len(chunk) for chunk in chunks])
+        assert_array_equal(["text1", "text2", "label"], chunks[0].columns)
+        self.assertEqual([30, 15], [len(chunk) for chunk in data_file_chunks("test/resources/train.csv", 30, n=45)])
+        chunks = list(data_file_chunks("test/resources/data_with_null_values.csv", 2, index="id"))
+        assert_array_equal([1, 3, 5], pd.concat(chunks).index)
+
+    def test_deduplicate(self):
+        data = pd.DataFrame({text_1: ["a b", "a b", "c d", "e f g h i j k l", "a b", "e f g h i j k l m"],
+                             text_2: ["c d", "c d", "a b", "x", "c d", "x"],
+                             label: [0, 0, 0, 1, 1, 1]}, columns=[text_1, text_2, label])
+        exact = deduplicate(data)
+        assert_array_equal([0, 2, 3, 4, 5], exact.index)
+        assert_array_equal([2, 1, 1, 1, 1], exact[weight])
+        symmetric = deduplicate(data, symmetric=True)
+        assert_array_equal([0, 3, 4, 5], symmetric.index)
+        assert_array_equal([3, 1, 1, 1], symmetric[weight])
+        near = deduplicate(data, symmetric=True, near_duplicates=0.5)
+        assert_array_equal([0, 3, 4], near.index)
+        assert_array_equal([3, 2, 1], near[weight])
+        self.assertEqual(len(data), near[weight].sum())
+        # Deduplicating again adds the weights.
+        assert_array_equal([3, 2, 1], deduplicate(near, symmetric=True)[weight])
+
+    def test_load_deduplicated_data(self):
+        data = data_file("test/resources/train.csv", duplicates="symmetric")
+        assert_array_equal(["text1", "text2", "label", "weight"], data.columns)
+        self.assertEqual(100, data[weight].sum())
+
     def test_fix_columns_with_no_rename(self):
         train = fix_columns(self.train, text_1_name=None, text_2_name=None, label_name=None)
         assert_array_equal(["text1", "text2", "label"], train.columns)
@@ -63,6 +107,194 @@ class TestPreprocess(TestCase):
             self.assertEqual(20, len(s[1]))
 
 
+class TestCompiledDataset(TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.mkdtemp()
+        self.train = data_file("test/resources/train.csv")
+        self.compiled_directory = os.path.join(self.temporary_directory, "train.compiled")
+        self.compiled = compile_dataset(self.train, self.compiled_directory)
+
+    def test_compile(self):
+        self.assertIsInstance(self.compiled, CompiledDataset)
+        self.assertEqual(100, len(self.compiled))
+        assert_array_equal(["text1", "text2", "label"], self.compiled.columns)
+        assert_array_equal(self.train.index, self.compiled.index)
+        self.assertEqual([0, 1], self.compiled.classes)
+        compiled = data_file(self.compiled_directory, n=10)
+        self.assertIsInstance(compiled, CompiledDataset)
+        self.assertEqual(10, len(compiled))
+
+    def test_compile_in_worker_processes(self):
+        compiled = compile_dataset(self.train, os.path.join(self.temporary_directory, "parallel"), workers=2)
+        assert_array_equal(self.compiled.vocabulary, compiled.vocabulary)
+        assert_array_equal(self.compiled.lengths("text1"), compiled.lengths("text1"))
+
+    def test_cross_validate_compiled(self):
+        splits = cross_validation_partitions(self.compiled, 0.8, 2)
+        for train, validate in splits:
+            self.assertEqual(80, len(train))
+            self.assertEqual(20, len(validate))
+            self.assertEqual(set(), set(train.index) & set(validate.index))
+
+    def test_embed_compiled(self):
+        g = TextPairEmbeddingGenerator(self.train, batch_size=32, maximum_tokens=10)
+        expected = list(islice(g(), g.batches_per_epoch))
+        g = TextPairEmbeddingGenerator(self.compiled, batch_size=32)
+        self.assertEqual("TextPairEmbeddingGenerator: 100 samples, classes [0, 1], batch size 32, maximum tokens 40",
+                         str(g))
+        g = TextPairEmbeddingGenerator(self.compiled, batch_size=32, maximum_tokens=10)
+        for (embeddings, labels), (expected_embeddings, expected_labels) in zip(g(), expected):
+            assert_array_equal(expected_embeddings[0], embeddings[0])
+            assert_array_equal(expected_embeddings[1], embeddings[1])
+            assert_array_equal(expected_labels, labels)
+
+    def test_prune_compiled(self):
+        model_directory = os.path.join(self.temporary_directory, "model")
+        with self.assertRaises(ValueError):
+            TextPairClassifier.train(self.compiled, False, 16, 1, model_directory=model_directory, pruned_vectors=1)
+        self.assertFalse(os.path.exists(model_directory))
+
+    def tearDown(self):
+        shutil.rmtree(self.temporary_directory)
+
+
+class TestIndexedDataset(TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.mkdtemp()
+        self.data_filename = os.path.join(self.temporary_directory, "train.csv")
+        shutil.copy("test/resources/train.csv", self.data_filename)
+        self.train = data_file(self.data_filename)
+        self.indexed = indexed_data_file(self.data_filename)
+
+    def test_index(self):
+        self.assertIsInstance(self.indexed, IndexedDataset)
+        self.assertEqual(100, len(self.indexed))
+        assert_array_equal(["text1", "text2", "label"], self.indexed.columns)
+        assert_array_equal(self.train.index, self.indexed.index)
+        self.assertEqual([0, 1], self.indexed.classes)
+        assert_array_equal(self.train[text_1], self.indexed[text_1])
+        self.assertFalse(is_sharded(self.data_filename + ".index"))
+        indexed = data_file(self.data_filename + ".index", n=10)
+        self.assertIsInstance(indexed, IndexedDataset)
+        self.assertEqual(10, len(indexed))
+        compiled = compile_dataset(self.train, os.path.join(self.temporary_directory, "train.compiled"))
+        assert_array_equal(compiled.lengths(text_2), self.indexed.lengths(text_2))
+        batch = self.indexed.batch([17, 3, 17])
+        assert_array_equal(self.train[text_1].values[[17, 3, 17]], batch[text_1])
+        assert_array_equal(self.train[label].values[[17, 3, 17]], batch[label])
+
+    def test_reload_index(self):
+        metadata_filename = os.path.join(self.data_filename + ".index", "index.json")
+        modified = os.path.getmtime(metadata_filename)
+        indexed = indexed_data_file(self.data_filename, n=10)
+        self.assertIsInstance(indexed, IndexedDataset)
+        self.assertEqual(10, len(indexed))
+        self.assertEqual(modified, os.path.getmtime(metadata_filename))
+        # Different loading options make a new index.
+        indexed = indexed_data_file(self.data_filename, duplicates="exact")
+        assert_array_equal(["text1", "text2", "label", "weight"], indexed.columns)
+        self.assertEqual(100, indexed.batch(range(len(indexed)))[weight].sum())
+
+    def test_concurrently_built_index(self):
+        directory = self.data_filename + ".index"
+        metadata_filename = os.path.join(directory, "index.json")
+        modified = os.path.getmtime(metadata_filename)
+        # An index with the same key that another process installed first is kept.
+        indexed = index_dataset(self.train, directory, key=self.indexed.key)
+        self.assertEqual(modified, os.path.getmtime(metadata_filename))
+        self.assertEqual(100, len(indexed))
+        self.assertEqual([".index"], [os.path.splitext(name)[1] for name in os.listdir(self.temporary_directory)
+                                      if name.startswith("train.csv.")])
+
+    def test_embed_indexed(self):
+        g = TextPairEmbeddingGenerator(self.train, batch_size=32)
+        expected = list(islice(g(), g.batches_per_epoch))
+        g = TextPairEmbeddingGenerator(self.indexed, batch_size=32)
+        self.assertEqual("TextPairEmbeddingGenerator: 100 samples, classes [0, 1], batch size 32, maximum tokens 40",
+                         str(g))
+        for (embeddings, labels), (expected_embeddings, expected_labels) in zip(g(), expected):
+            assert_array_equal(expected_embeddings[0], embeddings[0])
+            assert_array_equal(expected_embeddings[1], embeddings[1])
+            assert_array_equal(expected_labels, labels)
+        g = TextPairEmbeddingGenerator(self.indexed, batch_size=32, curriculum_epochs=2, seed=0)
+        self.assertEqual(4, len(next(g.embedded_texts(np.array([5, 2, 9, 2])))[0]))
+
+    def test_cache_indexed(self):
+        model = TextPairClassifier.create(2, 40, 300, 16, None, False)
+        with PredictionCache(os.path.join(self.temporary_directory, "cache.db")) as cache:
+            model.predict(self.train.head(50), cache=cache)
+            predictions = model.predict(self.indexed, cache=cache)
+            self.assertEqual(100, len(cache))
+            assert_allclose(model.predict(self.train).values, predictions.values, rtol=1e-04)
+
+    def test_train_indexed(self):
+        train, validate = cross_validation_partitions(self.indexed, 0.8, 1, seed=0)[0]
+        model, history = TextPairClassifier.train(train, False, 16, 1, validation_data=validate)
+        self.assertEqual(["0", "1"], history.class_names)
+
+    def tearDown(self):
+        shutil.rmtree(self.temporary_directory)
+
+
+class TestShardedDataset(TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.mkdtemp()
+        self.shards_directory = os.path.join(self.temporary_directory, "shards")
+        os.makedirs(self.shards_directory)
+        self.train = load_data_file("test/resources/train.csv")
+        for i, start in enumerate(range(0, 100, 40)):
+            self.train[start:start + 40].to_csv(os.path.join(self.shards_directory, "train-%d.csv" % i), index=False)
+
+    def test_scan(self):
+        self.assertTrue(is_sharded(self.shards_directory))
+        self.assertTrue(is_sharded(os.path.join(self.shards_directory, "*.csv")))
+        self.assertFalse(is_sharded("test/resources/train.csv"))
+        shards = ShardedDataset(self.shards_directory, shuffle_buffer=30, chunk_size=7)
+        self.assertEqual("ShardedDataset(%s, 3 shards, 100 samples)" % self.shards_directory, repr(shards))
+        self.assertEqual([0, 1], shards.classes)
+        self.assertTrue(os.path.isfile(os.path.join(self.shards_directory, "train-0.csv.meta.json")))
+        # The metadata files are not shards.
+        shards = ShardedDataset(os.path.join(self.shards_directory, "*.csv"), classes=["1"])
+        self.assertEqual(3, len(shards.shards))
+        self.assertEqual(35, len(shards))
+
+    def test_batches(self):
+        shards = ShardedDataset(self.shards_directory, shuffle_buffer=30, chunk_size=7)
+        batches = list(shards.batches(32))
+        self.assertEqual([32, 32, 32, 4], [len(batch) for batch in batches])
+        samples = pd.concat(batches)
+        self.assertEqual(set(map(tuple, self.train.values)), set(map(tuple, samples.values)))
+        assert_array_equal(samples.values, pd.concat(shards.batches(32)).values)
+        self.assertFalse((samples.values == pd.concat(shards.batches(32, epoch=1)).values).all())
+        partitions = [pd.concat(shards.partition(k, 2).batches(32)) for k in range(2)]
+        self.assertEqual([50, 50], [len(partition) for partition in partitions])
+        self.assertEqual(set(), set(partitions[0][text_1] + partitions[0][text_2]) &
+                         set(partitions[1][text_1] + partitions[1][text_2]))
+
+    def test_embed_sharded(self):
+        shards = ShardedDataset(self.shards_directory, shuffle_buffer=30, chunk_size=7)
+        self.assertRaises(ValueError, TextPairEmbeddingGenerator, shards, batch_size=32)
+        g = TextPairEmbeddingGenerator(shards, batch_size=32, maximum_tokens=10)
+        self.assertEqual("TextPairEmbeddingGenerator: 100 samples, classes [0, 1], batch size 32, maximum tokens 10",
+                         str(g))
+        self.assertEqual(4, g.batches_per_epoch)
+        batches = list(islice(g(), 8))
+        self.assertEqual([32, 32, 32, 4] * 2, [len(labels) for _, labels in batches])
+        self.assertEqual(35, sum(labels.sum() for _, labels in batches[:4]))
+        # A generator that starts at a later pass draws the batches of that pass.
+        for (embeddings, labels), (expected_embeddings, expected_labels) in zip(g(1, initial_epoch=1), batches[5:8]):
+            assert_array_equal(expected_embeddings[0], embeddings[0])
+            assert_array_equal(expected_labels, labels)
+
+    def test_train_sharded(self):
+        shards = ShardedDataset(self.shards_directory, shuffle_buffer=30)
+        model, history = TextPairClassifier.train(shards, False, 16, 1, maximum_tokens=10)
+        self.assertEqual(["0", "1"], history.class_names)
+
+    def tearDown(self):
+        shutil.rmtree(self.temporary_directory)
+
+
 class TestNonCommaDelimited(TestCase):
     # The Standford textual entailment SNLI format uses spaces as delimiters instead of commas.
     def test_load_data_with_space_delimiter(self):
@@ -114,6 +346,98 @@ class TestTextPairEmbeddingGenerator(TestCase):
         two_epochs = list(islice(g(), 2 * g.batches_per_epoch))
         self._validate_labeled_batches(two_epochs, g.batches_per_epoch, 10, [32, 32, 32, 4] * 2)
 
+    def test_embed_labeled_in_worker_processes(self):
+        g = TextPairEmbeddingGenerator(self.labeled, batch_size=32, maximum_tokens=10)
+        expected = list(islice(g(), g.batches_per_epoch))
+        g = TextPairEmbeddingGenerator(self.labeled, batch_size=32, maximum_tokens=10, workers=2)
+        two_epochs = list(islice(g(), 2 * g.batches_per_epoch))
+        self._validate_labeled_batches(two_epochs, g.batches_per_epoch, 10, [32, 32, 32, 4] * 2)
+        for (embeddings, labels), (expected_embeddings, expected_labels) in zip(two_epochs, expected):
+            assert_array_equal(expected_embeddings[0], embeddings[0])
+            assert_array_equal(expected_embeddings[1], embeddings[1])
+            assert_array_equal(expected_labels, labels)
+
+    def test_concurrent_worker_pools(self):
+        long = TextPairEmbeddingGenerator(self.labeled, batch_size=32, maximum_tokens=10, workers=2)()
+        short = TextPairEmbeddingGenerator(self.labeled, batch_size=32, maximum_tokens=5, workers=2)()
+        for _ in range(3):
+            self.assertEqual((32, 10), next(long)[0][0].shape[:2])
+            self.assertEqual((32, 5), next(short)[0][0].shape[:2])
+
+    def test_embed_labeled_shards(self):
+        shards = [TextPairEmbeddingGenerator(self.labeled, batch_size=16, maximum_tokens=10, shard=(k, 3))
+                  for k in range(3)]
+        self.assertEqual([34, 33, 33], [len(g) for g in shards])
+        self.assertEqual([3, 3, 3], [g.batches_per_epoch for g in shards])
+        self.assertEqual([[0, 1]] * 3, [g.classes for g in shards])
+        self.assertEqual(set(), set(shards[0].data.index) & set(shards[1].data.index))
+        shards[0].resize(8)
+        self.assertEqual(5, shards[0].batches_per_epoch)
+        self.assertEqual([8] * 4 + [2], [len(labels) for _, labels in islice(shards[0](), 5)])
+
+    def test_embed_weighted(self):
+        weighted = self.labeled.assign(weight=np.arange(len(self.labeled), dtype=float))
+        g = TextPairEmbeddingGenerator(weighted, batch_size=32, maximum_tokens=10)
+        embeddings, labels, weights = next(g())
+        self.assertEqual(32, len(weights))
+        assert_array_equal(np.arange(32), weights)
+
+    def test_resize(self):
+        g = TextPairEmbeddingGenerator(self.labeled, batch_size=32, maximum_tokens=10)
+        g.resize(64)
+        self.assertEqual(2, g.batches_per_epoch)
+        self._validate_labeled_batches(list(islice(g(), 2)), g.batches_per_epoch, 10, [64, 36])
+
+    def test_swap_augmentation(self):
+        g = TextPairEmbeddingGenerator(self.labeled, batch_size=32, maximum_tokens=10, swap_augmentation=True)
+        self.assertEqual(8, g.batches_per_epoch)
+        self.assertEqual("TextPairEmbeddingGenerator: 100 samples, classes [0, 1], batch size 32, maximum tokens 10, "
+                         "swap augmentation", str(g))
+        (embeddings, labels), (swapped, swapped_labels) = islice(g(), 2)
+        assert_array_equal(embeddings[0], swapped[1])
+        assert_array_equal(embeddings[1], swapped[0])
+        assert_array_equal(labels, swapped_labels)
+        # Resuming from an odd batch starts with the swapped copy of a batch.
+        _, third_labels = list(islice(g(), 4))[3]
+        assert_array_equal(third_labels, next(g(initial_batch=3))[1])
+
+    def test_hard_example_sampling(self):
+        g = TextPairEmbeddingGenerator(self.labeled, batch_size=32, maximum_tokens=10, sample_fraction=0.5, seed=0)
+        self.assertEqual(2, g.batches_per_epoch)
+        self.assertEqual("TextPairEmbeddingGenerator: 100 samples, classes [0, 1], batch size 32, maximum tokens 10, "
+                         "sample fraction 0.50", str(g))
+        batches = list(islice(g(), 2))
+        self.assertEqual([32, 18], [len(labels) for _, labels in batches])
+        positions = g.take_epoch_positions(0)
+        self.assertEqual(50, len(set(positions)))
+        self.assertIsNone(g.take_epoch_positions(0))
+        # Once losses are known, the samples with the highest losses are drawn most often.
+        losses = np.full(100, 0.01)
+        losses[:5] = 10
+        g.record_losses(np.arange(100), losses)
+        positions = g._epoch_positions(1)
+        self.assertGreater(np.isin(positions, np.arange(5)).sum(), 25)
+        assert_array_equal(self.labeled[label].cat.codes.values[:5], g.label_codes(np.arange(5)))
+        self.assertRaises(ValueError, TextPairEmbeddingGenerator, self.unlabeled, maximum_tokens=10,
+                          sample_fraction=0.5)
+
+    def test_label_probability_targets(self):
+        targets = pd.DataFrame({"no": np.linspace(0, 1, 100), "yes": np.linspace(1, 0, 100)}, columns=["no", "yes"])
+        g = TextPairEmbeddingGenerator(self.labeled, batch_size=32, maximum_tokens=10, targets=targets)
+        self.assertEqual(["no", "yes"], g.classes)
+        batches = list(islice(g(), 4))
+        assert_allclose(targets.values[32:64], batches[1][1])
+        self.assertEqual((4, 2), batches[3][1].shape)
+        self.assertRaises(ValueError, TextPairEmbeddingGenerator, self.labeled, maximum_tokens=10,
+                          targets=targets.head(10))
+
+    def test_curriculum(self):
+        g = TextPairEmbeddingGenerator(self.labeled, batch_size=32, maximum_tokens=10, curriculum_epochs=4, seed=0)
+        lengths = self.labeled[text_1].str.len().values + self.labeled[text_2].str.len().values
+        shortest = np.sort(lengths)[24]
+        self.assertTrue((lengths[g._epoch_positions(0)] <= shortest).all())
+        self.assertEqual(100, len(set(g._epoch_positions(3))))
+
     def _validate_unlabeled_batches(self, batches, batches_per_epoch, expected_maximum_tokens,
                                     expected_batch_sizes):
         # Verify that we got the expected data.
@@ -159,6 +483,130 @@ class TestTextPairEmbeddingGenerator(TestCase):
             assert_array_equal(label_a, label_b)
 
 
+class TestEmbedders(TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.mkdtemp()
+        self.vectors_directory = os.path.join(self.temporary_directory, "vectors")
+        save_vectors(self.vectors_directory, ["the", "cat", "."], np.arange(12).reshape((3, 4)))
+        self.buckets_filename = os.path.join(self.temporary_directory, "buckets.npy")
+        np.save(self.buckets_filename, np.random.rand(100, 5).astype(np.float32))
+
+    def test_canonical_specification(self):
+        self.assertEqual("spacy:en", canonical_specification(None))
+        self.assertEqual("spacy:en", canonical_specification("en"))
+        self.assertEqual("vectors:/tmp/vectors", canonical_specification("vectors:/tmp/vectors"))
+        self.assertRaises(ValueError, canonical_specification, "bogus:en")
+
+    def test_incomplete_embedder(self):
+        class Incomplete(RegexTokenizerEmbedder):
+            kind = "incomplete"
+
+        self.assertRaises(TypeError, Incomplete, "argument")
+
+    def test_spacy_embedder(self):
+        embedder = load_embedder()
+        self.assertIsInstance(embedder, SpacyEmbedder)
+        self.assertIs(embedder, load_embedder("en"))
+        self.assertEqual(300, embedder.embedding_size)
+
+    def test_vectors_file_embedder(self):
+        embedder = load_embedder("vectors:" + self.vectors_directory)
+        self.assertIsInstance(embedder, VectorsFileEmbedder)
+        self.assertEqual(4, embedder.embedding_size)
+        self.assertEqual([["The", "cat", "sat", "."]], list(embedder.tokenize(["The cat sat."])))
+        embedding = list(embedder.embed(["The cat sat."]))[0]
+        assert_array_equal([[0, 1, 2, 3], [4, 5, 6, 7], [0, 0, 0, 0], [8, 9, 10, 11]], embedding)
+
+    def test_vocabulary_line_breaks(self):
+        directory = os.path.join(self.temporary_directory, "line-breaks")
+        words = ["a\x1cb", "c\u2028d", "e\rf", "g\nh", "cat"]
+        save_vectors(directory, words, np.arange(10).reshape((5, 2)))
+        self.assertEqual(words, read_vocabulary(directory))
+        assert_array_equal([[8, 9]], VectorsFileEmbedder(directory).embed_tokens(["cat"]))
+        # Vocabularies written by earlier versions have a word on each line.
+        os.remove(os.path.join(directory, "vocabulary.json"))
+        with open(os.path.join(directory, "vocabulary.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write("a\x1cb\nc\u2028d\ne\rf\ncat\n")
+        self.assertEqual(["a\x1cb", "c\u2028d", "e\rf", "cat"], read_vocabulary(directory))
+
+    def test_hashed_subword_embedder(self):
+        embedder = load_embedder("subword:" + self.buckets_filename)
+        self.assertIsInstance(embedder, HashedSubwordEmbedder)
+        self.assertEqual(5, embedder.embedding_size)
+        embedding = list(embedder.embed(["An unseenword"]))[0]
+        self.assertEqual((2, 5), embedding.shape)
+        assert_array_equal(embedding[1], embedder.embed_tokens(["unseenword"])[0])
+
+    def test_truncation(self):
+        embedding = np.arange(5)[:, np.newaxis]
+        assert_array_equal([[0], [1], [2]], Truncation().truncate(embedding, 3))
+        assert_array_equal([[2], [3], [4]], Truncation("tail").truncate(embedding, 3))
+        assert_array_equal([[0], [1], [4]], Truncation("head-tail").truncate(embedding, 3))
+        assert_array_equal(embedding, Truncation("head-tail").truncate(embedding, 10))
+        truncation = Truncation.from_specification("tail:stopwords,punctuation")
+        self.assertEqual("tail:punctuation,stopwords", truncation.specification)
+        self.assertEqual(Truncation("tail", ["punctuation", "stopwords"]), truncation)
+        self.assertRaises(ValueError, Truncation, "middle")
+        self.assertRaises(ValueError, Truncation, "head", ["nouns"])
+
+    def test_drop_tokens(self):
+        embedder = load_embedder("vectors:" + self.vectors_directory)
+        self.assertEqual(["cat", "sat"],
+                         embedder.filter_tokens(["The", "cat", "sat", "."], ["stopwords", "punctuation"]))
+        embedding = list(embedder.embed(["The cat sat."], ["punctuation"]))[0]
+        assert_array_equal([[0, 1, 2, 3], [4, 5, 6, 7], [0, 0, 0, 0]], embedding)
+        spacy_embedder = load_embedder()
+        self.assertEqual(["cat", "sat"],
+                         spacy_embedder.filter_tokens(["the", "cat", "sat", "."], ["stopwords", "punctuation"]))
+        self.assertEqual((2, 300), list(spacy_embedder.embed(["The cat sat."], ["stopwords", "punctuation"]))[0].shape)
+
+    def test_generator_with_embedder(self):
+        embedder = load_embedder("vectors:" + self.vectors_directory)
+        g = TextPairEmbeddingGenerator(load_data_file("test/resources/test.csv"), batch_size=4, embedder=embedder)
+        batch = next(g())
+        self.assertEqual((4, g.maximum_tokens, 4), batch[0].shape)
+
+    def test_train_with_embedder(self):
+        model_directory = os.path.join(self.temporary_directory, "model")
+        specification = "vectors:" + self.vectors_directory
+        TextPairClassifier.train(load_data_file("test/resources/train.csv").head(20), False, 16, 1,
+                                 maximum_tokens=10, model_directory=model_directory, embedder=specification)
+        model = TextPairClassifier.load_from_model_directory(model_directory)
+        self.assertEqual(specification, model.embedder_specification)
+        self.assertEqual(4, model.embedding_size)
+
+    def test_train_with_truncation(self):
+        model_directory = os.path.join(self.temporary_directory, "model")
+        _, history = TextPairClassifier.train(load_data_file("test/resources/train.csv").head(20), False, 16, 1,
+                                              maximum_tokens=5, model_directory=model_directory,
+                                              truncation="head-tail:punctuation")
+        self.assertIn("truncation head-tail:punctuation", history.runs[0]["training"])
+        model = TextPairClassifier.load_from_model_directory(model_directory)
+        self.assertEqual(Truncation("head-tail", ["punctuation"]), model.truncation)
+
+    def test_train_with_pruned_vectors(self):
+        model_directory = os.path.join(self.temporary_directory, "model")
+        TextPairClassifier.train(load_data_file("test/resources/train.csv").head(20), False, 16, 1,
+                                 maximum_tokens=10, model_directory=model_directory,
+                                 embedder="vectors:" + self.vectors_directory, pruned_vectors=1)
+        vectors_directory = os.path.join(model_directory, "vectors")
+        self.assertTrue(os.path.isfile(os.path.join(vectors_directory, "vectors.npy")))
+        vocabulary = read_vocabulary(vectors_directory)
+        self.assertEqual("the", vocabulary[0])
+        self.assertEqual(len(vocabulary), len(set(vocabulary)))
+        # Move the model directory to make sure the vectors are found relative to it.
+        moved_model_directory = os.path.join(self.temporary_directory, "moved")
+        shutil.move(model_directory, moved_model_directory)
+        model = TextPairClassifier.load_from_model_directory(moved_model_directory)
+        self.assertEqual("vectors:" + os.path.join(moved_model_directory, "vectors"), model.embedder_specification)
+        self.assertEqual(model.embedder_specification,
+                         TextPairClassifier.embedder_specification_from_model_directory(moved_model_directory))
+        self.assertEqual(9, len(model.predict(load_data_file("test/resources/test.csv"))))
+
+    def tearDown(self):
+        shutil.rmtree(self.temporary_directory)
+
+
 class TestModel(TestCase):
     def setUp(self):
         data = load_data_file("test/resources/train.csv")
@@ -238,6 +686,271 @@ class TestModel(TestCase):
         self.assertIsInstance(model, TextPairClassifier)
         self.assertIsInstance(history, TrainingHistory)
 
+    def test_train_checkpoints(self):
+        TextPairClassifier.train(self.train.head(20), False, 16, 3, maximum_tokens=10,
+                                 model_directory=self.model_directory, checkpoint_every=1, keep_checkpoints=2)
+        self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "model.h5")))
+        self.assertFalse(os.path.isfile(os.path.join(self.model_directory, "model.epoch-001.h5")))
+        self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "model.epoch-002.h5")))
+        self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "model.epoch-003.h5")))
+        epochs = read_epoch_history(os.path.join(self.model_directory, "epoch-history.jsonl"))
+        self.assertEqual([1, 2, 3], [epoch["epoch"] for epoch in epochs])
+        self.assertEqual(1, len(set(epoch["run"] for epoch in epochs)))
+        self.assertIn("loss", epochs[0])
+
+    def test_continue_after_allocation_failure(self):
+        fit = TextPairClassifier.fit
+        initial_epochs = []
+
+        def fail_after_first_epoch(model, training, **options):
+            initial_epochs.append(options.get("initial_epoch", 0))
+            if len(initial_epochs) == 1:
+                fit(model, training, **dict(options, epochs=1))
+                raise MemoryError()
+            return fit(model, training, **options)
+
+        TextPairClassifier.fit = fail_after_first_epoch
+        try:
+            _, history = TextPairClassifier.train(self.train.head(20), False, 16, 3, maximum_tokens=10, batch_size=8,
+                                                  model_directory=self.model_directory)
+        finally:
+            TextPairClassifier.fit = fit
+        self.assertEqual([0, 1], initial_epochs)
+        self.assertEqual(3, len(history.runs[-1]["history"]["loss"]))
+        epochs = read_epoch_history(os.path.join(self.model_directory, "epoch-history.jsonl"))
+        self.assertEqual([1, 2, 3], [epoch["epoch"] for epoch in epochs])
+        self.assertEqual(1, len(set(epoch["run"] for epoch in epochs)))
+
+    def test_resume_training(self):
+        model, _ = TextPairClassifier.train(self.train, False, 16, 1, maximum_tokens=10,
+                                            model_directory=self.model_directory)
+        resume_filename = os.path.join(self.model_directory, "resume.h5")
+        self.assertFalse(os.path.isfile(resume_filename))
+        # Simulate a run that was interrupted after the second batch of its first epoch.
+        checkpoint = ResumeCheckpoint(resume_filename,
+                                      {"run": "interrupted", "epochs": 2, "batch-size": 16, "samples": len(self.train)})
+        checkpoint.set_model(model.model)
+        checkpoint.on_train_begin()
+        checkpoint._save(0, 2)
+        checkpoint.on_train_end()
+        self.assertEqual({"run": "interrupted", "epochs": 2, "batch-size": 16, "samples": 80, "epoch": 0, "batch": 2},
+                         read_resume_state(resume_filename))
+        model, history = TextPairClassifier.resume_training(self.train, self.model_directory)
+        self.assertFalse(os.path.isfile(resume_filename))
+        self.assertEqual("interrupted", history.runs[-1]["run"])
+        self.assertEqual(2, len(history.runs[-1]["history"]["loss"]))
+        self.assertRaises(ValueError, TextPairClassifier.resume_training, self.train, self.model_directory)
+
+    def test_resume_sampled_training(self):
+        model, _ = TextPairClassifier.train(self.train, False, 16, 1, maximum_tokens=10,
+                                            model_directory=self.model_directory)
+        resume_filename = os.path.join(self.model_directory, "resume.h5")
+        g = TextPairEmbeddingGenerator(self.train, batch_size=16, maximum_tokens=10, sample_fraction=0.5, seed=0)
+        losses = np.linspace(0, 1, len(self.train))
+        g.record_losses(np.arange(len(self.train)), losses)
+        g.sampled_epochs, g.trained_samples, g.scored_samples = 1, 40, 35
+        checkpoint = ResumeCheckpoint(resume_filename,
+                                      {"run": "interrupted", "epochs": 2, "batch-size": 16, "samples": len(self.train),
+                                       "sample-fraction": 0.5, "seed": 0}, generator=g)
+        checkpoint.set_model(model.model)
+        checkpoint.on_train_begin()
+        checkpoint._save(1, 0)
+        checkpoint.on_train_end()
+        assert_array_equal(losses, read_resume_sample_losses(resume_filename))
+        self.assertEqual(40, read_resume_state(resume_filename)["trained-samples"])
+        model, history = TextPairClassifier.resume_training(self.train, self.model_directory)
+        self.assertEqual(2, history.runs[-1]["sampling"]["epochs"])
+        self.assertEqual(80, history.runs[-1]["sampling"]["trained-samples"])
+
+    def test_mapped_weights(self):
+        model, _ = TextPairClassifier.train(self.train, False, 16, 1, maximum_tokens=10,
+                                            model_directory=self.model_directory)
+        mapped_filename = os.path.join(self.model_directory, "model.weights")
+        self.assertTrue(os.path.isfile(mapped_filename))
+        architecture, weights = load_mapped_weights(mapped_filename)
+        self.assertTrue(all(isinstance(w, np.memmap) and not w.flags.writeable for w in weights))
+        for expected, w in zip(model.model.get_weights(), weights):
+            assert_array_equal(expected, w)
+        mapped = TextPairClassifier.load_from_model_directory(self.model_directory)
+        self.assertEqual(model.fingerprint, mapped.fingerprint)
+        assert_allclose(model.predict(self.test).values, mapped.predict(self.test).values, rtol=1e-05)
+        # A missing file is only rewritten from the model file if requested.
+        os.remove(mapped_filename)
+        TextPairClassifier.load_from_model_directory(self.model_directory)
+        self.assertFalse(os.path.isfile(mapped_filename))
+        TextPairClassifier.load_from_model_directory(self.model_directory, write_mapped_weights=True)
+        self.assertTrue(os.path.isfile(mapped_filename))
+
+    def test_encoder_and_head(self):
+        model = TextPairClassifier.create(2, 30, 300, 16, 0.5, False)
+        encodings_1 = model.encode(self.test[text_1])
+        encodings_2 = model.encode(self.test[text_2])
+        self.assertEqual((len(self.test), 16), encodings_1.shape)
+        assert_allclose(model.predict(self.test).values,
+                        model.head_model().predict([encodings_1, encodings_2]), rtol=1e-04, atol=1e-06)
+        # The derived models are only built once.
+        self.assertIs(model.head_model(), model.head_model())
+        self.assertIs(model.encoder_model(), model.encoder_model())
+        self.assertIs(model.symmetric_model(), model.symmetric_model())
+
+    def test_prediction_output(self):
+        model = TextPairClassifier.create(2, 30, 300, 16, None, False)
+        probabilities = model.predict(self.test, class_names=["no", "yes"])
+        labels = model.predict(self.test, class_names=["no", "yes"], output="label")
+        self.assertEqual([label], list(labels.columns))
+        assert_array_equal(np.where(probabilities["yes"] > probabilities["no"], "yes", "no"), labels[label])
+        top = model.predict(self.test, class_names=["no", "yes"], output="top", k=2)
+        self.assertEqual(["label_1", "probability_1", "label_2", "probability_2"], list(top.columns))
+        assert_allclose(probabilities.max(axis=1), top["probability_1"], rtol=1e-04)
+        self.assertTrue((top["probability_1"] >= top["probability_2"]).all())
+        filtered = model.predict(self.test, class_names=["no", "yes"], threshold=("yes", 0.5))
+        assert_array_equal(probabilities.index[probabilities["yes"] > 0.5], filtered.index)
+        self.assertRaises(ValueError, model.predict, self.test, threshold=("maybe", 0.5))
+
+    def test_prediction_cache(self):
+        model = TextPairClassifier.create(2, 30, 300, 16, None, False)
+        with PredictionCache(os.path.join(self.temporary_directory, "cache.db")) as cache:
+            predictions = model.predict(self.test, cache=cache)
+            self.assertEqual(len(self.test), len(cache))
+            assert_allclose(model.predict(self.test).values, predictions.values, rtol=1e-04)
+            keys = cache.pair_keys(self.test[text_1], self.test[text_2])
+            _, found = cache.get(model.fingerprint, keys, 2)
+            self.assertTrue(found.all())
+            assert_allclose(predictions.values, model.predict(self.test, cache=cache).values)
+            scores = dict(model.score(self.train, cache=cache))
+            assert_allclose(list(dict(model.score(self.train)).values()), list(scores.values()), rtol=1e-03)
+            # A different model does not use these predictions.
+            _, found = cache.get(TextPairClassifier.create(2, 30, 300, 16, None, False).fingerprint, keys, 2)
+            self.assertFalse(found.any())
+
+    def test_fingerprint(self):
+        model = TextPairClassifier.create(2, 30, 300, 16, None, False)
+        fingerprint = model.fingerprint
+        self.assertEqual(fingerprint, model.fingerprint)
+        model.fit(TextPairEmbeddingGenerator(self.train, maximum_tokens=30, batch_size=32))
+        self.assertNotEqual(fingerprint, model.fingerprint)
+
+    def test_symmetric_prediction(self):
+        model = TextPairClassifier.create(2, 30, 300, 16, None, False)
+        swapped = self.test.rename(columns={text_1: text_2, text_2: text_1})
+        symmetric = model.predict(self.test, symmetric=True)
+        assert_allclose((model.predict(self.test).values + model.predict(swapped).values) / 2, symmetric.values,
+                        rtol=1e-04, atol=1e-06)
+        assert_allclose(symmetric.values, model.predict(swapped, symmetric=True).values, rtol=1e-04, atol=1e-06)
+
+    def test_train_swap_augmentation(self):
+        _, history = TextPairClassifier.train(self.train, False, 16, 1, maximum_tokens=30, swap_augmentation=True)
+        self.assertIn("swap augmentation", history.runs[0]["training"])
+
+    def test_configure_backend(self):
+        configure_backend(seed=1, intra_op_threads=1, inter_op_threads=1)
+        first = TextPairClassifier.create(2, 30, 300, 16, None, False).model.get_weights()
+        configure_backend(seed=1, intra_op_threads=1, inter_op_threads=1)
+        second = TextPairClassifier.create(2, 30, 300, 16, None, False).model.get_weights()
+        for a, b in zip(first, second):
+            assert_array_equal(a, b)
+        _, history = TextPairClassifier.train(self.train, False, 16, 1, maximum_tokens=30)
+        self.assertEqual({"seed": 1, "intra-op-threads": 1, "inter-op-threads": 1}, history.runs[0]["backend"])
+        self.assertIn("Backend: inter-op-threads=1, intra-op-threads=1, seed=1", history.latest_run_summary())
+        configure_backend()
+
+    def test_training_history_storage(self):
+        _, history = TextPairClassifier.train(self.train, False, 16, 1, maximum_tokens=30,
+                                              model_directory=self.model_directory)
+        # Convert the model directory to the format of earlier versions.
+        legacy_filename = os.path.join(self.model_directory, "training-history.json")
+        with open(legacy_filename, "w") as f:
+            json.dump(history.runs, f)
+        os.remove(os.path.join(self.model_directory, "training-history.jsonl"))
+        manifest_filename = os.path.join(self.model_directory, "manifest.json")
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+        self.assertEqual(["0", "1"], manifest.pop("class-names"))
+        with open(manifest_filename, "w") as f:
+            json.dump(manifest, f)
+        self.assertEqual(["0", "1"], TextPairClassifier.class_names_from_model_directory(self.model_directory))
+        _, history = TextPairClassifier.continue_training(self.train, 1, self.model_directory)
+        self.assertEqual("Training history, 1 runs", str(history))
+        self.assertFalse(os.path.isfile(legacy_filename))
+        history_filename = os.path.join(self.model_directory, "training-history.jsonl")
+        with open(history_filename) as f:
+            self.assertEqual(2, len(f.readlines()))
+        self.assertEqual(history.runs, TrainingHistory.load(history_filename, last=1).runs)
+        summary = TextPairClassifier.training_history_from_model_directory(self.model_directory).summary()
+        self.assertEqual([80, 80], list(summary["samples"]))
+        self.assertEqual([1, 1], list(summary["epochs"]))
+        self.assertTrue((summary["samples/second"] > 0).all())
+
+    def test_throughput_metrics(self):
+        _, history = TextPairClassifier.train(self.train, False, 16, 2, maximum_tokens=30, batch_size=32,
+                                              model_directory=self.model_directory)
+        metrics = history.runs[0]["history"]
+        for name in ["epoch_seconds", "samples_per_second", "wait_seconds", "peak_memory"]:
+            self.assertEqual(2, len(metrics[name]))
+        self.assertTrue(all(rate > 0 for rate in metrics["samples_per_second"]))
+        self.assertIn("Throughput:", history.latest_run_summary())
+        records = read_epoch_history(os.path.join(self.model_directory, "epoch-history.jsonl"))
+        self.assertIn("samples_per_second", records[0])
+        self.assertIn("waiting", history.summary().columns)
+
+    def test_wait_excludes_callbacks(self):
+        throughput = ThroughputLog()
+        throughput.on_epoch_begin(0)
+        for batch in range(2):
+            throughput.on_batch_begin(batch)
+            throughput.on_batch_end(batch, {"size": 4})
+            # A slow callback between the two.
+            time.sleep(0.2)
+            throughput.fetch_start.on_batch_end(batch)
+        logs = {}
+        throughput.on_epoch_end(0, logs)
+        self.assertLess(logs["wait_seconds"], 0.1)
+        self.assertEqual(8 / logs["epoch_seconds"], logs["samples_per_second"])
+
+    def test_train_hard_examples(self):
+        _, history = TextPairClassifier.train(self.train, False, 16, 2, maximum_tokens=30, sample_fraction=0.5,
+                                              curriculum_epochs=1)
+        sampling = history.runs[0]["sampling"]
+        self.assertEqual({"samples": 80, "epochs": 2, "trained-samples": 80}, dict(
+            (k, sampling[k]) for k in ("samples", "epochs", "trained-samples")))
+        self.assertLessEqual(sampling["scored-samples"], 80)
+        self.assertIn("Sampling: trained on 80", history.latest_run_summary())
+
+    def test_score_chunks(self):
+        model = TextPairClassifier.create(2, 30, 300, 16, None, False)
+        metrics = model.score_chunks(data_file_chunks("test/resources/train.csv", 30), [0, 1])
+        self.assertEqual(100, metrics.samples)
+        scores = dict(model.score(self.train.append(self.validate)))
+        assert_allclose(scores["loss"], metrics.loss, rtol=1e-03)
+        assert_allclose(scores["acc"], metrics.accuracy)
+
+    def test_batch_size_for_memory(self):
+        model = TextPairClassifier.create(2, 40, 300, 128, None, False)
+        prediction = model.batch_size_for_memory(2 ** 30)
+        training = model.batch_size_for_memory(2 ** 30, training=True)
+        self.assertGreater(prediction, training)
+        self.assertGreater(model.batch_size_for_memory(2 ** 31), prediction)
+        self.assertGreater(prediction, model.batch_size_for_memory(2 ** 30, workers=4))
+        self.assertRaises(ValueError, model.batch_size_for_memory, 2 ** 10)
+
+    def test_shrink_batches_on_failure(self):
+        attempts = []
+
+        def operation(batch_size):
+            attempts.append(batch_size)
+            if batch_size > 100:
+                raise MemoryError()
+            return batch_size
+
+        self.assertEqual(64, TextPairClassifier._shrink_batches_on_failure(operation, 512))
+        self.assertEqual([512, 256, 128, 64], attempts)
+
+    def test_train_with_memory_budget(self):
+        model, history = TextPairClassifier.train(self.train, False, 16, 1, maximum_tokens=30,
+                                                  memory_budget=2 ** 25)
+        self.assertIn("batch size %d," % model.batch_size_for_memory(2 ** 25, training=True),
+                      history.runs[0]["training"])
+
     def test_train_no_model_directory(self):
         model, history = TextPairClassifier.train(self.train.head(20), False, 128, 1, dropout=0.5, maximum_tokens=30)
         self.assertIsInstance(model, TextPairClassifier)
@@ -247,6 +960,199 @@ class TestModel(TestCase):
         shutil.rmtree(self.temporary_directory)
 
 
+class TestStreamingMetrics(TestCase):
+    def test_metrics(self):
+        probabilities = np.array([[0.9, 0.1], [0.6, 0.4], [0.3, 0.7], [0.2, 0.8], [0.7, 0.3]])
+        codes = np.array([0, 1, 1, 1, 0])
+        metrics = StreamingMetrics(["no", "yes"])
+        metrics.update(probabilities[:2], codes[:2])
+        metrics.update(probabilities[2:], codes[2:])
+        self.assertEqual(5, metrics.samples)
+        assert_allclose(-np.log([0.9, 0.4, 0.7, 0.8, 0.7]).mean(), metrics.loss)
+        assert_allclose(0.8, metrics.accuracy)
+        assert_array_equal([[2, 0], [1, 2]], metrics.confusion_matrix)
+        assert_allclose([2 / 3, 1], metrics.precision)
+        assert_allclose([1, 2 / 3], metrics.recall)
+        assert_allclose([0.8, 0.8], metrics.f1)
+        assert_array_equal([2, 3], metrics.support)
+        # Every positive sample is ranked above every negative one.
+        assert_allclose([1, 1], metrics.roc_auc)
+        self.assertEqual(["loss", "acc", "auc", "ece"], [name for name, _ in metrics.results()])
+        self.assertIn("Confusion matrix", metrics.report())
+
+    def test_label_codes(self):
+        metrics = StreamingMetrics([0, 1])
+        assert_array_equal([1, 0, -1], metrics.label_codes(pd.Series(["1", "0", "2"])))
+        metrics = StreamingMetrics(["contradiction", "entailment", "neutral"])
+        assert_array_equal([2, 0], metrics.label_codes(pd.Series(["neutral", "contradiction"])))
+
+
+class TestPredictionCache(TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temporary_directory, "cache.db")
+
+    def test_get_and_put(self):
+        keys = PredictionCache.pair_keys(["a", "b", "c"], ["x", "y", "z"])
+        self.assertEqual(3, len(set(keys)))
+        with PredictionCache(self.filename) as cache:
+            cache.put("model", keys[:2], np.array([[0.1, 0.9], [0.8, 0.2]]))
+            probabilities, found = cache.get("model", keys, 2)
+            assert_array_equal([True, True, False], found)
+            assert_allclose([[0.1, 0.9], [0.8, 0.2]], probabilities[:2])
+            _, found = cache.get("other model", keys, 2)
+            self.assertFalse(found.any())
+        with PredictionCache(self.filename) as cache:
+            self.assertEqual(2, len(cache))
+
+    def test_least_recently_used_eviction(self):
+        keys = PredictionCache.pair_keys(["a", "b", "c"], ["x", "y", "z"])
+        with PredictionCache(self.filename, maximum_size=2) as cache:
+            cache.put("model", keys[:2], np.array([[0.1, 0.9], [0.8, 0.2]]))
+            cache.get("model", keys[:1], 2)
+            cache.put("model", keys[2:], np.array([[0.5, 0.5]]))
+            self.assertEqual(2, len(cache))
+            _, found = cache.get("model", keys, 2)
+            assert_array_equal([True, False, True], found)
+
+    def tearDown(self):
+        shutil.rmtree(self.temporary_directory)
+
+
+class TestSearch(TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.mkdtemp()
+        self.model_directory = os.path.join(self.temporary_directory, "model")
+        self.index_directory = os.path.join(self.temporary_directory, "index")
+        data = load_data_file("test/resources/train.csv")
+        TextPairClassifier.train(data, False, 16, 1, maximum_tokens=30, model_directory=self.model_directory)
+        self.texts = pd.concat([data[text_1], data[text_2]], ignore_index=True)
+
+    def test_k_means(self):
+        vectors = normalize(np.array([[1, 0.1], [1, -0.1], [-0.1, 1], [0.1, 1]]))
+        centroids = spherical_k_means(vectors, 2, seed=0)
+        assignments = nearest_centroids(vectors, centroids)
+        self.assertEqual(assignments[0], assignments[1])
+        self.assertEqual(assignments[2], assignments[3])
+        self.assertNotEqual(assignments[0], assignments[2])
+        assert_array_equal([[2, 0], [0, 1]], top_k(np.array([[0.2, 0.1, 0.9], [0.8, 0.5, 0.3]]), 2))
+
+    def test_index_and_search(self):
+        index = EncodingIndex.build(self.model_directory, self.texts, self.index_directory, clusters=4, seed=0)
+        self.assertEqual("EncodingIndex(%d texts, 4 clusters)" % len(self.texts), repr(index))
+        index = EncodingIndex(self.index_directory)
+        self.assertEqual(len(self.texts), len(index))
+        queries = self.texts.head(5)
+        # Searching every cluster is an exhaustive search, so every query finds itself.
+        candidates = index.search(queries, k=3, probes=4, class_names=["no", "yes"])
+        self.assertEqual(["query", "candidate", "similarity", "no", "yes"], list(candidates.columns))
+        self.assertEqual(15, len(candidates))
+        for query, matches in candidates.groupby("query"):
+            self.assertIn(query, matches["candidate"].values)
+            assert_allclose(1, matches["similarity"].max(), rtol=1e-04)
+        assert_allclose(ones(len(candidates)), candidates[["no", "yes"]].sum(axis=1), rtol=1e-04)
+
+    def tearDown(self):
+        shutil.rmtree(self.temporary_directory)
+
+
+class TestDistillation(TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.mkdtemp()
+        self.teacher_directory = os.path.join(self.temporary_directory, "teacher")
+        self.student_directory = os.path.join(self.temporary_directory, "student")
+        self.data = load_data_file("test/resources/train.csv")
+        TextPairClassifier.train(self.data, True, 32, 1, maximum_tokens=30, model_directory=self.teacher_directory)
+
+    def test_distill(self):
+        unlabeled = self.data[[text_1, text_2]]
+        with PredictionCache(os.path.join(self.temporary_directory, "cache.db")) as cache:
+            student, history = TextPairClassifier.distill(self.teacher_directory, unlabeled, 8, 2,
+                                                          model_directory=self.student_directory, cache=cache)
+            self.assertEqual(len(unlabeled), len(cache))
+        self.assertEqual(2, len(history.runs[0]["history"]["loss"]))
+        self.assertEqual(["0", "1"], TextPairClassifier.class_names_from_model_directory(self.student_directory))
+        student = TextPairClassifier.load_from_model_directory(self.student_directory, optimizer_state=True)
+        self.assertEqual(30, student.maximum_tokens)
+        # The student is compiled to train on labels like any other model.
+        TextPairClassifier.continue_training(self.data, 1, self.student_directory)
+        teacher = TextPairClassifier.load_from_model_directory(self.teacher_directory)
+        comparison = compare_models([("teacher", teacher), ("student", student)], self.data, [0, 1])
+        self.assertEqual(["parameters", "pairs/second", "agreement", "accuracy"], list(comparison.columns))
+        self.assertEqual(1, comparison.loc["teacher", "agreement"])
+        self.assertGreater(comparison.loc["teacher", "parameters"], comparison.loc["student", "parameters"])
+
+    def tearDown(self):
+        shutil.rmtree(self.temporary_directory)
+
+
+class TestModelRegistry(TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.mkdtemp()
+        self.model_directory = os.path.join(self.temporary_directory, "model")
+        TextPairClassifier.train(load_data_file("test/resources/train.csv"), False, 16, 1, maximum_tokens=30,
+                                 model_directory=self.model_directory)
+        self.test = load_data_file("test/resources/test.csv")
+        self.pairs = list(zip(self.test[text_1], self.test[text_2]))
+
+    def test_predict_pairs(self):
+        expected = TextPairClassifier.load_from_model_directory(self.model_directory).predict(self.test)
+        with ModelRegistry() as registry:
+            futures = [registry.submit(self.model_directory, self.pairs[i:i + 2]) for i in range(0, 9, 2)]
+            predictions = pd.concat([future.result() for future in futures], ignore_index=True)
+            self.assertEqual([0, 1], list(predictions.columns))
+            assert_allclose(expected.values, predictions.values, rtol=1e-04)
+            self.assertEqual(0, len(registry.predict_pairs(self.model_directory, [])))
+            self.assertEqual([self.model_directory], registry.loaded)
+            self.assertRaises(IOError, registry.predict_pairs, os.path.join(self.temporary_directory, "none"),
+                              self.pairs)
+
+    def test_eviction(self):
+        other_model_directory = os.path.join(self.temporary_directory, "other")
+        shutil.copytree(self.model_directory, other_model_directory)
+        with ModelRegistry(maximum_memory=1) as registry:
+            expected = registry.predict_pairs(self.model_directory, self.pairs)
+            session = registry._models[self.model_directory].session
+            registry.predict_pairs(other_model_directory, self.pairs)
+            self.assertEqual([other_model_directory], registry.loaded)
+            self.assertGreater(registry.memory, 0)
+            # The evicted model's session is closed and a reloaded model gets a new one.
+            self.assertTrue(session._closed)
+            assert_allclose(expected.values, registry.predict_pairs(self.model_directory, self.pairs).values,
+                            rtol=1e-05)
+            self.assertIsNot(session.graph, registry._models[self.model_directory].session.graph)
+
+    def test_submit_after_close(self):
+        registry = ModelRegistry()
+        future = registry.submit(self.model_directory, self.pairs)
+        registry.close()
+        self.assertEqual(len(self.pairs), len(future.result(0)))
+        self.assertRaises(RuntimeError, registry.submit, self.model_directory, self.pairs)
+        registry.close()
+
+    def test_async_predict(self):
+        expected = TextPairClassifier.load_from_model_directory(self.model_directory).predict(self.test)
+
+        async def predict():
+            async with AsyncTextPairClassifier(self.model_directory, maximum_pending=2) as classifier:
+                predictions = await asyncio.gather(*(classifier.predict(self.pairs[i:i + 2]) for i in range(0, 9, 2)))
+                cancelled = asyncio.ensure_future(classifier.predict(self.pairs))
+                cancelled.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await cancelled
+                self.assertEqual(len(self.pairs), len(await classifier.predict(self.pairs)))
+                return pd.concat(predictions, ignore_index=True)
+
+        loop = asyncio.new_event_loop()
+        try:
+            assert_allclose(expected.values, loop.run_until_complete(predict()).values, rtol=1e-04)
+        finally:
+            loop.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temporary_directory)
+
+
 class TestCommandLine(TestCase):
     def setUp(self):
         self.temporary_directory = tempfile.mkdtemp()
@@ -256,7 +1162,14 @@ class TestCommandLine(TestCase):
         actual = main_function_output([])
         self.assertEqual(
             "usage: bisemantic [-h] [--version] [--log LEVEL]\n                  " +
-            "{train,continue,predict,score,cross-validation} ...\n", actual)
+            "{train,continue,predict,score,cross-validation,compile,index,search,distill,history}\n" +
+            "                  ...\n", actual)
+
+    def test_memory_size(self):
+        self.assertEqual(1000, memory_size("1000"))
+        self.assertEqual(16 * 2 ** 30, memory_size("16G"))
+        self.assertEqual(512 * 2 ** 20, memory_size("512MB"))
+        self.assertEqual(2 ** 29, memory_size("0.5g"))
 
     def test_version(self):
         actual = main_function_output(["--version"])
@@ -265,12 +1178,15 @@ class TestCommandLine(TestCase):
     def test_cross_validation(self):
         main_function_output(["cross-validation", "test/resources/train.csv",
                               "0.8", "3",
+                              "--seed", "1",
                               "--prefix", "_batches",
                               "--output-directory", self.temporary_directory])
         for i in range(1, 3):
             for partition_name in ["train", "validate"]:
                 filename = os.path.join(self.temporary_directory, "_batches.%d.%s.csv" % (i, partition_name))
                 self.assertTrue(os.path.isfile(filename), "%s is not a file" % filename)
+        self.assertRaises(ValueError, main_function_output,
+                          ["cross-validation", os.path.join(self.temporary_directory, "*.csv"), "0.8", "3"])
 
     def test_train_predict_score(self):
         main_function_output(["train", "test/resources/train.csv",
@@ -280,13 +1196,87 @@ class TestCommandLine(TestCase):
                               "--epochs", "2",
                               "--model", self.model_directory])
         self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "model.h5")))
-        training_history_filename = os.path.join(self.model_directory, "training-history.json")
+        training_history_filename = os.path.join(self.model_directory, "training-history.jsonl")
         self.assertTrue(os.path.isfile(training_history_filename))
         training_history = TrainingHistory.load(training_history_filename)
         self.assertEqual("Training history, 1 runs", str(training_history))
         self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "model.info.txt")))
         main_function_output(["predict", self.model_directory, "test/resources/test.csv"])
         main_function_output(["score", self.model_directory, "test/resources/train.csv"])
+        scores = main_function_output(["score", self.model_directory, "test/resources/train.csv",
+                                       "--chunk-size", "30"])
+        self.assertTrue(scores.startswith("loss="))
+        cache = os.path.join(self.temporary_directory, "cache.db")
+        uncached = main_function_output(["predict", self.model_directory, "test/resources/test.csv", "--cache", cache])
+        cached = main_function_output(["predict", self.model_directory, "test/resources/test.csv", "--cache", cache])
+        self.assertEqual(uncached, cached)
+        predictions = main_function_output(["predict", self.model_directory, "test/resources/test.csv",
+                                            "--output", "top", "--k", "2", "--precision", "3", "--symmetric"])
+        self.assertEqual(",label_1,probability_1,label_2,probability_2", predictions.split("\n")[0])
+        predictions_file = os.path.join(self.temporary_directory, "predictions.npz")
+        main_function_output(["predict", self.model_directory, "test/resources/test.csv",
+                              "--output", "label", "--format", "npz", "--output-file", predictions_file])
+        with np.load(predictions_file) as predictions:
+            self.assertEqual({"index", "label"}, set(predictions.files))
+            self.assertEqual(9, len(predictions["label"]))
+            self.assertEqual("U", predictions["label"].dtype.kind)
+
+    def test_data_parallel_train(self):
+        main_function_output(["train", "test/resources/train.csv",
+                              "--validation-fraction", "0.2",
+                              "--units", "16",
+                              "--epochs", "2",
+                              "--processes", "2",
+                              "--pruned-vectors", "100",
+                              "--model", self.model_directory])
+        self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "model.h5")))
+        self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "vectors", "vectors.npy")))
+        training_history = TrainingHistory.load(os.path.join(self.model_directory, "training-history.jsonl"))
+        self.assertEqual("Training history, 1 runs", str(training_history))
+        self.assertEqual(2, len(training_history.runs[0]["history"]["val_loss"]))
+        main_function_output(["predict", self.model_directory, "test/resources/test.csv"])
+
+    def test_compile_train_predict_score(self):
+        compiled_training = os.path.join(self.temporary_directory, "train.compiled")
+        compiled_test = os.path.join(self.temporary_directory, "test.compiled")
+        main_function_output(["compile", "test/resources/train.csv", compiled_training])
+        main_function_output(["compile", "test/resources/test.csv", compiled_test])
+        main_function_output(["train", compiled_training,
+                              "--validation-fraction", "0.2",
+                              "--units", "16",
+                              "--epochs", "1",
+                              "--model", self.model_directory])
+        self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "model.h5")))
+        predictions = main_function_output(["predict", self.model_directory, compiled_test])
+        self.assertEqual(10, len(predictions.strip().split("\n")))
+        main_function_output(["score", self.model_directory, compiled_training])
+
+    def test_index_search(self):
+        main_function_output(["train", "test/resources/train.csv",
+                              "--units", "16",
+                              "--epochs", "1",
+                              "--model", self.model_directory])
+        texts = os.path.join(self.temporary_directory, "texts.csv")
+        load_data_file("test/resources/train.csv")[[text_1]].rename(columns={text_1: "text"}).to_csv(texts)
+        index_directory = os.path.join(self.temporary_directory, "index")
+        main_function_output(["index", self.model_directory, texts, index_directory, "--clusters", "3"])
+        self.assertTrue(os.path.isfile(os.path.join(index_directory, "encodings.npy")))
+        candidates = main_function_output(["search", index_directory, texts, "--n", "4", "--k", "2"])
+        self.assertEqual(9, len(candidates.strip().split("\n")))
+
+    def test_distill(self):
+        main_function_output(["train", "test/resources/train.csv",
+                              "--units", "16",
+                              "--epochs", "1",
+                              "--model", self.model_directory])
+        student_directory = os.path.join(self.temporary_directory, "student")
+        comparison = main_function_output(["distill", self.model_directory, "test/resources/train.csv",
+                                           "--units", "4",
+                                           "--epochs", "1",
+                                           "--model-directory-name", student_directory])
+        self.assertIn("student", comparison)
+        predictions = main_function_output(["predict", student_directory, "test/resources/test.csv"])
+        self.assertEqual(10, len(predictions.strip().split("\n")))
 
     def test_train_predict_snli_format(self):
         snli_format = [
@@ -305,7 +1295,7 @@ class TestCommandLine(TestCase):
                               "--model", self.model_directory
                               ] + snli_format)
         self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "model.h5")))
-        training_history_filename = os.path.join(self.model_directory, "training-history.json")
+        training_history_filename = os.path.join(self.model_directory, "training-history.jsonl")
         self.assertTrue(os.path.isfile(training_history_filename))
         training_history = TrainingHistory.load(training_history_filename)
         self.assertEqual("Training history, 1 runs", str(training_history))
@@ -317,15 +1307,39 @@ class TestCommandLine(TestCase):
                               "--units", "64",
                               "--dropout", "0.5",
                               "--epochs", "2",
+                              "--seed", "1",
+                              "--intra-op-threads", "2",
                               "--model", self.model_directory])
         self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "model.h5")))
-        training_history_filename = os.path.join(self.model_directory, "training-history.json")
+        training_history_filename = os.path.join(self.model_directory, "training-history.jsonl")
         self.assertTrue(os.path.isfile(training_history_filename))
         training_history = TrainingHistory.load(training_history_filename)
         self.assertEqual("Training history, 1 runs", str(training_history))
+        self.assertEqual(1, training_history.runs[0]["backend"]["seed"])
         self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "model.info.txt")))
         main_function_output(["predict", self.model_directory, "test/resources/test.csv"])
 
+    def test_train_continue_indexed(self):
+        data_filename = os.path.join(self.temporary_directory, "train.csv")
+        shutil.copy("test/resources/train.csv", data_filename)
+        main_function_output(["train", data_filename,
+                              "--index-data",
+                              "--validation-fraction", "0.2",
+                              "--units", "64",
+                              "--epochs", "2",
+                              "--model", self.model_directory])
+        metadata_filename = os.path.join(data_filename + ".index", "index.json")
+        self.assertTrue(os.path.isfile(metadata_filename))
+        modified = os.path.getmtime(metadata_filename)
+        main_function_output(["continue", data_filename, self.model_directory,
+                              "--index-data",
+                              "--curriculum-epochs", "2",
+                              "--epochs", "2"])
+        # Continued training indexes with the model's embedder, so the index is reused.
+        self.assertEqual(modified, os.path.getmtime(metadata_filename))
+        training_history = TrainingHistory.load(os.path.join(self.model_directory, "training-history.jsonl"))
+        self.assertEqual("Training history, 2 runs", str(training_history))
+
     def test_train_predict_crossvalidation_fraction_with_continue(self):
         # Train a model.
         main_function_output(["train", "test/resources/train.csv",
@@ -335,7 +1349,7 @@ class TestCommandLine(TestCase):
                               "--epochs", "2",
                               "--model", self.model_directory])
         self.assertTrue(os.path.isfile(os.path.join(self.model_directory, "model.h5")))
-        training_history_filename = os.path.join(self.model_directory, "training-history.json")
+        training_history_filename = os.path.join(self.model_directory, "training-history.jsonl")
         self.assertTrue(os.path.isfile(training_history_filename))
         training_history = TrainingHistory.load(training_history_filename)
         self.assertEqual("Training history, 1 runs", str(training_history))
@@ -350,6 +1364,9 @@ class TestCommandLine(TestCase):
                               "--epochs", "2"])
         training_history = TrainingHistory.load(training_history_filename)
         self.assertEqual("Training history, 2 runs", str(training_history))
+        summary = main_function_output(["history", self.model_directory, "--last", "1"])
+        self.assertEqual(2, len(summary.strip().split("\n")))
+        self.assertIn("samples/second", summary)
 
     def tearDown(self):
         shutil.rmtree(self.temporary_directory)
@@ -362,5 +1379,6 @@ def main_function_output(args):
         main()
     except SystemExit:
         pass
-    sys.stdout = sys.__stdout__
+    finally:
+        sys.stdout = sys.__stdout__
     return s.getvalue()